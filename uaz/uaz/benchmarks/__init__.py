@@ -0,0 +1,2 @@
+# Benchmarks of the crawler's hot paths. Run a module directly, e.g.:
+# PYTHONPATH=uaz python -m uaz.benchmarks.parse
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: parse
+   :platform: Unix
+   :synopsis: Benchmark of advertisement data extraction: document-wide
+              XPath queries per field against the compiled extractor
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+from __future__ import print_function
+
+import os.path as op
+import timeit
+
+from scrapy import Selector
+from scrapy.http import HtmlResponse, Request
+
+from uaz.items import Advertisement
+from uaz.spiders.irr_spider import IrrSpider, IrrAdvertisementLoader
+
+
+SAMPLE = op.join(op.dirname(op.dirname(__file__)), 'tests', 'responses',
+                 'sample1.html')
+URL = 'http://irr.ru/cars/passenger/UAZ-3163-Patriot-3163-2013-g-v-' \
+      'advert241452769.html'
+
+
+def load_advertisement_by_queries(response):
+    """Extraction as it was done before XPathExtractor: every field is a
+       separate query over the whole document."""
+    ad = IrrAdvertisementLoader(Advertisement(), Selector(response))
+    ad.add_value('source', IrrSpider.source)
+    ad.add_value('url', response.url)
+    ad.add_xpath('foreign_id', '//div[contains(@class, "grey_info")]'
+                 '/span[contains(@class, "number")]/text()')
+    ad.add_xpath('title', '//h1[contains(@class, "title3")]/text()')
+    ad.add_xpath('views', '//span[@id="advCountViewsButton"]/text()')
+    ad.add_xpath('price', '//div[contains(@class, "credit_cost")]/text()')
+    ad.add_xpath('currency', '//div[contains(@class, "credit_cost")]'
+                 '/u/text()')
+    ad.add_xpath('ad_type', '//div[contains(@class, "grey_info")]'
+                 '/span[contains(@class, "partner")]/text()')
+    ad.add_xpath('seller', u'//ul[contains(@class, "form_info")]'
+                 u'/li/p[contains(text(), "Продавец")]'
+                 u'/following-sibling::p/text()')
+    ad.add_xpath('seller_url', u'//ul[contains(@class, "form_info")]'
+                 u'/li/p[contains(text(), "Продавец")]'
+                 u'/following-sibling::p/a/@href')
+    ad.add_xpath('published', '//div[contains(@class, "grey_info")]'
+                 '/span[contains(@class, "data")]/text()')
+    ad.add_xpath('description', '//div[contains(@class, "content_left")]'
+                 '/p[contains(@class, "text")]/text()')
+    ad.add_xpath('region', '//a[contains(@class, "address_link")]/text()')
+    for attr, elem_cls in (
+        ('manufacturer', 'make'), ('model', 'model'),
+        ('modification', 'modification'), ('fuel', 'turbo'),
+        ('mileage', 'mileage'), ('mileage_units', 'mileage'),
+        ('volume', 'volume'), ('volume_units', 'volume'),
+        ('transmission', 'transmittion'), ('release_year', 'car-year'),
+        ('tech_condition', 'condition'), ('body_type', 'bodytype'),
+        ('horsepower', 'engine-power'), ('gear', 'gear'),
+    ):
+        ad.add_xpath(attr, '//li[contains(@class, "cf_block_{0}")]'
+                     '/p[2]/text()'.format(elem_cls))
+    ad.add_xpath('photos', '//div[contains(@class, "slide")]/a/@href')
+    return ad.load_item()
+
+
+def parse_only(response):
+    """Builds the document tree without extraction (the common part)."""
+    return Selector(response)
+
+
+def measure(func, body, number=200, repeat=3):
+    """Measures time of processing of one page.
+
+    Args:
+        func (callable): takes a response.
+        body (str): page content.
+
+    Kwargs:
+        number (int): pages processed in one measurement.
+        repeat (int): number of measurements.
+
+    Returns:
+        float: the best time per page in milliseconds.
+    """
+    def run():
+        # new response for every page: parsed tree is cached per response
+        func(HtmlResponse(URL, body=body, request=Request(URL)))
+    return min(timeit.repeat(run, number=number, repeat=repeat)) / number \
+        * 1000
+
+
+def run(number=200):
+    """Runs the benchmark.
+
+    Kwargs:
+        number (int): pages processed in one measurement.
+
+    Returns:
+        dict: milliseconds per page by variant.
+    """
+    with open(SAMPLE, 'rb') as sample:
+        body = sample.read()
+    return dict((name, measure(func, body, number)) for name, func in (
+        ('parse_only', parse_only),
+        ('per_field_queries', load_advertisement_by_queries),
+        ('compiled_extractor', IrrSpider.load_advertisement),
+    ))
+
+
+if __name__ == '__main__':
+    for name, msecs in sorted(run().iteritems(), key=lambda pair: pair[1]):
+        print(u'{0:<20} {1:8.3f} ms/page'.format(name, msecs))
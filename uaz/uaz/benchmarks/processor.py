@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: processor
+   :platform: Unix
+   :synopsis: Micro-benchmark of numeric processors: character-by-character
+              implementation against the translation table (and check of
+              their equal results)
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+from __future__ import print_function
+
+import random
+import re
+import sys
+import timeit
+
+from uaz.processor import only_digits, only_price
+
+
+SAMPLES = (u'№ 241452769', u'75', u'182 л.с.', u'2.7 л', u'2013 г.',
+           u'125 000 км', u'559.989', u'Цена: 230.150.23 USD')
+
+
+def only_digits_by_chars(raw, force_int=False):
+    """Implementation of only_digits before the translation table."""
+    if isinstance(raw, (unicode, str)) and len(raw):
+        if not force_int and re.search(r'\d\.\d', raw):
+            try:
+                return float(u''.join(u'{0}'.format(one) for one in raw
+                                      if one.isdigit() or one == one.__class__(u'.')))
+            except (TypeError, ValueError):
+                return None
+        else:
+            try:
+                return int(u''.join(u'{0}'.format(one) for one in raw
+                                    if one.isdigit()))
+            except (TypeError, ValueError):
+                return None
+    elif isinstance(raw, (float, int)):
+        return raw
+    else:
+        return None
+
+
+def only_price_by_chars(raw):
+    """Implementation of only_price before the translation table."""
+    if isinstance(raw, (unicode, str)) and len(raw):
+        digits = only_digits_by_chars(raw, force_int=True)
+        if digits is None:
+            return None
+        if re.search(r'\d(\.|,)\d{2}(\D|$)', raw) and len(unicode(digits)) >= 4:
+            return float(u'{0}.{1}'.format(unicode(digits)[:-2],
+                                           unicode(digits)[-2:]))
+        else:
+            return float(digits)
+    else:
+        return None
+
+
+def random_number(rand, separators):
+    """Formats a random number like irr.ru does, with units.
+
+    Args:
+        rand (random.Random): random numbers generator.
+        separators (tuple): thousands separators to choose from (a comma
+                            among them allows decimal comma too).
+
+    Returns:
+        unicode: formatted number.
+    """
+    number = unicode(rand.randint(0, 10 ** rand.randint(1, 9)))
+    thousands = rand.choice(separators)
+    if thousands and len(number) > 3:
+        head = len(number) % 3 or 3
+        number = thousands.join(
+            [number[:head]] + [number[pos:pos + 3]
+                               for pos in xrange(head, len(number), 3)])
+    if rand.random() < 0.5:
+        number += rand.choice(u'.,' if u',' in separators else u'.') \
+            + unicode(rand.randint(0, 999)).zfill(rand.randint(1, 3))
+    return u'{0}{1}{2}'.format(
+        rand.choice((u'', u'№ ', u'Цена: ', u'$')), number,
+        rand.choice((u'', u' км', u'л', u' л.с.', u' руб.', u' г.')))
+
+
+def mismatches(count=2000, seed=42):
+    """Compares results of both implementations for random numbers.
+
+    Kwargs:
+        count (int): number of random values of every processor.
+        seed (int): seed of random numbers.
+
+    Returns:
+        list: tuples of processor name, value, old and new results, which
+              differ.
+    """
+    rand = random.Random(seed)
+    result = []
+
+    def compare(name, old, new, raw, **kwargs):
+        expected, actual = old(raw, **kwargs), new(raw, **kwargs)
+        if expected != actual:
+            result.append((name, raw, expected, actual))
+    for _ in xrange(count):
+        raw = random_number(rand, (u'', u' ', u'\u00a0'))
+        # the old only_digits returns None for a fraction followed by a
+        # unit with a dot ("2.7 л.с."), the new one reads it
+        if only_digits_by_chars(raw) is not None:
+            compare('only_digits', only_digits_by_chars, only_digits, raw)
+        compare('only_digits', only_digits_by_chars, only_digits, raw,
+                force_int=True)
+        raw = random_number(rand, (u'', u' ', u'.'))
+        compare('only_price', only_price_by_chars, only_price, raw)
+    return result
+
+
+def measure(func, number=2000, repeat=3):
+    """Measures time of processing of one value from SAMPLES.
+
+    Args:
+        func (callable): processor.
+
+    Kwargs:
+        number (int): passes over SAMPLES in one measurement.
+        repeat (int): number of measurements.
+
+    Returns:
+        float: the best time per value in microseconds.
+    """
+    def run():
+        for raw in SAMPLES:
+            func(raw)
+    return min(timeit.repeat(run, number=number, repeat=repeat)) \
+        / number / len(SAMPLES) * 1000000
+
+
+def run(number=2000):
+    """Runs the benchmark.
+
+    Kwargs:
+        number (int): passes over SAMPLES in one measurement.
+
+    Returns:
+        dict: microseconds per value by variant.
+    """
+    return dict((name, measure(func, number)) for name, func in (
+        ('only_digits_by_chars', only_digits_by_chars),
+        ('only_digits', only_digits),
+        ('only_price_by_chars', only_price_by_chars),
+        ('only_price', only_price),
+    ))
+
+
+if __name__ == '__main__':
+    different = mismatches()
+    for name, raw, expected, actual in different:
+        print(u'{0}({1!r}): {2!r} before, {3!r} now'.format(
+            name, raw, expected, actual))
+    for name, usecs in sorted(run().iteritems()):
+        print(u'{0:<22} {1:8.3f} us/value'.format(name, usecs))
+    sys.exit(1 if different else 0)
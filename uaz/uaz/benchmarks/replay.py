@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: replay
+   :platform: Unix
+   :synopsis: End-to-end load test: full crawl of a synthetic irr.ru site,
+              which is served by a local http proxy with configurable latency
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import os.path as op
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, SUPPRESS
+from timeit import default_timer
+from urlparse import urlparse
+
+from sqlalchemy.orm import sessionmaker
+
+from twisted.internet import protocol, reactor, task
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from scrapy import log, signals
+from scrapy.crawler import Crawler
+from scrapy.utils.project import get_project_settings
+
+from uaz.benchmarks.suite import FIRST_FOREIGN_ID, RESPONSES_DIRECTORY
+from uaz.benchmarks.suite import SyntheticSpider, bench_database
+from uaz.benchmarks.suite import synthetic_page, synthetic_values
+from uaz.items import Advertisement as AdvertisementItem
+from uaz.metrics import Histogram
+from uaz.models import Advertisement, CrawlMark, FrontierRequest, PriceChange
+from uaz.models import Source, create_tables, db_connect
+
+
+HANDLERS = {
+    'hybrid': 'uaz.handlers.HybridDownloadHandler',
+    'selenium': 'uaz.handlers.SeleniumDownloadHandler',
+    'http': 'scrapy.core.downloader.handlers.http11.HTTP11DownloadHandler',
+    'proxy': 'uaz.handlers.ProxyDownloadHandler',
+}
+
+# frontier of the sharded load test
+FRONTIER_JOB = 'replay'
+
+LISTING_ITEM = u'<div class="add_list"><a class="add_title" href="{url}">' \
+               u'УАЗ 3163 Patriot</a><div class="add_cost">{price} руб.' \
+               u'</div><div class="add_data">{published}</div></div>'
+
+
+class SyntheticSite(Resource):
+    """
+    Synthetic irr.ru: listing pages of any brand (with "same_adds_paging"
+    pagination and "add_title" links) and advertisement pages generated
+    from sample1.html. The site works as http proxy (requests contain
+    absolute urls), so the crawler requests real irr.ru urls and nothing
+    leaves the host.
+    """
+    isLeaf = True
+
+    listing_re = re.compile(r'^(/cars/passenger/[^/]+/)(?:page(\d+)/)?$')
+    advertisement_re = re.compile(r'advert(\d+)\.html$')
+
+    def __init__(self, ads, per_page=30, latency=0.0, jitter=0.0, seed=0):
+        """
+        Args:
+            ads (int): number of advertisements in every listing.
+
+        Kwargs:
+            per_page (int): advertisements on a listing page.
+            latency (float): seconds before every response.
+            jitter (float): max random deviation of the latency in seconds.
+            seed (int): seed of random values.
+        """
+        Resource.__init__(self)
+        with open(op.join(RESPONSES_DIRECTORY, 'sample1.html'), 'rb') \
+                as fixture:
+            self.fixture = fixture.read()
+        self.ads = ads
+        self.per_page = per_page
+        self.pages = max((ads + per_page - 1) // per_page, 1)
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.rand = random.Random(seed)
+        self.served = {'listing': 0, 'advertisement': 0, 'missing': 0}
+
+    def values(self, foreign_id):
+        """Returns price and publication date of an advertisement (the same
+           on the listing and on the page of the advertisement)."""
+        return synthetic_values(random.Random(self.seed * 1000003
+                                              + foreign_id))
+
+    def listing(self, path, page):
+        """Renders a listing page, the newest advertisements go first.
+
+        Args:
+            path (str): path of the first page of the listing.
+            page (int): page number.
+
+        Returns:
+            str: page content.
+        """
+        first = self.ads - (page - 1) * self.per_page
+        items = []
+        for foreign_id in xrange(FIRST_FOREIGN_ID + first - 1, max(
+                FIRST_FOREIGN_ID + first - 1 - self.per_page,
+                FIRST_FOREIGN_ID - 1), -1):
+            price, published = self.values(foreign_id)
+            items.append(LISTING_ITEM.format(
+                url=u'/cars/passenger/UAZ-3163-Patriot-advert{0}.html'.format(
+                    foreign_id), price=price, published=published))
+        paging = []
+        for num in xrange(1, self.pages + 1):
+            paging.append(u'<li{0}><a href="{1}">{2}</a></li>'.format(
+                u' class="current"' if num == page else u'',
+                path if num == 1 else u'{0}page{1}/'.format(path, num), num))
+        return (u'<html><head><title>УАЗ</title></head><body>{0}'
+                u'<ul class="same_adds_paging">{1}</ul></body></html>'.format(
+                    u''.join(items), u''.join(paging))).encode('utf-8')
+
+    def advertisement(self, foreign_id):
+        """Renders a page of an advertisement.
+
+        Args:
+            foreign_id (int): id of the advertisement.
+
+        Returns:
+            str: page content.
+        """
+        return synthetic_page(self.fixture, foreign_id,
+                              *self.values(foreign_id))
+
+    def page(self, path):
+        """Returns http status and content of a page."""
+        listing = self.listing_re.match(path)
+        if listing is not None:
+            page = int(listing.group(2) or 1)
+            if page <= self.pages:
+                self.served['listing'] += 1
+                return 200, self.listing(listing.group(1), page)
+        advertisement = self.advertisement_re.search(path)
+        if advertisement is not None:
+            foreign_id = int(advertisement.group(1))
+            if FIRST_FOREIGN_ID <= foreign_id < FIRST_FOREIGN_ID + self.ads:
+                self.served['advertisement'] += 1
+                return 200, self.advertisement(foreign_id)
+        self.served['missing'] += 1
+        return 404, '<html><body>Not found</body></html>'
+
+    def render_GET(self, request):
+        status, body = self.page(urlparse(request.uri).path)
+        request.setResponseCode(status)
+        request.setHeader('Content-Type', 'text/html; charset=utf-8')
+        delay = self.latency + self.rand.uniform(-self.jitter, self.jitter)
+        if delay <= 0:
+            return body
+        disconnected = []
+        request.notifyFinish().addErrback(disconnected.append)
+
+        def respond():
+            if not disconnected:
+                request.write(body)
+                request.finish()
+        task.deferLater(reactor, delay, respond)
+        return NOT_DONE_YET
+
+
+class BannedProxy(Resource):
+    """Proxy, which answers every request with "429 Too Many Requests"."""
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.served = 0
+
+    def render_GET(self, request):
+        self.served += 1
+        request.setResponseCode(429)
+        request.setHeader('Content-Type', 'text/html; charset=utf-8')
+        return '<html><body>Too many requests</body></html>'
+
+
+def remove_synthetic(database):
+    """Removes synthetic advertisements (of SyntheticSpider's source, with
+       their price changes), high-water marks of SyntheticSpider's start
+       urls and the frontier of the sharded load test from the database.
+
+    Returns:
+        int: number of removed advertisements.
+    """
+    engine = db_connect(database)
+    create_tables(engine)
+    session = sessionmaker(bind=engine)()
+    ads = session.query(Advertisement.id).join(Source).filter(
+        Advertisement.foreign_id >= FIRST_FOREIGN_ID,
+        Source.name == SyntheticSpider.source).subquery()
+    session.query(PriceChange).filter(PriceChange.advertisement_id.in_(
+        ads)).delete(synchronize_session=False)
+    removed = session.query(Advertisement).filter(
+        Advertisement.id.in_(ads)).delete(synchronize_session=False)
+    session.query(CrawlMark).filter(CrawlMark.start_url.in_(
+        SyntheticSpider.start_urls)).delete(synchronize_session=False)
+    session.query(FrontierRequest).filter(
+        FrontierRequest.job == FRONTIER_JOB).delete()
+    session.commit()
+    session.close()
+    return removed
+
+
+def crawl(settings):
+    """Runs SyntheticSpider until it's closed.
+
+    Args:
+        settings (scrapy.settings.Settings): crawler settings.
+
+    Returns:
+        tuple: crawler stats (dict), number of scraped advertisements and
+               seconds between opening and closing of the spider.
+    """
+    crawler = Crawler(settings)
+    scraped, timing = [], {}
+
+    def opened(spider):
+        timing['opened'] = default_timer()
+
+    def item_scraped(item, spider):
+        if isinstance(item, AdvertisementItem):
+            scraped.append(item.get('foreign_id'))
+
+    def closed(spider, reason):
+        timing['closed'] = default_timer()
+        reactor.callLater(0, reactor.stop)
+
+    crawler.signals.connect(opened, signal=signals.spider_opened)
+    crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+    crawler.signals.connect(closed, signal=signals.spider_closed)
+    if settings.get('LOG_ENABLED'):
+        log.start_from_crawler(crawler)
+    crawler.configure()
+    crawler.crawl(SyntheticSpider())
+    crawler.start()
+    reactor.run()
+    return (crawler.stats.get_stats(), len(scraped),
+            timing['closed'] - timing['opened'])
+
+
+class Worker(protocol.ProcessProtocol):
+    """Crawler process of a sharded crawl, which prints its results."""
+
+    def __init__(self, finished):
+        self.output = []
+        self.finished = finished
+
+    def outReceived(self, data):
+        self.output.append(data)
+
+    def processEnded(self, reason):
+        lines = ''.join(self.output).strip().splitlines()
+        self.finished(json.loads(lines[-1]) if lines else None)
+
+
+def spawn_workers(count, argv, proxy):
+    """Runs crawler processes of a sharded crawl against the synthetic site
+       until all of them are finished (the reactor serves the site).
+
+    Args:
+        count (int): number of workers.
+        argv (list): command line arguments of the load test.
+        proxy (str): addresses of the synthetic site (comma separated).
+
+    Returns:
+        list: results of workers (dicts, None if a worker failed).
+    """
+    results = []
+
+    def finished(result):
+        results.append(result)
+        if len(results) == count:
+            reactor.stop()
+
+    for num in xrange(count):
+        args = [sys.executable, '-m', 'uaz.benchmarks.replay'] + argv + [
+            '--proxy', proxy, '-s', 'FRONTIER_WORKER=replay-{0}'.format(num)]
+        reactor.spawnProcess(Worker(finished), sys.executable, args,
+                             env=os.environ, childFDs={0: 'w', 1: 'r', 2: 2})
+    reactor.run()
+    return results
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='End-to-end crawl of a synthetic '
+                                        'irr.ru site.')
+    parser.add_argument('-n', '--ads', type=int, default=300,
+                        help='advertisements in the listing '
+                             '(default: %(default)s)')
+    parser.add_argument('--per-page', type=int, default=30,
+                        help='advertisements on a listing page '
+                             '(default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='seconds before every response '
+                             '(default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help='max random deviation of the latency '
+                             '(default: %(default)s)')
+    parser.add_argument('--handler', choices=sorted(HANDLERS),
+                        help='download handler (default: DOWNLOAD_HANDLERS '
+                             'setting)')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        help='CONCURRENT_REQUESTS (and SELENIUM_POOL_SIZE)')
+    parser.add_argument('-p', '--proxies', type=int, default=1,
+                        help='proxies (ports of the site) in PROXY_PARAMS '
+                             '(default: %(default)s)')
+    parser.add_argument('--banned-proxies', type=int, default=0,
+                        help='proxies in PROXY_PARAMS, which ban every '
+                             'request (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='crawler processes of a sharded crawl with '
+                             'FrontierScheduler (default: %(default)s)')
+    parser.add_argument('-s', '--set', action='append', default=[],
+                        metavar='NAME=VALUE', help='override a setting')
+    parser.add_argument('--log-level', help='show log of the crawl')
+    # worker of a sharded crawl: crawls the site served by the load test
+    parser.add_argument('--proxy', help=SUPPRESS)
+    args = parser.parse_args(argv)
+    settings = get_project_settings()
+    database = bench_database(settings)
+    if not database:
+        return 2
+
+    site = banned = None
+    if args.proxy:
+        proxy = args.proxy
+    else:
+        site = SyntheticSite(args.ads, args.per_page, args.latency,
+                             args.jitter)
+        banned = BannedProxy()
+        addresses = []
+        for resource, count in ((site, args.proxies),
+                                (banned, args.banned_proxies)):
+            for _ in xrange(count):
+                port = reactor.listenTCP(0, Site(resource),
+                                         interface='127.0.0.1')
+                addresses.append('127.0.0.1:{0}'.format(port.getHost().port))
+        proxy = ','.join(addresses)
+    if args.handler == 'http':
+        # scrapy's http client doesn't use the proxies of the spider
+        os.environ['http_proxy'] = os.environ['https_proxy'] = \
+            'http://{0}'.format(proxy.split(',')[0])
+        os.environ.pop('no_proxy', None)
+    directory = tempfile.mkdtemp()
+    overrides = {
+        'DATABASE': database,
+        'PROXY_PARAMS': proxy,
+        'DOWNLOAD_DELAY': 0,
+        'PROXY_DOWNLOAD_DELAY': 0,
+        'HTTPCACHE_ENABLED': False,
+        'METRICS_PROMETHEUS_FILE': None,
+        'XLS_FILENAME': op.join(directory, 'replay'),
+        'LOG_ENABLED': bool(args.log_level),
+        'LOG_LEVEL': args.log_level or 'INFO',
+    }
+    if args.handler:
+        overrides['DOWNLOAD_HANDLERS'] = {'http': HANDLERS[args.handler],
+                                          'https': HANDLERS[args.handler]}
+    if args.concurrency:
+        overrides['CONCURRENT_REQUESTS'] = args.concurrency
+        overrides['SELENIUM_POOL_SIZE'] = args.concurrency
+    if args.workers > 1:
+        overrides['SCHEDULER'] = 'uaz.scheduler.FrontierScheduler'
+        overrides['FRONTIER_JOB'] = FRONTIER_JOB
+        overrides['FRONTIER_LEASE'] = 60
+    for override in args.set:
+        name, value = override.split('=', 1)
+        overrides[name] = value
+    settings.setdict(overrides, priority='cmdline')
+
+    if args.proxy:
+        try:
+            stats, scraped, seconds = crawl(settings)
+        finally:
+            shutil.rmtree(directory)
+        closed = time.time()
+        print(json.dumps({'finish_reason': stats.get('finish_reason'),
+                          'scraped': scraped, 'opened': closed - seconds,
+                          'closed': closed}))
+        return 0
+
+    remove_synthetic(database)
+    try:
+        if args.workers > 1:
+            results = spawn_workers(args.workers, sys.argv[1:] if argv is None
+                                    else list(argv), proxy)
+            finished = [result for result in results if result]
+            stats = {'finish_reason': 'finished' if finished and all(
+                result['finish_reason'] == 'finished'
+                for result in results if result) and len(finished) ==
+                len(results) else 'failed'}
+            scraped = sum(result['scraped'] for result in finished)
+            seconds = max(result['closed'] for result in finished) - min(
+                result['opened'] for result in finished) if finished else 0
+        else:
+            stats, scraped, seconds = crawl(settings)
+    finally:
+        stored = remove_synthetic(database)
+        shutil.rmtree(directory)
+
+    print(u'{0:<24} {1}'.format(u'finish reason', stats.get('finish_reason')))
+    print(u'{0:<24} {1}'.format(u'listing pages served',
+                                site.served['listing']))
+    print(u'{0:<24} {1}'.format(u'ad pages served',
+                                site.served['advertisement']))
+    if args.banned_proxies:
+        print(u'{0:<24} {1}'.format(u'banned pages served', banned.served))
+    print(u'{0:<24} {1} of {2} ({3} stored)'.format(
+        u'ads scraped', scraped, args.ads, stored))
+    print(u'{0:<24} {1:.1f}'.format(u'seconds', seconds))
+    print(u'{0:<24} {1:.1f}'.format(u'ads/minute',
+                                    scraped / seconds * 60 if seconds else 0))
+    for key, value in sorted(stats.iteritems()):
+        if isinstance(value, Histogram):
+            print(u'{0:<24} {1!r}'.format(key, value))
+    if stats.get('finish_reason') != 'finished' or scraped < args.ads:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
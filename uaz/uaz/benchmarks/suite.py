@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: suite
+   :platform: Unix
+   :synopsis: Benchmark of the whole item path (parsing, processors, excel
+              and database pipelines) without network and browser
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+from __future__ import print_function
+
+import os.path as op
+import json
+import random
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+from timeit import default_timer
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.project import get_project_settings
+
+from uaz.benchmarks.processor import SAMPLES
+from uaz.models import Advertisement, PriceChange, Source
+from uaz.pipelines import UazDBPipeline, UazExcelPipeline
+from uaz.processor import RU_EN_MONTHS
+from uaz.processor import only_digits, only_price, datetime_interpretation
+from uaz.spiders.irr_spider import IrrSpider
+
+
+RESPONSES_DIRECTORY = op.join(op.dirname(op.dirname(__file__)), 'tests',
+                              'responses')
+BASELINE = op.join(op.dirname(__file__), 'baseline.json')
+
+# ids of synthetic advertisements, far from ids of real ones
+FIRST_FOREIGN_ID = 900000000
+
+
+class SyntheticSpider(IrrSpider):
+    """
+    IrrSpider for synthetic pages. Advertisements are stored with their own
+    source and the listing has its own url (and high-water mark), so
+    benchmarks don't touch data of real crawls.
+    """
+    source = 'synthetic.irr.ru'
+    start_urls = ['http://irr.ru/cars/passenger/synthetic/']
+
+
+def bench_database(settings):
+    """Returns the scratch database of benchmarks, which remove their data
+       from it.
+
+    Args:
+        settings (scrapy.settings.Settings): project settings.
+
+    Returns:
+        dict: BENCH_DATABASE.
+        None: if BENCH_DATABASE isn't set or it's DATABASE.
+    """
+    database = settings.get('BENCH_DATABASE')
+    if not database:
+        print(u'BENCH_DATABASE is not set')
+        return None
+    production = settings.get('DATABASE') or {}
+    if all(database.get(key) == production.get(key)
+           for key in ('host', 'port', 'database')):
+        print(u'BENCH_DATABASE is DATABASE, benchmarks never run against '
+              u'the database of the crawler')
+        return None
+    return database
+
+
+def synthetic_pages(count, seed=0):
+    """Generates pages from the fixtures, with unique ids, prices and dates.
+
+    Args:
+        count (int): number of pages.
+
+    Kwargs:
+        seed (int): seed of random values.
+
+    Returns:
+        list: tuples of url and page content.
+    """
+    rand = random.Random(seed)
+    fixtures = []
+    for filename in ('sample1.html',):
+        with open(op.join(RESPONSES_DIRECTORY, filename), 'rb') as fixture:
+            fixtures.append(fixture.read())
+    pages = []
+    for num in xrange(count):
+        foreign_id = FIRST_FOREIGN_ID + num
+        pages.append((
+            'http://irr.ru/cars/passenger/UAZ-advert{0}.html'.format(
+                foreign_id),
+            synthetic_page(fixtures[num % len(fixtures)], foreign_id,
+                           *synthetic_values(rand))))
+    return pages
+
+
+def synthetic_values(rand):
+    """Generates price and publication date of a synthetic page.
+
+    Args:
+        rand (random.Random): generator of random values.
+
+    Returns:
+        tuple: price and date as they are shown on the page (unicode).
+    """
+    price = u'{0}.{1:03d}'.format(rand.randint(100, 999), rand.randint(0, 999))
+    published = u'{0} {1} {2}'.format(rand.randint(1, 28),
+                                      rand.choice(RU_EN_MONTHS)[0],
+                                      rand.randint(2005, 2014))
+    return price, published
+
+
+def synthetic_page(fixture, foreign_id, price, published):
+    """Creates a page of an advertisement from a fixture.
+
+    Args:
+        fixture (str): content of an advertisement page.
+        foreign_id (int): id of the advertisement.
+        price (unicode): price as it's shown on the page.
+        published (unicode): publication date as it's shown on the page.
+
+    Returns:
+        str: page content.
+    """
+    return fixture.replace('241452769', str(foreign_id)) \
+        .replace('559.989', price.encode('utf-8')) \
+        .replace(u'27 декабря 2013'.encode('utf-8'), published.encode('utf-8'))
+
+
+class Stage(object):
+    """Collects latencies of one stage of the item path."""
+
+    def __init__(self, name, unit):
+        """
+        Args:
+            name (str): stage name.
+            unit (str): processed object (page, item, value, batch).
+        """
+        self.name = name
+        self.unit = unit
+        self.latencies = []
+        self.items = 0
+
+    def measure(self, func, *args, **kwargs):
+        """Calls a function and keeps its latency.
+
+        Kwargs:
+            items (int): number of items processed by the call.
+
+        Returns:
+            result of the function.
+        """
+        items = kwargs.pop('items', 1)
+        start = default_timer()
+        result = func(*args, **kwargs)
+        self.latencies.append(default_timer() - start)
+        self.items += items
+        return result
+
+    def percentile(self, percent):
+        """Returns latency percentile in milliseconds."""
+        latencies = sorted(self.latencies)
+        index = min(int(len(latencies) * percent / 100.0), len(latencies) - 1)
+        return latencies[index] * 1000
+
+    def report(self):
+        """Returns items per second and latency percentiles."""
+        total = sum(self.latencies)
+        return {
+            'unit': self.unit,
+            'items': self.items,
+            'items_per_sec': self.items / total if total else 0,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'p99_ms': self.percentile(99),
+        }
+
+
+def bench_parse(pages):
+    stage = Stage('parse', 'page')
+    items = []
+    for url, body in pages:
+        response = HtmlResponse(url, body=body, request=Request(url))
+        items.append(stage.measure(SyntheticSpider.load_advertisement,
+                                   response))
+    return stage, items
+
+
+def bench_processors(passes):
+    stage = Stage('processors', 'value')
+    values = SAMPLES + tuple(u'{0} {1} 2013'.format(day, month)
+                             for day in xrange(1, 29)
+                             for month, en in RU_EN_MONTHS)
+    for _ in xrange(passes):
+        for raw in values:
+            stage.measure(only_digits, raw)
+            stage.measure(only_price, raw)
+            stage.measure(datetime_interpretation, raw)
+    return stage
+
+
+def bench_excel(items):
+    stage, save = Stage('excel', 'item'), Stage('excel_save', 'file')
+    directory = tempfile.mkdtemp()
+    try:
+        pipeline = UazExcelPipeline()
+        pipeline.filename = op.join(directory, 'bench.xls')
+        for item in items:
+            stage.measure(pipeline.process_item, item, None)
+        save.measure(pipeline.close_spider, None, items=len(items))
+    finally:
+        shutil.rmtree(directory)
+    return stage, save
+
+
+def bench_db(items, database, batch_size):
+    stage = Stage('db', 'batch')
+    pipeline = UazDBPipeline(database=database)
+    pipeline.preload_references()
+
+    def cleanup():
+        session = pipeline.Session()
+        ads = session.query(Advertisement.id).join(Source).filter(
+            Advertisement.foreign_id >= FIRST_FOREIGN_ID,
+            Source.name == SyntheticSpider.source).subquery()
+        session.query(PriceChange).filter(PriceChange.advertisement_id.in_(
+            ads)).delete(synchronize_session=False)
+        session.query(Advertisement).filter(Advertisement.id.in_(
+            ads)).delete(synchronize_session=False)
+        session.commit()
+        session.close()
+
+    cleanup()
+    try:
+        for pos in xrange(0, len(items), batch_size):
+            batch = items[pos:pos + batch_size]
+            stage.measure(pipeline.store, batch, items=len(batch))
+    finally:
+        cleanup()
+    return stage
+
+
+def compare(results, baseline, tolerance):
+    """Compares throughput of stages with the baseline.
+
+    Returns:
+        list: names of stages slower than the baseline more than tolerance.
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        ratio = result['items_per_sec'] / baseline[name]['items_per_sec']
+        print(u'{0:<12} {1:6.2f}x of baseline'.format(name, ratio))
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark of the item path.')
+    parser.add_argument('-n', '--pages', type=int, default=200,
+                        help='number of synthetic pages (default: 200)')
+    parser.add_argument('--save', action='store_true',
+                        help='store results as the baseline')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline file (default: %(default)s)')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='acceptable slowdown of throughput '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    settings = get_project_settings()
+
+    stages = []
+    parse, items = bench_parse(synthetic_pages(args.pages))
+    stages.extend((parse, bench_processors(max(args.pages / 100, 1))))
+    stages.extend(bench_excel(items))
+    database = bench_database(settings)
+    if database:
+        stages.append(bench_db(items, database,
+                               max(settings.getint('DB_BATCH_SIZE', 1), 1)))
+    else:
+        print(u'Database stage is skipped')
+
+    results = dict((stage.name, stage.report()) for stage in stages)
+    print(u'{0:<12} {1:>8} {2:>12} {3:>9} {4:>9} {5:>9}'.format(
+        u'stage', u'unit', u'items/sec', u'p50 ms', u'p90 ms', u'p99 ms'))
+    for stage in stages:
+        result = results[stage.name]
+        print(u'{0:<12} {unit:>8} {items_per_sec:12.1f} {p50_ms:9.3f} '
+              u'{p90_ms:9.3f} {p99_ms:9.3f}'.format(stage.name, **result))
+
+    if args.save:
+        with open(args.baseline, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+        return 0
+    if not op.exists(args.baseline):
+        return 0
+    with open(args.baseline) as baseline:
+        regressions = compare(results, json.load(baseline), args.tolerance)
+    if regressions:
+        print(u'Slower than the baseline: {0}'.format(u', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: browser
+   :platform: Unix
+   :synopsis: Pool of selenium webdriver instances rendering pages in
+              worker threads
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import json
+import os
+import os.path as op
+import shutil
+import socket
+import time
+from base64 import b64encode
+from httplib import HTTPException
+from threading import Lock
+
+from twisted.internet import reactor, threads
+from twisted.internet.defer import DeferredQueue
+from twisted.python.threadpool import ThreadPool
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from selenium.webdriver.common.proxy import Proxy, ProxyType
+from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
+from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
+from selenium.webdriver.support.ui import WebDriverWait
+
+from pyvirtualdisplay import Display
+
+from .metrics import timed
+
+
+# firefox preferences of the lean profile: no images, fonts and plugins,
+# browser.get returns without waiting for all resources of the page
+LEAN_PREFERENCES = (
+    ('permissions.default.image', 2),
+    ('gfx.downloadable_fonts.enabled', False),
+    ('browser.display.use_document_fonts', 0),
+    ('plugin.state.flash', 0),
+    ('network.prefetch-next', False),
+    ('network.dns.disablePrefetch', True),
+    ('webdriver.load.strategy', 'unstable'),
+)
+
+PROXY_AUTOCONFIG = """function FindProxyForURL(url, host) {{
+    var blocked = {blocked};
+    for (var i = 0; i < blocked.length; i++) {{
+        if (host == blocked[i] || dnsDomainIs(host, '.' + blocked[i])) {{
+            return 'PROXY 127.0.0.1:9';
+        }}
+    }}
+    return '{default}';
+}}"""
+
+
+def proxy_autoconfig(proxy, blocked):
+    """Creates proxy auto-config script, which sends requests to blocked
+       hosts into nowhere (closed local port) and other requests to the
+       proxy.
+
+    Args:
+        proxy (str): proxy server address (host:port) or None (direct
+                     connection).
+        blocked (list): blocked domains (with subdomains).
+
+    Returns:
+        str: data url with the script.
+    """
+    script = PROXY_AUTOCONFIG.format(
+        blocked=json.dumps(list(blocked)),
+        default='PROXY {0}'.format(proxy) if proxy else 'DIRECT')
+    return 'data:application/x-ns-proxy-autoconfig;base64,{0}'.format(
+        b64encode(script))
+
+
+def browser_rss(browser):
+    """Returns resident memory of the browser's main process.
+
+    Args:
+        browser (selenium.webdriver.Firefox): webdriver instance.
+
+    Returns:
+        int: memory size in bytes (0 if it's unknown).
+    """
+    try:
+        pid = browser.binary.process.pid
+        with open('/proc/{0}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (AttributeError, IOError, ValueError):
+        pass
+    return 0
+
+
+def browser_session(browser):
+    """Returns what plain http requests need to pass for the browser.
+
+    Args:
+        browser (selenium.webdriver.Firefox): webdriver instance.
+
+    Returns:
+        dict: "cookies" (list of dicts with name, value and domain) and
+              "user_agent" of the browser.
+    """
+    return {
+        'cookies': browser.get_cookies(),
+        'user_agent': browser.execute_script('return navigator.userAgent;'),
+    }
+
+
+class BrowserPool(object):
+    """
+    Keeps a fixed number of webdriver instances (headless or started in one
+    virtual display). Every page is rendered by an idle browser in a worker
+    thread, so the reactor isn't blocked while the browser loads a page.
+    Browsers are started when the first pages are requested, restarted after
+    crashes, after SELENIUM_RESTART_PAGES pages or when they take too much
+    memory; failed loads are retried by a new browser.
+    """
+
+    def __init__(self, settings, proxy=None):
+        """Configures the pool of SELENIUM_POOL_SIZE webdriver instances.
+        Nothing is started until the first page is requested, so creation
+        of the pool is cheap. Every webdriver instance of the pool uses the
+        same proxy (see uaz.proxies.ProxyPool).
+
+        Args:
+            settings (scrapy.settings.Settings): project settings.
+
+        Kwargs:
+            proxy (str): proxy server address (host:port) or None (direct
+                         connection).
+        """
+        self.settings = settings
+        self.proxy = proxy
+        self.stats = None
+        self.lean = settings.getbool('SELENIUM_LEAN_PROFILE', False)
+        self.wait_for = tuple(tuple(group) for group in
+                              settings.get('SELENIUM_WAIT_FOR', ()))
+        self.wait_timeout = settings.getfloat('SELENIUM_WAIT_TIMEOUT', 10)
+        self.page_load_timeout = settings.getfloat(
+            'SELENIUM_PAGE_LOAD_TIMEOUT', 0)
+        self.script_timeout = settings.getfloat('SELENIUM_SCRIPT_TIMEOUT', 0)
+        self.retry_times = max(settings.getint('SELENIUM_RETRY_TIMES', 0), 0)
+        self.retry_backoff = settings.getfloat('SELENIUM_RETRY_BACKOFF', 1)
+        self.restart_pages = settings.getint('SELENIUM_RESTART_PAGES', 0)
+        self.max_rss = settings.getint('SELENIUM_MAX_RSS', 0) * 1024 * 1024
+        self.size = max(settings.getint('SELENIUM_POOL_SIZE', 1), 1)
+        self.headless = settings.getbool('SELENIUM_HEADLESS', False)
+        self.profile_dir = settings.get('SELENIUM_PROFILE_DIR')
+        self.profile_lock = Lock()
+        self.xsession = None
+        self.xsession_lock = Lock()
+        self.browsers = [None] * self.size
+        self.pages = [0] * self.size
+        self.crashed = [False] * self.size
+        self.idle = DeferredQueue()
+        for slot in xrange(self.size):
+            self.idle.put(slot)
+        self.threadpool = None
+        self.shutdown_trigger = None
+
+    def start(self):
+        """Starts worker threads. Browsers are started by the threads."""
+        self.threadpool = ThreadPool(self.size, self.size, u'BrowserPool')
+        self.threadpool.start()
+        self.shutdown_trigger = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self.threadpool.stop)
+
+    def ensure_xsession(self):
+        """Starts xsession in virtual display for browsers without headless
+           mode (or restarts it if it has died)."""
+        if self.headless:
+            return
+        with self.xsession_lock:
+            if self.xsession is not None:
+                if self.xsession.is_alive():
+                    return
+                self.inc_stat('browser/xsession_restarts')
+                try:
+                    self.xsession.stop()
+                except Exception:
+                    pass
+            self.xsession = self.create_xsession()
+
+    def create_xsession(self):
+        """Starts xsession in virtual display.
+
+        Returns:
+            pyvirtualdisplay.Display: started display.
+        """
+        xsession = Display(
+            visible=self.settings.get('XSESSION_VISIBLE', False),
+            size=self.settings.get('XSESSION_DISPLAY_RESOLUTION', (800, 600)),
+        )
+        xsession.start()
+        return xsession
+
+    def create_browser(self):
+        """Starts new webdriver instance with a copy of the pre-warmed
+           profile (if SELENIUM_PROFILE_DIR is set).
+
+        Returns:
+            selenium.webdriver.Firefox: started browser.
+        """
+        return self.launch_browser(self.profile_template())
+
+    def profile_template(self):
+        """Returns the directory of the pre-warmed profile. If it doesn't
+           exist, it's copied from the profile of a browser, which has been
+           started once (so preferences, extension and databases of the
+           profile are initialized by this browser, not by every next one).
+
+        Returns:
+            str: path of the directory.
+            None: if SELENIUM_PROFILE_DIR isn't set.
+        """
+        if not self.profile_dir:
+            return None
+        with self.profile_lock:
+            if not op.isdir(self.profile_dir):
+                browser = self.launch_browser()
+                try:
+                    browser.get('about:blank')
+                    temporary = self.profile_dir + '.tmp'
+                    shutil.rmtree(temporary, ignore_errors=True)
+                    shutil.copytree(browser.profile.path, temporary,
+                                    ignore=shutil.ignore_patterns(
+                                        'parent.lock', 'lock', '.parentlock'))
+                    os.rename(temporary, self.profile_dir)
+                finally:
+                    browser.quit()
+                self.inc_stat('browser/profile_warmed')
+        return self.profile_dir
+
+    def launch_browser(self, template=None):
+        """Starts new webdriver instance. With SELENIUM_HEADLESS it uses
+           native headless mode of firefox, otherwise it's started in
+           xsession. With SELENIUM_LEAN_PROFILE the browser doesn't load
+           images, fonts, plugins and resources from SELENIUM_BLOCKED_HOSTS,
+           and uses "eager" page loading strategy.
+
+        Kwargs:
+            template (str): profile directory copied for the browser (None -
+                            new profile).
+
+        Returns:
+            selenium.webdriver.Firefox: started browser.
+        """
+        self.ensure_xsession()
+        profile = FirefoxProfile(template)
+        binary = FirefoxBinary()
+        if self.headless:
+            binary.add_command_line_options('-headless')
+        capabilities = dict(DesiredCapabilities.FIREFOX)
+        if self.lean:
+            for key, value in LEAN_PREFERENCES:
+                profile.set_preference(key, value)
+            capabilities['pageLoadStrategy'] = 'eager'
+        browser = webdriver.Firefox(firefox_profile=profile,
+                                    firefox_binary=binary,
+                                    capabilities=capabilities,
+                                    proxy=self.create_proxy())
+        browser.maximize_window()
+        if self.page_load_timeout > 0:
+            browser.set_page_load_timeout(self.page_load_timeout)
+        if self.script_timeout > 0:
+            browser.set_script_timeout(self.script_timeout)
+        return browser
+
+    def create_proxy(self):
+        """Creates proxy settings of a browser: the proxy server of the
+           pool, and auto-config script blocking SELENIUM_BLOCKED_HOSTS in
+           the lean profile.
+
+        Returns:
+            selenium.webdriver.common.proxy.Proxy: proxy settings.
+            None: direct connection.
+        """
+        proxy = self.proxy
+        blocked = self.settings.getlist('SELENIUM_BLOCKED_HOSTS') \
+            if self.lean else []
+        if blocked:
+            return Proxy({
+                'proxyType': ProxyType.PAC,
+                'proxyAutoconfigUrl': proxy_autoconfig(proxy, blocked),
+            })
+        if proxy:
+            return Proxy({
+                'proxyType': ProxyType.MANUAL,
+                'httpProxy': proxy,
+                'ftpProxy': proxy,
+                'sslProxy': proxy,
+                'noProxy': proxy,
+            })
+        return None
+
+    def render(self, url, session=False):
+        """Loads a page in the first idle browser.
+
+        Args:
+            url (unicode or str): page url.
+
+        Kwargs:
+            session (bool): return the browser's session too.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with a tuple of the final
+                                             url and the page source (and
+                                             the session, see
+                                             browser_session).
+        """
+        if self.threadpool is None:
+            self.start()
+        deferred = self.idle.get()
+        deferred.addCallback(self._render_in_thread, url, session)
+        return deferred
+
+    def _render_in_thread(self, slot, url, session=False):
+        deferred = threads.deferToThreadPool(
+            reactor, self.threadpool, self.fetch, slot, url, session)
+        deferred.addBoth(self._release, slot)
+        return deferred
+
+    def _release(self, result, slot):
+        self.idle.put(slot)
+        return result
+
+    def fetch(self, slot, url, session=False):
+        """Loads a page by a browser from the pool (in a worker thread). The
+           browser is restarted if it's needed. Failed loads are retried
+           SELENIUM_RETRY_TIMES times, pauses between attempts grow twice
+           from SELENIUM_RETRY_BACKOFF seconds.
+
+        Args:
+            slot (int): number of the browser in the pool.
+            url (unicode or str): page url.
+
+        Kwargs:
+            session (bool): return the browser's session too.
+
+        Raises:
+            selenium.common.exceptions.WebDriverException: if all attempts
+                                                            failed.
+
+        Returns:
+            tuple: final url (after redirects) and source of the page (and
+                   the session, see browser_session).
+        """
+        if self.browsers[slot] is None:
+            self.start_browser(slot)
+        attempt = 0
+        while True:
+            reason = self.restart_reason(slot)
+            if reason is not None:
+                self.restart(slot, reason)
+            try:
+                page = self.load_page(self.browsers[slot], url, self.stats,
+                                      self.wait_for, self.wait_timeout)
+                if session:
+                    page += (browser_session(self.browsers[slot]),)
+            except TimeoutException:
+                self.inc_stat('browser/timeouts')
+                if attempt >= self.retry_times:
+                    raise
+            except (WebDriverException, socket.error, HTTPException):
+                self.inc_stat('browser/crashes')
+                self.crashed[slot] = True
+                if attempt >= self.retry_times:
+                    raise
+            else:
+                self.pages[slot] += 1
+                return page
+            self.inc_stat('browser/retries')
+            time.sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+
+    def restart_reason(self, slot):
+        """Checks whether a browser should be restarted.
+
+        Args:
+            slot (int): number of the browser in the pool.
+
+        Returns:
+            str: reason of restart ("crash", "pages" or "rss").
+            None: if the browser is fine.
+        """
+        if self.crashed[slot]:
+            return 'crash'
+        if self.restart_pages and self.pages[slot] >= self.restart_pages:
+            return 'pages'
+        if self.max_rss and browser_rss(self.browsers[slot]) > self.max_rss:
+            return 'rss'
+        return None
+
+    def restart(self, slot, reason):
+        """Replaces a browser with new one (and restarts xsession if it has
+           died).
+
+        Args:
+            slot (int): number of the browser in the pool.
+            reason (str): reason of restart for stats.
+        """
+        self.inc_stat('browser/restarts')
+        self.inc_stat('browser/restarts/{0}'.format(reason))
+        self.crashed[slot] = True  # until new browser is started
+        try:
+            self.browsers[slot].quit()
+        except Exception:
+            pass
+        self.start_browser(slot)
+
+    def start_browser(self, slot):
+        """Starts a browser in a slot of the pool.
+
+        Args:
+            slot (int): number of the browser in the pool.
+        """
+        self.browsers[slot] = self.create_browser()
+        self.pages[slot] = 0
+        self.crashed[slot] = False
+        self.inc_stat('browser/starts')
+
+    def inc_stat(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
+    @staticmethod
+    def load_page(browser, url, stats=None, wait_for=(), wait_timeout=10):
+        """Loads a page. Blocks until the browser finishes, so it is called
+           from a worker thread only.
+
+        Args:
+            browser (selenium.webdriver.Firefox): webdriver instance.
+            url (unicode or str): page url.
+
+        Kwargs:
+            stats (scrapy.statscol.StatsCollector): crawler stats for
+                                                    latencies of page loading
+                                                    and serialization.
+            wait_for (tuple): groups of css selectors. The page is ready
+                              when every element of any group is found (or
+                              when wait_timeout expires).
+            wait_timeout (float): max seconds of waiting for elements.
+
+        Returns:
+            tuple: final url (after redirects) and source of the page.
+        """
+        with timed(stats, 'download/page_load'):
+            browser.get(url)
+        if wait_for:
+            with timed(stats, 'download/wait'):
+                try:
+                    WebDriverWait(browser, wait_timeout, 0.1).until(
+                        lambda browser: any(
+                            all(browser.find_elements_by_css_selector(css)
+                                for css in group) for group in wait_for))
+                except TimeoutException:
+                    if stats is not None:
+                        stats.inc_value('download/wait_timeout')
+        with timed(stats, 'download/page_source'):
+            source = browser.page_source
+        return browser.current_url, source
+
+    def stop(self):
+        """Stops worker threads, webdriver instances and xsession (the ones,
+           which have been started)."""
+        if self.threadpool is not None:
+            reactor.removeSystemEventTrigger(self.shutdown_trigger)
+            self.threadpool.stop()
+            self.threadpool = None
+        for browser in self.browsers:
+            if browser is None:
+                continue
+            try:
+                browser.quit()
+            except Exception:
+                pass
+        self.browsers = [None] * self.size
+        if self.xsession is not None:
+            self.xsession.stop()
+            self.xsession = None
@@ -0,0 +1,2 @@
+# This package contains custom scrapy commands of the project (see
+# COMMANDS_MODULE in settings.py).
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: migrate
+   :platform: Unix
+   :synopsis: Command for upgrading of the database created by previous
+              versions of the crawler
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+from __future__ import print_function
+
+from scrapy.command import ScrapyCommand
+
+from uaz.models import db_connect, migrate
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Upgrade the database created by previous versions"
+
+    def long_desc(self):
+        return ("Create tables, columns and indexes missing in the database "
+                "(DATABASE setting). Before a unique index is created, "
+                "duplicate records are merged: the oldest record is kept, "
+                "references to removed ones are redirected to it. Stop "
+                "crawlers before the upgrade.")
+
+    def run(self, args, opts):
+        added = migrate(db_connect())
+        for name in added:
+            print(u"Added {0}".format(name))
+        print(u"Database is up to date ({0} changes)".format(len(added)))
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: reparse
+   :platform: Unix
+   :synopsis: Command for re-parsing of stored advertisement pages and
+              updating of advertisements in the database
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import gzip
+import sys
+import traceback
+import tarfile
+import zipfile
+import time
+import cPickle as pickle
+from cStringIO import StringIO
+from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
+from multiprocessing import Pool, cpu_count
+
+from scrapy.command import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import HtmlResponse, Headers
+
+from uaz.pipelines import UazDBPipeline
+from uaz.spiders.irr_spider import IrrSpider
+
+
+PAGE_EXTENSIONS = ('.html', '.htm', '.gz')
+
+
+def iter_pages(paths):
+    """Lists stored pages in directories and archives.
+
+    Args:
+        paths (list): directories, tar or zip archives, or page files. Pages
+                      are html files or gzipped files of RenderedPageStorage.
+
+    Returns:
+        generator: tuples of page name, content and modification timestamp
+                   of archive member (content and timestamp are None if the
+                   page should be read from the file with this name).
+    """
+    for path in paths:
+        if op.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for filename in sorted(files):
+                    if filename.endswith(PAGE_EXTENSIONS):
+                        yield op.join(root, filename), None, None
+        elif tarfile.is_tarfile(path):
+            archive = tarfile.open(path)
+            for member in archive:
+                if member.isfile() and member.name.endswith(PAGE_EXTENSIONS):
+                    yield (member.name, archive.extractfile(member).read(),
+                           member.mtime)
+            archive.close()
+        elif zipfile.is_zipfile(path):
+            archive = zipfile.ZipFile(path)
+            for info in archive.infolist():
+                if info.filename.endswith(PAGE_EXTENSIONS):
+                    yield (info.filename, archive.read(info),
+                           time.mktime(info.date_time + (0, 0, -1)))
+            archive.close()
+        else:
+            yield path, None, None
+
+
+def fetch_time(data, mtime):
+    """Determines the time of download of a page cached by
+       RenderedPageStorage.
+
+    Args:
+        data (dict): unpickled cache entry.
+        mtime (float): modification timestamp of the cache file.
+
+    Returns:
+        datetime: time from the stored Date header or from the modification
+                  time (local time).
+        None: if the time is unknown.
+    """
+    date = Headers(data.get('headers') or {}).get('Date')
+    if date:
+        parsed = parsedate_tz(date)
+        if parsed:
+            return datetime.fromtimestamp(mktime_tz(parsed))
+    if mtime is not None:
+        return datetime.fromtimestamp(mtime)
+    return None
+
+
+def parse_page(page):
+    """Extracts advertisement data from a stored page (in worker process).
+
+    Relative dates ("today", "yesterday") are resolved against the time of
+    download of the page. It's known only for pages stored by
+    RenderedPageStorage, so for other pages such dates are dropped (and
+    stored values are kept by UazDBPipeline.update).
+
+    Args:
+        page (tuple): page name, content and modification timestamp (None
+                      to read them from the file).
+
+    Returns:
+        dict: advertisement data. Url is included only if it's known (for
+              pages stored by RenderedPageStorage).
+        None: if the page can't be read or parsed (the error is printed).
+    """
+    name, content, mtime = page
+    try:
+        if content is None:
+            with open(name, 'rb') as source:
+                content = source.read()
+            mtime = op.getmtime(name)
+        url = None
+        context = dict(relative_dates=False)
+        if name.endswith('.gz'):
+            data = pickle.loads(
+                gzip.GzipFile(fileobj=StringIO(content)).read())
+            url, content = data['url'], data['body']
+            fetched = fetch_time(data, mtime)
+            if fetched is not None:
+                context = dict(now=fetched)
+        response = HtmlResponse(
+            url or u'file://{0}'.format(op.abspath(name)), body=content)
+        item = dict(IrrSpider.load_advertisement(response, **context))
+    except Exception:
+        print(u"Can't parse {0}:\n{1}".format(name, traceback.format_exc()),
+              file=sys.stderr)
+        return None
+    if url is None:
+        del item['url']
+    return item
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return "[options] <directory or archive> ..."
+
+    def short_desc(self):
+        return "Re-parse stored advertisement pages and update the database"
+
+    def long_desc(self):
+        return ("Re-parse stored advertisement pages (html files or pages "
+                "cached by RenderedPageStorage, in directories, tar or zip "
+                "archives) in parallel processes and update matching "
+                "advertisements in the database by foreign id. Browser "
+                "isn't started.")
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option("-j", "--processes", type="int",
+                          default=cpu_count(),
+                          help="number of parsing processes (default: "
+                               "number of CPUs)")
+        parser.add_option("-b", "--batch-size", type="int", default=500,
+                          help="number of advertisements updated by one "
+                               "transaction (default: 500)")
+
+    def run(self, args, opts):
+        if not args:
+            raise UsageError()
+        pipeline = UazDBPipeline()
+        pipeline.preload_references()
+        pool = Pool(max(opts.processes, 1))
+        parsed = updated = skipped = 0
+        batch = []
+        for item in pool.imap_unordered(parse_page, iter_pages(args),
+                                        chunksize=16):
+            parsed += 1
+            if not item or not item.get('foreign_id'):
+                skipped += 1
+                continue
+            batch.append(item)
+            if len(batch) >= opts.batch_size:
+                updated += pipeline.update(batch)
+                batch = []
+        if batch:
+            updated += pipeline.update(batch)
+        pool.close()
+        pool.join()
+        print(u"Parsed {0} pages ({1} broken or without foreign id), "
+              u"updated {2} advertisements".format(parsed, skipped, updated))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: extractor
+   :platform: Unix
+   :synopsis: Extraction of item fields by XPath expressions compiled once
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+from collections import defaultdict
+
+from lxml import etree
+from scrapy.selector.lxmldocument import LxmlDocument
+
+
+class XPathExtractor(object):
+    """
+    Extracts values of all fields from a page. Container nodes of the fields
+    are located by one pass over the document (matching tags and classes),
+    then each field is selected by a short XPath expression relative to its
+    containers. The expressions are compiled once, when the extractor is
+    created.
+    """
+
+    def __init__(self, fields):
+        """Compiles XPath expressions.
+
+        Args:
+            fields (tuple): tuples of field name, container's tag, substring
+                            of container's class and XPath expression
+                            relative to the container (tag None - relative
+                            to the root node, e.g. for elements found by
+                            id).
+        """
+        self.containers = defaultdict(list)
+        self.fields = []
+        compiled = {}
+        for name, tag, cls, xpath in fields:
+            if tag is not None and cls not in self.containers[tag]:
+                self.containers[tag].append(cls)
+            if xpath not in compiled:
+                compiled[xpath] = etree.XPath(xpath, smart_strings=False)
+            self.fields.append((name, (tag, cls), compiled[xpath]))
+
+    def find_containers(self, root):
+        """Locates container nodes by one pass over the document. Cheaper
+           than XPath's contains() on each node.
+
+        Args:
+            root (lxml.etree._Element): document root.
+
+        Returns:
+            dict: lists of nodes by tag and class substring.
+        """
+        found = defaultdict(list)
+        for node in root.iter(*self.containers):
+            cls = node.get('class')
+            if cls:
+                for substring in self.containers[node.tag]:
+                    if substring in cls:
+                        found[(node.tag, substring)].append(node)
+        return found
+
+    def extract(self, response):
+        """Extracts values of fields from a page.
+
+        Args:
+            response (scrapy.http.TextResponse): page.
+
+        Returns:
+            generator: tuples of field name and list of unicode values.
+        """
+        return self.extract_node(LxmlDocument(response))
+
+    def extract_node(self, root):
+        """Extracts values of fields from a part of a page.
+
+        Args:
+            root (lxml.etree._Element): node containing the containers.
+
+        Returns:
+            generator: tuples of field name and list of unicode values.
+        """
+        containers = self.find_containers(root)
+        containers[(None, None)] = [root]
+        for name, container, xpath in self.fields:
+            values = []
+            for node in containers.get(container, ()):
+                values.extend(value if isinstance(value, unicode)
+                              else unicode(value) for value in xpath(node))
+            yield name, values
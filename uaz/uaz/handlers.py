@@ -8,7 +8,33 @@
 
 """
 
+from scrapy import Selector
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
 from scrapy.http import HtmlResponse
+from scrapy.utils.httpobj import urlparse_cached
+
+from .metrics import timed_deferred
+
+
+def proxy_request(request, slot, **kwargs):
+    """Creates a copy of a request through a proxy of the pool (unless the
+       request has its own proxy).
+
+    Args:
+        request (scrapy.http.Request): request from spider.
+        slot (uaz.proxies.ProxySlot): proxy of the pool.
+
+    Kwargs:
+        attributes of the copy.
+
+    Returns:
+        scrapy.http.Request: request for http client.
+    """
+    if slot.address and 'proxy' not in request.meta:
+        meta = dict(request.meta)
+        meta['proxy'] = 'http://{0}'.format(slot.address)
+        kwargs['meta'] = meta
+    return request.replace(**kwargs) if kwargs else request
 
 
 class SeleniumDownloadHandler(object):
@@ -18,19 +44,227 @@ class SeleniumDownloadHandler(object):
         pass
 
     def download_request(self, request, spider):
-        """Downloads page requested by spider.
+        """Downloads page requested by spider. The page is rendered by one
+           of browsers from the spider's pool in a worker thread.
 
         Args:
             request (scrapy.http.Request): request from spider.
             spider (scrapy.Spider or subclass): spider instance.
 
+        Returns:
+            twisted.internet.defer.Deferred: fires with
+                scrapy.http.HtmlResponse (response with body, received
+                from webserver).
+        """
+        deferred = spider.browsers.render(request.url)
+        deferred.addCallback(self.build_response, request)
+        return timed_deferred(getattr(spider, 'stats', None),
+                              'download/total', deferred)
+
+    def build_response(self, page, request):
+        """Creates response from a rendered page.
+
+        Args:
+            page (tuple): final url and source of the page.
+            request (scrapy.http.Request): request from spider.
+
         Returns:
             scrapy.http.HtmlResponse: response with body, received
                                       from webserver.
         """
-        spider.browser.get(request.url)
+        url, source = page
         return HtmlResponse(
-            spider.browser.current_url,
-            body=spider.browser.page_source.encode(u'utf-8'),
+            url,
+            body=source.encode(u'utf-8'),
             request=request,
         )
+
+
+class ProxyDownloadHandler(object):
+    """
+    Download handler for pages without javascript: pages are downloaded by
+    scrapy's http client through proxies of the spider's pool (see
+    uaz.proxies.ProxyPool), without browser.
+    """
+
+    def __init__(self, settings):
+        """
+        Args:
+            settings (scrapy.settings.Settings): project settings.
+        """
+        self.http = HTTP11DownloadHandler(settings)
+
+    def download_request(self, request, spider):
+        """Downloads page requested by spider through the best proxy.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with
+                scrapy.http.Response (response with body, received
+                from webserver).
+        """
+        return timed_deferred(getattr(spider, 'stats', None),
+                              'download/total',
+                              spider.browsers.fetch(self.download_by, request,
+                                                    spider))
+
+    def download_by(self, slot, request, spider):
+        return self.http.download_request(proxy_request(request, slot),
+                                          spider)
+
+    def close(self):
+        return self.http.close()
+
+
+class HybridDownloadHandler(SeleniumDownloadHandler):
+    """
+    Download handler, which renders pages by browser only when it's needed.
+    A page rendered by a browser of a proxy gives the session of the proxy
+    (cookies and user agent), next pages through this proxy are downloaded
+    by scrapy's http client with this session. The page is rendered by
+    browser again if the response looks like a javascript challenge
+    (HYBRID_CHALLENGE_STATUSES, HYBRID_CHALLENGE_MARKERS) or doesn't contain
+    elements of any group of SELENIUM_WAIT_FOR.
+    """
+
+    def __init__(self, settings):
+        """
+        Args:
+            settings (scrapy.settings.Settings): project settings.
+        """
+        self.http = HTTP11DownloadHandler(settings)
+        self.wait_for = tuple(tuple(group) for group in
+                              settings.get('SELENIUM_WAIT_FOR', ()))
+        self.challenge_statuses = set(
+            int(status) for status in
+            settings.getlist('HYBRID_CHALLENGE_STATUSES'))
+        self.challenge_markers = tuple(
+            marker.encode('utf-8') if isinstance(marker, unicode) else marker
+            for marker in settings.getlist('HYBRID_CHALLENGE_MARKERS'))
+
+    def download_request(self, request, spider):
+        """Downloads page requested by spider through the best proxy of the
+           spider's pool (see uaz.proxies.ProxyPool).
+
+        Args:
+            request (scrapy.http.Request): request from spider.
+            spider (scrapy.Spider or subclass): spider instance.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with
+                scrapy.http.Response (response with body, received
+                from webserver).
+        """
+        return timed_deferred(getattr(spider, 'stats', None),
+                              'download/total',
+                              spider.browsers.fetch(self.download_by, request,
+                                                    spider))
+
+    def download_by(self, slot, request, spider):
+        """Downloads page through a proxy: by http client if there is a
+           session of the proxy's browser, otherwise by browser.
+
+        Args:
+            slot (uaz.proxies.ProxySlot): proxy of the pool.
+            request (scrapy.http.Request): request from spider.
+            spider (scrapy.Spider or subclass): spider instance.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with
+                scrapy.http.Response.
+        """
+        if slot.session is None:
+            return self.render(slot, request, spider)
+        deferred = timed_deferred(
+            getattr(spider, 'stats', None), 'download/http',
+            self.http.download_request(self.http_request(request, slot),
+                                       spider))
+        deferred.addCallback(self.check_response, slot, request, spider)
+        return deferred
+
+    def render(self, slot, request, spider):
+        """Renders page by a browser of the proxy and keeps the browser's
+           session."""
+        deferred = slot.browsers.render(request.url, session=True)
+        deferred.addCallback(self.keep_session, slot)
+        deferred.addCallback(self.build_response, request)
+        self.inc_stat(spider, 'hybrid/browser_pages')
+        return deferred
+
+    def keep_session(self, page, slot):
+        url, source, slot.session = page
+        return url, source
+
+    def http_request(self, request, slot):
+        """Creates a copy of the request with the session of the proxy's
+           browser.
+
+        Args:
+            request (scrapy.http.Request): request from spider.
+            slot (uaz.proxies.ProxySlot): proxy of the pool.
+
+        Returns:
+            scrapy.http.Request: request for http client.
+        """
+        host = urlparse_cached(request).hostname or ''
+        cookies = [u'{0}={1}'.format(cookie['name'], cookie['value'])
+                   .encode('utf-8') for cookie in slot.session['cookies']
+                   if ('.' + host).endswith(
+                       '.' + (cookie.get('domain') or host).lstrip('.'))]
+        headers = request.headers.copy()
+        if slot.session.get('user_agent'):
+            headers['User-Agent'] = slot.session['user_agent']
+        if cookies:
+            # cookies of scrapy's cookie jar (from http responses) go after
+            # the browser's ones
+            headers['Cookie'] = '; '.join(cookies + headers.getlist('Cookie'))
+        return proxy_request(request, slot, headers=headers)
+
+    def check_response(self, response, slot, request, spider):
+        """Renders the page by browser if the response can't be used.
+
+        Returns:
+            scrapy.http.Response: the response.
+            twisted.internet.defer.Deferred: fires with response of browser.
+        """
+        reason = self.fallback_reason(response)
+        if reason is None:
+            self.inc_stat(spider, 'hybrid/http_pages')
+            return response
+        self.inc_stat(spider, 'hybrid/browser_fallbacks')
+        self.inc_stat(spider, 'hybrid/browser_fallbacks/{0}'.format(reason))
+        slot.session = None
+        return self.render(slot, request, spider)
+
+    def fallback_reason(self, response):
+        """Checks whether a response of http client can be used.
+
+        Args:
+            response (scrapy.http.Response): response of http client.
+
+        Returns:
+            str: why the page should be rendered by browser ("challenge" or
+                 "markup").
+            None: if the response is fine.
+        """
+        if response.status in self.challenge_statuses:
+            return 'challenge'
+        if response.status != 200 or not isinstance(response, HtmlResponse):
+            return None
+        if any(marker in response.body for marker in self.challenge_markers):
+            return 'challenge'
+        if self.wait_for:
+            # the parsed document is cached for the response and reused by
+            # spider
+            selector = Selector(response)
+            if not any(all(selector.css(css) for css in group)
+                       for group in self.wait_for):
+                return 'markup'
+        return None
+
+    def inc_stat(self, spider, key):
+        stats = getattr(spider, 'stats', None)
+        if stats is not None:
+            stats.inc_value(key)
+
+    def close(self):
+        return self.http.close()
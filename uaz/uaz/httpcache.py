@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: httpcache
+   :platform: Unix
+   :synopsis: Storage of pages rendered by the browser for scrapy's
+              HttpCacheMiddleware
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import os
+import os.path as op
+import gzip
+import cPickle as pickle
+from hashlib import sha1
+from time import time
+
+from scrapy.http import Headers, HtmlResponse
+from scrapy.utils.project import data_path
+from scrapy.utils.url import canonicalize_url
+
+
+class RenderedPageStorage(object):
+    """
+    Keeps pages rendered by the browser in gzipped files, one file per url.
+    Listing pages and advertisement pages expire after different periods.
+    When the cache grows over HTTPCACHE_MAX_SIZE megabytes, the oldest pages
+    are removed. Requests with "refresh_cache" in meta are never served from
+    the cache, their new pages replace cached ones. Only pages with 200
+    status are kept, and neither challenges (HYBRID_CHALLENGE_MARKERS) nor
+    bans of the proxy (PROXY_BAN_MARKERS).
+    """
+
+    def __init__(self, settings):
+        """Initializes cache directory.
+
+        Args:
+            settings (scrapy.settings.Settings): crawler settings.
+        """
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.listing_expiration = settings.getint(
+            'HTTPCACHE_LISTING_EXPIRATION_SECS', 3600)
+        self.ad_expiration = settings.getint('HTTPCACHE_AD_EXPIRATION_SECS', 0)
+        self.max_size = settings.getint('HTTPCACHE_MAX_SIZE', 0) * 1024 * 1024
+        self.markers = tuple(
+            marker.encode('utf-8') if isinstance(marker, unicode) else marker
+            for marker in settings.getlist('HYBRID_CHALLENGE_MARKERS') +
+            settings.getlist('PROXY_BAN_MARKERS'))
+        self.size = 0
+
+    def open_spider(self, spider):
+        """Calculates size of the cache."""
+        self.size = sum(size for mtime, path, size in self.pages(spider))
+
+    def close_spider(self, spider):
+        pass
+
+    def retrieve_response(self, spider, request):
+        """Searches for a fresh copy of the requested page.
+
+        Args:
+            spider (uaz.spiders.IrrSpider): spider instance.
+            request (scrapy.http.Request): request from spider.
+
+        Returns:
+            scrapy.http.HtmlResponse: cached page.
+            None: if the page isn't cached, is expired or should be
+                  refreshed.
+        """
+        if request.meta.get('refresh_cache'):
+            return None
+        path = self.page_path(spider, request.url)
+        try:
+            age = time() - op.getmtime(path)
+        except OSError:
+            return None
+        expiration = self.expiration(spider, request.url)
+        if expiration and age > expiration:
+            return None
+        with gzip.open(path, 'rb') as page:
+            data = pickle.load(page)
+        return HtmlResponse(data['url'], status=data.get('status', 200),
+                            headers=Headers(data.get('headers', {})),
+                            body=data['body'], request=request)
+
+    def store_response(self, spider, request, response):
+        """Keeps a rendered page (unless it's an error, a challenge or a ban
+           page), removes the oldest pages if the cache is too big.
+
+        Args:
+            spider (uaz.spiders.IrrSpider): spider instance.
+            request (scrapy.http.Request): request from spider.
+            response (scrapy.http.HtmlResponse): rendered page.
+        """
+        if response.status != 200 or any(marker in response.body
+                                         for marker in self.markers):
+            return
+        path = self.page_path(spider, request.url)
+        if not op.exists(op.dirname(path)):
+            os.makedirs(op.dirname(path))
+        try:
+            self.size -= op.getsize(path)
+        except OSError:
+            pass
+        with gzip.open(path + '.tmp', 'wb') as page:
+            pickle.dump({
+                'url': response.url,
+                'request_url': request.url,
+                'status': response.status,
+                'headers': dict(response.headers),
+                'body': response.body,
+            }, page, protocol=2)
+        os.rename(path + '.tmp', path)
+        self.size += op.getsize(path)
+        if self.max_size and self.size > self.max_size:
+            self.evict(spider)
+
+    def expiration(self, spider, url):
+        """Returns lifetime of a page in seconds (0 - never expires)."""
+        if getattr(spider, 'foreign_id_from_url', lambda url: None)(url):
+            return self.ad_expiration
+        return self.listing_expiration
+
+    def evict(self, spider):
+        """Removes the oldest pages until the cache takes 90% of max size."""
+        for mtime, path, size in sorted(self.pages(spider)):
+            if self.size <= self.max_size * 0.9:
+                break
+            os.remove(path)
+            self.size -= size
+
+    def page_path(self, spider, url):
+        key = sha1(canonicalize_url(url)).hexdigest()
+        return op.join(self.cachedir, spider.name, key[:2], key + '.gz')
+
+    def pages(self, spider):
+        """Lists cached pages of a spider.
+
+        Args:
+            spider (uaz.spiders.IrrSpider): spider instance.
+
+        Returns:
+            generator: tuples of modification time, path and size of a file.
+        """
+        for root, dirs, files in os.walk(op.join(self.cachedir, spider.name)):
+            for filename in files:
+                if filename.endswith('.gz'):
+                    path = op.join(root, filename)
+                    stat = os.stat(path)
+                    yield stat.st_mtime, path, stat.st_size
@@ -44,3 +44,17 @@ class Advertisement(Item):
     body_type = Field()
     horsepower = Field()
     fuel = Field()
+
+
+class AdvertisementSummary(Item):
+    """
+    Spider keeps data shown for an advertisement on a listing page in
+    instance of this class. It's used to track changes of stored
+    advertisements without rendering of their pages.
+    """
+    source = Field()
+    foreign_id = Field()
+    url = Field()
+    title = Field()
+    price = Field()
+    published = Field()
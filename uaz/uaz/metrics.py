@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: metrics
+   :platform: Unix
+   :synopsis: Latency histograms of crawling stages in crawler's stats and
+              their export in Prometheus text format
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import os
+import re
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from timeit import default_timer
+
+from twisted.internet import task
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+
+# upper bounds of histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+_stats_lock = Lock()
+
+
+class Histogram(object):
+    """
+    Counts observed latencies by buckets. Observations may come from
+    worker threads.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Kwargs:
+            buckets (tuple): sorted upper bounds of buckets in seconds (the
+                             last bucket is unbounded).
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def percentile(self, percent):
+        """Returns upper bound of the bucket with the percentile (None for
+           the unbounded bucket or if nothing is observed)."""
+        with self.lock:
+            rank, cumulative = self.count * percent / 100.0, 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                if cumulative and cumulative >= rank:
+                    return bound
+        return None
+
+    def cumulative(self):
+        """Returns pairs of bucket's upper bound ('+Inf' for the last one)
+           and number of observations not greater than it."""
+        with self.lock:
+            result, cumulative = [], 0
+            for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+                cumulative += count
+                result.append((bound, cumulative))
+            return result
+
+    def __repr__(self):
+        return '<Histogram count={0} mean={1:.4f}s p50<={2}s p99<={3}s>' \
+            .format(self.count, self.sum / self.count if self.count else 0,
+                    self.percentile(50), self.percentile(99))
+
+
+def observe(stats, stage, seconds):
+    """Adds a latency to the histogram of a stage ("latency/<stage>" key of
+       stats).
+
+    Args:
+        stats (scrapy.statscol.StatsCollector): crawler stats (nothing is
+                                                recorded if None).
+        stage (str): stage name.
+        seconds (float): latency.
+    """
+    if stats is None:
+        return
+    key = 'latency/{0}'.format(stage)
+    with _stats_lock:
+        histogram = stats.get_value(key)
+        if histogram is None:
+            histogram = Histogram()
+            stats.set_value(key, histogram)
+    histogram.observe(seconds)
+
+
+@contextmanager
+def timed(stats, stage):
+    """Records latency of the block into the histogram of a stage."""
+    start = default_timer()
+    try:
+        yield
+    finally:
+        observe(stats, stage, default_timer() - start)
+
+
+def timed_deferred(stats, stage, deferred):
+    """Records time until the deferred fires into the histogram of a stage.
+
+    Returns:
+        twisted.internet.defer.Deferred: the same deferred.
+    """
+    if stats is not None:
+        start = default_timer()
+
+        def fired(result):
+            observe(stats, stage, default_timer() - start)
+            return result
+        deferred.addBoth(fired)
+    return deferred
+
+
+def prometheus_text(stats, prefix='uaz'):
+    """Formats stats in Prometheus text exposition format. Histograms are
+       exported as "<prefix>_latency_seconds" with "stage" label, numeric
+       stats as "<prefix>_stat" with "name" label.
+
+    Args:
+        stats (dict): values of crawler stats.
+
+    Kwargs:
+        prefix (str): prefix of metric names.
+
+    Returns:
+        str: metrics.
+    """
+    def label(value):
+        return re.sub(r'(["\\])', r'\\\1', value).replace('\n', r'\n')
+
+    latency, numeric = [], []
+    for key, value in sorted(stats.iteritems()):
+        if isinstance(value, Histogram):
+            stage = label(key.split('/', 1)[-1])
+            for bound, count in value.cumulative():
+                latency.append('{0}_latency_seconds_bucket{{stage="{1}",'
+                               'le="{2}"}} {3}'.format(prefix, stage, bound,
+                                                       count))
+            latency.append('{0}_latency_seconds_sum{{stage="{1}"}} {2!r}'
+                           .format(prefix, stage, value.sum))
+            latency.append('{0}_latency_seconds_count{{stage="{1}"}} {2}'
+                           .format(prefix, stage, value.count))
+        elif isinstance(value, (int, long, float)) \
+                and not isinstance(value, bool):
+            numeric.append('{0}_stat{{name="{1}"}} {2!r}'.format(
+                prefix, label(key), value))
+    lines = []
+    if latency:
+        lines.append('# TYPE {0}_latency_seconds histogram'.format(prefix))
+        lines.extend(latency)
+    if numeric:
+        lines.append('# TYPE {0}_stat gauge'.format(prefix))
+        lines.extend(numeric)
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusExporter(object):
+    """
+    Extension writing crawler stats (with latency histograms) into
+    METRICS_PROMETHEUS_FILE in Prometheus text format (e.g. for textfile
+    collector of node_exporter): every METRICS_EXPORT_INTERVAL seconds and
+    when the spider is closed.
+    """
+
+    def __init__(self, stats, filename, interval=0):
+        """
+        Args:
+            stats (scrapy.statscol.StatsCollector): crawler stats.
+            filename (str): path of metrics file.
+
+        Kwargs:
+            interval (float): seconds between exports (0 - only when the
+                              spider is closed).
+        """
+        self.stats = stats
+        self.filename = filename
+        self.interval = interval
+        self.exporter = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        filename = crawler.settings.get('METRICS_PROMETHEUS_FILE')
+        if not filename:
+            raise NotConfigured
+        extension = cls(crawler.stats, filename, crawler.settings.getfloat(
+            'METRICS_EXPORT_INTERVAL', 0))
+        crawler.signals.connect(extension.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed,
+                                signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        if self.interval > 0:
+            self.exporter = task.LoopingCall(self.export)
+            self.exporter.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.exporter is not None and self.exporter.running:
+            self.exporter.stop()
+        self.export()
+
+    def export(self):
+        """Writes the metrics file (atomically, readers never see a part)."""
+        with open(self.filename + '.tmp', 'w') as metrics:
+            metrics.write(prometheus_text(self.stats.get_stats()))
+        os.rename(self.filename + '.tmp', self.filename)
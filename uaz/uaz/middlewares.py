@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: middlewares
+   :platform: Unix
+   :synopsis: Custom downloader and spider middlewares definition
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import math
+import struct
+from datetime import datetime
+from hashlib import md5
+
+from sqlalchemy.orm import sessionmaker
+
+from scrapy import signals
+from scrapy.http import Request
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+
+from .items import AdvertisementSummary
+from .models import db_connect, unique_index, InsertOnConflict
+from .models import Advertisement, Source, CrawlMark
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set of advertisement ids. Takes a few bits per id instead
+    of a full python object, but reports a small share of unknown ids as
+    known ones.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """Allocates bit array for specified number of ids.
+
+        Args:
+            capacity (int): expected number of ids.
+
+        Kwargs:
+            error_rate (float): acceptable share of false positives.
+        """
+        self.bits = max(int(-capacity * math.log(error_rate)
+                            / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.bits * math.log(2) / capacity)), 1)
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        """Calculates bit positions of a value (double hashing).
+
+        Args:
+            value (int or unicode or str): id.
+
+        Returns:
+            generator: bit numbers.
+        """
+        first, second = struct.unpack('<QQ', md5(str(value)).digest())
+        return ((first + num * second) % self.bits
+                for num in xrange(self.hashes))
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.array[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(value))
+
+    def __len__(self):
+        return self.count
+
+
+def summary_key(foreign_id, price, published):
+    """Returns a key of advertisement's data shown on listing pages.
+
+    Args:
+        foreign_id (int): advertisement id.
+        price (float): price (None if unknown).
+        published (datetime.datetime): publication date (None if unknown).
+
+    Returns:
+        str: the key.
+    """
+    return '{0}:{1!r}:{2}'.format(
+        foreign_id, None if price is None else float(price),
+        published.date().isoformat() if published else None)
+
+
+class KnownAdvertisementMiddleware(object):
+    """
+    Drops requests of advertisements stored in the database previously, so
+    the browser doesn't render pages, which UazDBPipeline would drop anyway.
+    With TRACK_CHANGES a stored advertisement is rendered again if its
+    summary from a listing page (price and publication date in request's
+    meta) differs from the stored data (its cached page is rendered again
+    too, see uaz.httpcache.RenderedPageStorage).
+    """
+
+    def __init__(self, settings, stats):
+        """Initializes storage of known advertisement ids.
+
+        Args:
+            settings (scrapy.settings.Settings): crawler settings.
+            stats (scrapy.statscol.StatsCollector): crawler stats.
+
+        Raises:
+            NotConfigured: if KNOWN_ADS_ENABLED is off.
+        """
+        if not settings.getbool('KNOWN_ADS_ENABLED', True):
+            raise NotConfigured
+        self.stats = stats
+        self.database = settings.get('DATABASE')
+        self.track_changes = settings.getbool('TRACK_CHANGES', False)
+        if settings.getbool('KNOWN_ADS_BLOOM_FILTER'):
+            capacity = settings.getint('KNOWN_ADS_BLOOM_CAPACITY', 1000000)
+            error_rate = settings.getfloat('KNOWN_ADS_BLOOM_ERROR_RATE', 0.001)
+            self.known = BloomFilter(capacity, error_rate)
+            self.summaries = BloomFilter(capacity, error_rate)
+        else:
+            self.known, self.summaries = set(), set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(middleware.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(middleware.item_scraped,
+                                signal=signals.item_scraped)
+        return middleware
+
+    def spider_opened(self, spider):
+        """Loads ids of advertisements stored in the database.
+
+        Args:
+            spider (uaz.spiders.IrrSpider): spider instance.
+        """
+        session = sessionmaker(bind=db_connect(self.database))()
+        query = session.query(
+            Advertisement.foreign_id, Advertisement.price,
+            Advertisement.published,
+        ).join(Source).filter(
+            Source.name == spider.source,
+            Advertisement.foreign_id.isnot(None),
+        )
+        for foreign_id, price, published in query.yield_per(10000):
+            self.known.add(foreign_id)
+            if self.track_changes:
+                self.summaries.add(summary_key(foreign_id, price, published))
+        session.close()
+        self.stats.set_value('known_ads/preloaded', len(self.known),
+                             spider=spider)
+
+    def item_scraped(self, item, spider):
+        """Remembers id of an advertisement stored during this crawl."""
+        if item.get('foreign_id') \
+                and not isinstance(item, AdvertisementSummary):
+            self.known.add(item.get('foreign_id'))
+            if self.track_changes:
+                self.summaries.add(summary_key(
+                    item.get('foreign_id'), item.get('price'),
+                    item.get('published')))
+
+    def process_request(self, request, spider):
+        """Drops a request if it leads to a known advertisement.
+
+        Args:
+            request (scrapy.http.Request): request from spider.
+            spider (uaz.spiders.IrrSpider): spider instance.
+
+        Raises:
+            IgnoreRequest: if the advertisement exists in the database (and
+                           its summary hasn't changed).
+        """
+        foreign_id = request.meta.get('foreign_id')
+        if foreign_id is None and hasattr(spider, 'foreign_id_from_url'):
+            foreign_id = spider.foreign_id_from_url(request.url)
+        if foreign_id is not None and foreign_id in self.known:
+            summary = request.meta.get('summary')
+            if self.track_changes and summary is not None \
+                    and summary_key(foreign_id, *summary) \
+                    not in self.summaries:
+                self.stats.inc_value('known_ads/changed', spider=spider)
+                # the cached page has the old data
+                request.meta['refresh_cache'] = True
+                return None
+            self.stats.inc_value('known_ads/skipped', spider=spider)
+            raise IgnoreRequest(u'Advertisement has been scraped previously: '
+                                u'{0}'.format(request.url))
+
+
+class IncrementalCrawlMiddleware(object):
+    """
+    Stops following pagination of a listing when a page of the listing
+    contains only advertisements not newer than the newest one seen during
+    the previous complete crawl of this listing (high-water mark).
+    Advertisement ids on irr.ru grow, so the highest id is the newest ad.
+    """
+
+    def __init__(self, settings, stats):
+        """Initializes storage of high-water marks.
+
+        Args:
+            settings (scrapy.settings.Settings): crawler settings.
+            stats (scrapy.statscol.StatsCollector): crawler stats.
+
+        Raises:
+            NotConfigured: if INCREMENTAL_CRAWL is off.
+        """
+        if not settings.getbool('INCREMENTAL_CRAWL'):
+            raise NotConfigured
+        self.stats = stats
+        self.database = settings.get('DATABASE')
+        self.marks = {}
+        self.seen = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(middleware.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed,
+                                signal=signals.spider_closed)
+        return middleware
+
+    def spider_opened(self, spider):
+        """Loads high-water marks of the previous crawl. Ids seen by the
+           crawl are kept in the spider state, so a crawl resumed from JOBDIR
+           continues with ids seen before it was stopped.
+
+        Args:
+            spider (uaz.spiders.IrrSpider): spider instance.
+        """
+        session = sessionmaker(bind=db_connect(self.database))()
+        self.marks = dict(session.query(CrawlMark.start_url,
+                                        CrawlMark.foreign_id))
+        session.close()
+        state = getattr(spider, 'state', None)
+        if isinstance(state, dict):
+            self.seen = state.setdefault('incremental_seen', {})
+
+    def spider_closed(self, spider, reason):
+        """Stores new high-water marks. Marks are kept only after a complete
+           crawl, otherwise ads below the new mark might be never scraped.
+
+        Args:
+            spider (uaz.spiders.IrrSpider): spider instance.
+            reason (str): the reason why the spider was closed.
+        """
+        if reason != 'finished' or not self.seen:
+            return
+        now = datetime.now()
+        with db_connect(self.database).begin() as connection:
+            connection.execute(InsertOnConflict(
+                CrawlMark.__table__, unique_index(CrawlMark), update={
+                    'foreign_id': u'greatest({0}.foreign_id, '
+                                  u'EXCLUDED.foreign_id)'.format(
+                                      CrawlMark.__tablename__),
+                    'updated': u'EXCLUDED.updated',
+                }).values([
+                    {'start_url': start_url, 'foreign_id': foreign_id,
+                     'updated': now}
+                    for start_url, foreign_id in self.seen.iteritems()]))
+
+    def process_start_requests(self, start_requests, spider):
+        """Marks start requests as listing roots."""
+        for request in start_requests:
+            request.meta.setdefault('start_url', request.url)
+            yield request
+
+    def process_spider_output(self, response, result, spider):
+        """Drops pagination requests of a listing page if all advertisements
+           on it are older than the high-water mark of the listing.
+
+        Args:
+            response (scrapy.http.Response): listing or advertisement page.
+            result (iterable): requests and items from the spider.
+            spider (uaz.spiders.IrrSpider): spider instance.
+
+        Returns:
+            list: requests and items to pass further.
+        """
+        start_url = response.meta.get('start_url')
+        if start_url is None:
+            return result
+        result = list(result)
+        ids = []
+        for entry in result:
+            if isinstance(entry, Request):
+                entry.meta.setdefault('start_url', start_url)
+                foreign_id = spider.foreign_id_from_url(entry.url)
+                if foreign_id is not None:
+                    ids.append(foreign_id)
+        if self.marks.get(start_url) is not None:
+            # only a few first pages of a listing are needed when it was
+            # crawled previously: pages requested at once (with the page
+            # number) are dropped, the pagination is followed page by page
+            # and can be stopped
+            kept = [entry for entry in result if not isinstance(entry, Request)
+                    or 'page' not in entry.meta]
+            if len(kept) < len(result):
+                self.stats.inc_value('incremental/fanout_dropped',
+                                     len(result) - len(kept), spider=spider)
+                result = kept
+        if not ids:
+            return result
+        self.seen[start_url] = max(self.seen.get(start_url, 0), max(ids))
+        mark = self.marks.get(start_url)
+        if mark is None or max(ids) > mark:
+            return result
+        self.stats.inc_value('incremental/pagination_stopped', spider=spider)
+        return [entry for entry in result if not isinstance(entry, Request)
+                or spider.foreign_id_from_url(entry.url) is not None]
@@ -8,11 +8,15 @@
 
 """
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text, func
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.engine.url import URL
 from sqlalchemy import Column, String, Integer, Text, ForeignKey, DateTime, Float
+from sqlalchemy import LargeBinary
+from sqlalchemy import Index
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.expression import Insert, ColumnClause
 from sqlalchemy.dialects import postgresql
 
 from scrapy.utils.project import get_project_settings
@@ -21,18 +25,23 @@ from scrapy.utils.project import get_project_settings
 DeclarativeBase = declarative_base()
 
 
-def db_connect():
+def db_connect(database=None):
     """Creates configured database engine instance.
 
+    Kwargs:
+        database (dict): connection parameters (DATABASE setting if None).
+
     Returns:
         sqlalchemy.engine.Engine
     """
-    settings = get_project_settings()
-    return create_engine(URL(**settings.get('DATABASE', {})))
+    if database is None:
+        database = get_project_settings().get('DATABASE', {})
+    return create_engine(URL(**database))
 
 
 def create_tables(engine):
     """Creates tables, indexes, relationships, sequences, etc in database.
+    Tables created by previous versions aren't changed (see migrate).
 
     Args:
         engine (sqlalchemy.engine.Engine): configured database engine instance.
@@ -40,6 +49,163 @@ def create_tables(engine):
     DeclarativeBase.metadata.create_all(engine)
 
 
+def migrate(engine):
+    """Upgrades the database created by previous versions: creates missing
+       tables, columns and indexes (see "scrapy migrate" command). Must not
+       run while crawlers write to the database.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): configured database engine instance.
+
+    Returns:
+        list: names of added columns (table.column) and indexes.
+    """
+    create_tables(engine)
+    return create_columns(engine) + create_indexes(engine)
+
+
+def create_columns(engine):
+    """Adds columns missing in tables created by previous versions (new
+       columns are nullable).
+
+    Args:
+        engine (sqlalchemy.engine.Engine): configured database engine instance.
+
+    Returns:
+        list: names of added columns (table.column).
+    """
+    added = []
+    for table in DeclarativeBase.metadata.sorted_tables:
+        existing = set(name for name, in engine.execute(text(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = :table"
+        ), table=table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute(text(u"ALTER TABLE {0} ADD COLUMN {1} {2}"
+                                    .format(table.name, column.name,
+                                            column.type.compile(
+                                                dialect=engine.dialect))))
+                added.append(u'{0}.{1}'.format(table.name, column.name))
+    return added
+
+
+def create_indexes(engine):
+    """Creates indexes missing in tables created by previous versions. Before
+       a unique index is created, duplicate records are merged.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): configured database engine instance.
+
+    Returns:
+        list: names of added indexes.
+    """
+    added = []
+    for table in DeclarativeBase.metadata.sorted_tables:
+        for index in table.indexes:
+            if engine.execute(text(
+                "SELECT 1 FROM pg_indexes WHERE indexname = :name"
+            ), name=index.name).scalar():
+                continue
+            with engine.begin() as connection:
+                if index.unique:
+                    merge_duplicates(connection, index)
+                index.create(connection)
+            added.append(index.name)
+    return added
+
+
+def merge_duplicates(connection, index):
+    """Leaves one record (the oldest one) of every group of records, which
+       violate a unique index. References to removed records are redirected
+       to the remaining one.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): database connection.
+        index (sqlalchemy.Index): unique index.
+    """
+    table = index.table
+    compiler = connection.dialect.statement_compiler(connection.dialect, None)
+    expressions = index_expressions(index, compiler)
+    duplicates = (
+        u"WITH ranked AS (SELECT id, min(id) OVER (PARTITION BY {0}) AS keep "
+        u"FROM {1} WHERE ({0}) IS NOT NULL) ".format(expressions, table.name)
+    )
+    for referrer in DeclarativeBase.metadata.sorted_tables:
+        for foreign_key in referrer.foreign_keys:
+            if foreign_key.column.table is table:
+                connection.execute(text(duplicates + (
+                    u"UPDATE {0} SET {1} = ranked.keep FROM ranked "
+                    u"WHERE {0}.{1} = ranked.id AND ranked.id <> ranked.keep"
+                ).format(referrer.name, foreign_key.parent.name)))
+    connection.execute(text(duplicates + (
+        u"DELETE FROM {0} WHERE id IN "
+        u"(SELECT id FROM ranked WHERE id <> keep)").format(table.name)))
+
+
+def index_expressions(index, compiler):
+    """Renders columns and expressions of an index.
+
+    Args:
+        index (sqlalchemy.Index): index.
+        compiler (sqlalchemy.sql.compiler.SQLCompiler): statement compiler.
+
+    Returns:
+        unicode: comma separated expressions.
+    """
+    return u', '.join(compiler.process(
+        expr if isinstance(expr, ColumnClause) else expr.self_group(),
+        include_table=False, literal_binds=True,
+    ) for expr in index.expressions)
+
+
+def unique_index(cls):
+    """Returns unique index used to detect duplicate records of a model.
+
+    Args:
+        cls (one of uaz.models.* classes): model.
+
+    Returns:
+        sqlalchemy.Index: unique index of the model's table.
+    """
+    return next(index for index in cls.__table__.indexes if index.unique)
+
+
+class InsertOnConflict(Insert):
+    """
+    INSERT ... ON CONFLICT statement (PostgreSQL 9.5+). Records conflicting
+    with a unique index are skipped or, if update is True, "updated" with the
+    same value, so RETURNING gives ids of existing records too. If update is
+    a dict, existing records are updated by its SQL expressions (by column
+    names, EXCLUDED is the new record).
+    """
+
+    def __init__(self, table, index, update=False, **kwargs):
+        super(InsertOnConflict, self).__init__(table, **kwargs)
+        self.index = index
+        self.update = update
+
+
+@compiles(InsertOnConflict, 'postgresql')
+def compile_insert_on_conflict(insert, compiler, **kwargs):
+    statement = compiler.visit_insert(insert, **kwargs)
+    if isinstance(insert.update, dict):
+        action = u'DO UPDATE SET {0}'.format(u', '.join(
+            u'{0} = {1}'.format(compiler.preparer.quote(name), expression)
+            for name, expression in sorted(insert.update.iteritems())))
+    elif insert.update:
+        column = compiler.preparer.quote(list(insert.index.columns)[0].name)
+        action = u'DO UPDATE SET {0} = EXCLUDED.{0}'.format(column)
+    else:
+        action = u'DO NOTHING'
+    clause = u' ON CONFLICT ({0}) {1}'.format(
+        index_expressions(insert.index, compiler), action)
+    returning = statement.find(u' RETURNING ')
+    if returning == -1:
+        return statement + clause
+    return statement[:returning] + clause + statement[returning:]
+
+
 class Advertisement(DeclarativeBase):
     __tablename__ = "advertisement"
 
@@ -71,13 +237,19 @@ class Advertisement(DeclarativeBase):
     tech_condition_id = Column(Integer, ForeignKey("tech_condition.id"))
     bodytype_id = Column(Integer, ForeignKey("bodytype.id"))
     fuel_id = Column(Integer, ForeignKey("fuel.id"))
+    last_seen = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('advertisement_foreign_id_source_id_key', 'foreign_id',
+              'source_id', unique=True),
+    )
 
 
 class Source(DeclarativeBase):
     __tablename__ = "source"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(32))
+    name = Column(String(32), unique=True, index=True)
     description = Column(Text, nullable=True)
     ads = relationship("Advertisement", backref="source")
 
@@ -92,11 +264,15 @@ class Seller(DeclarativeBase):
     ads = relationship("Advertisement", backref="seller")
 
 
+Index('seller_name_url_key', Seller.name, func.coalesce(Seller.url, u''),
+      unique=True)
+
+
 class AdType(DeclarativeBase):
     __tablename__ = "adtype"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(64))
+    name = Column(String(64), unique=True, index=True)
     description = Column(Text, nullable=True)
     ads = relationship("Advertisement", backref="ad_type")
 
@@ -105,7 +281,7 @@ class Currency(DeclarativeBase):
     __tablename__ = "currency"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(32), nullable=True)
+    name = Column(String(32), nullable=True, unique=True, index=True)
     code = Column(String(8), nullable=True)
     ads = relationship("Advertisement", backref="currency")
 
@@ -114,7 +290,7 @@ class Region(DeclarativeBase):
     __tablename__ = "region"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(32))
+    name = Column(String(32), unique=True, index=True)
     ads = relationship("Advertisement", backref="region")
 
 
@@ -122,7 +298,7 @@ class Manufacturer(DeclarativeBase):
     __tablename__ = "manufacturer"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(32))
+    name = Column(String(32), unique=True, index=True)
     description = Column(String, nullable=True)
     ads = relationship("Advertisement", backref="manufacturer")
 
@@ -131,7 +307,7 @@ class Model(DeclarativeBase):
     __tablename__ = "model"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(64))
+    name = Column(String(64), unique=True, index=True)
     description = Column(String, nullable=True)
     ads = relationship("Advertisement", backref="model")
 
@@ -140,7 +316,7 @@ class Modification(DeclarativeBase):
     __tablename__ = "modification"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(64))
+    name = Column(String(64), unique=True, index=True)
     description = Column(String, nullable=True)
     ads = relationship("Advertisement", backref="modification")
 
@@ -149,7 +325,7 @@ class Gear(DeclarativeBase):
     __tablename__ = "gear"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(32))
+    name = Column(String(32), unique=True, index=True)
     ads = relationship("Advertisement", backref="gear")
 
 
@@ -157,7 +333,7 @@ class MileageUnits(DeclarativeBase):
     __tablename__ = "mileage_units"
 
     id = Column(Integer, primary_key=True)
-    code = Column(String(8))
+    code = Column(String(8), unique=True, index=True)
     name = Column(String(16), nullable=True)
     ads = relationship("Advertisement", backref="mileage_units")
 
@@ -166,7 +342,7 @@ class VolumeUnits(DeclarativeBase):
     __tablename__ = "volume_units"
 
     id = Column(Integer, primary_key=True)
-    code = Column(String(8))
+    code = Column(String(8), unique=True, index=True)
     name = Column(String(16), nullable=True)
     ads = relationship("Advertisement", backref="volume_units")
 
@@ -175,7 +351,7 @@ class Transmission(DeclarativeBase):
     __tablename__ = "transmission"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(32))
+    name = Column(String(32), unique=True, index=True)
     ads = relationship("Advertisement", backref="transmission")
 
 
@@ -183,7 +359,7 @@ class TechCondition(DeclarativeBase):
     __tablename__ = "tech_condition"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(32))
+    name = Column(String(32), unique=True, index=True)
     ads = relationship("Advertisement", backref="tech_condition")
 
 
@@ -191,7 +367,7 @@ class BodyType(DeclarativeBase):
     __tablename__ = "bodytype"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(32))
+    name = Column(String(32), unique=True, index=True)
     ads = relationship("Advertisement", backref="body_type")
 
 
@@ -199,5 +375,54 @@ class Fuel(DeclarativeBase):
     __tablename__ = "fuel"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(32))
+    name = Column(String(32), unique=True, index=True)
     ads = relationship("Advertisement", backref="fuel")
+
+
+class CrawlMark(DeclarativeBase):
+    __tablename__ = "crawl_mark"
+
+    id = Column(Integer, primary_key=True)
+    start_url = Column(String)
+    foreign_id = Column(Integer)
+    updated = Column(DateTime)
+
+    __table_args__ = (
+        Index('crawl_mark_start_url_key', 'start_url', unique=True),
+    )
+
+
+class PriceChange(DeclarativeBase):
+    __tablename__ = "price_change"
+
+    id = Column(Integer, primary_key=True)
+    advertisement_id = Column(Integer, ForeignKey("advertisement.id"),
+                              index=True)
+    old_price = Column(Float, nullable=True)
+    new_price = Column(Float, nullable=True)
+    changed = Column(DateTime)
+    advertisement = relationship("Advertisement", backref="price_changes")
+
+
+class FrontierRequest(DeclarativeBase):
+    """Request of the frontier shared by workers of a sharded crawl (see
+       uaz.scheduler.FrontierScheduler)."""
+    __tablename__ = "crawl_frontier"
+
+    id = Column(Integer, primary_key=True)
+    job = Column(String(64))
+    fingerprint = Column(String(40))
+    url = Column(String)
+    request = Column(LargeBinary)  # pickled dict of the request
+    priority = Column(Integer)
+    attempts = Column(Integer)  # number of claims
+    worker = Column(String(128))  # the worker, which claimed the request
+    leased_until = Column(DateTime, nullable=True)  # UTC
+    done = Column(DateTime, nullable=True)  # UTC
+
+    __table_args__ = (
+        Index('crawl_frontier_job_fingerprint_key', 'job', 'fingerprint',
+              unique=True),
+        Index('crawl_frontier_pending_idx', 'job', 'priority',
+              postgresql_where=done.is_(None)),
+    )
@@ -8,39 +8,225 @@
 
 """
 
+from collections import OrderedDict
 from datetime import datetime
+from threading import RLock, local
+from timeit import default_timer
 
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import exists
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import sessionmaker, class_mapper
+
+from twisted.internet import reactor, task, threads
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
 from scrapy.exceptions import DropItem
 from scrapy.utils.project import get_project_settings
 
 import xlwt
 
-from .models import create_tables, db_connect
+from .items import AdvertisementSummary
+from .metrics import observe, timed, timed_deferred
+from .models import create_tables, db_connect, unique_index, InsertOnConflict
 from .models import Advertisement, Source, Seller, AdType, Currency, Region
 from .models import Manufacturer, Model, Modification, Gear, MileageUnits
 from .models import VolumeUnits, Transmission, TechCondition, BodyType, Fuel
+from .models import PriceChange
+
+
+class ReferenceCache(object):
+    """
+    Keeps ids of reference tables records in memory, so reference values are
+    resolved without database queries. Sellers are too many to keep all of
+    them, so only recently used sellers are kept. The cache may be shared by
+    several writing threads: records created in a transaction are seen only
+    by the thread of the transaction until it's committed.
+    """
+
+    def __init__(self, seller_cache_size=10000):
+        """Initializes empty cache.
+
+        Kwargs:
+            seller_cache_size (int): max number of kept sellers.
+        """
+        self.seller_cache_size = seller_cache_size
+        self.records = {Seller: OrderedDict()}
+        self.transaction = local()  # records created by the thread
+        self.hits = 0
+        self.misses = 0
+        self.lock = RLock()
+
+    @staticmethod
+    def key(**fields):
+        return tuple(sorted(fields.iteritems()))
+
+    def preload(self, session, cls, *fieldnames):
+        """Loads all records of a reference table.
+
+        Args:
+            session (sqlalchemy.orm.Session): DB session instance.
+            cls (one of uaz.models.* classes): reference table.
+            fieldnames (list): names of fields used to seek for records.
+        """
+        loaded = dict((self.key(**dict(
+            (field, getattr(record, field)) for field in fieldnames)
+        ), record.id) for record in session.query(cls))
+        with self.lock:
+            self.records.setdefault(cls, {}).update(loaded)
+
+    def get(self, cls, key):
+        """Searches for an id of reference record.
+
+        Args:
+            cls (one of uaz.models.* classes): reference table.
+            key (tuple): search conditions.
+
+        Returns:
+            int: id of the record.
+            None: if the record isn't cached.
+        """
+        record_id = self.created.get((cls, key))
+        if record_id is not None:
+            with self.lock:
+                self.hits += 1
+            return record_id
+        with self.lock:
+            records = self.records.get(cls, {})
+            record_id = records.get(key)
+            if record_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if cls is Seller:
+                    records[key] = records.pop(key)
+        return record_id
+
+    def add(self, cls, key, record_id, created=False):
+        """Keeps an id of reference record.
+
+        Args:
+            cls (one of uaz.models.* classes): reference table.
+            key (tuple): search conditions.
+            record_id (int): id of the record.
+
+        Kwargs:
+            created (boolean): record is created in uncommitted transaction
+                               of the thread.
+        """
+        if created:
+            self.created[(cls, key)] = record_id
+            return
+        with self.lock:
+            records = self.records.setdefault(cls, {})
+            records[key] = record_id
+            if cls is Seller and len(records) > self.seller_cache_size:
+                records.popitem(last=False)
+
+    @property
+    def created(self):
+        """Records created in the transaction of the current thread."""
+        created = getattr(self.transaction, 'created', None)
+        if created is None:
+            created = self.transaction.created = {}
+        return created
+
+    def commit(self):
+        """Shares records created in the committed transaction of the
+           thread with other threads."""
+        created = self.created
+        for (cls, key), record_id in created.iteritems():
+            self.add(cls, key, record_id)
+        created.clear()
+
+    def rollback(self):
+        """Forgets records created in the rolled back transaction of the
+           thread."""
+        self.created.clear()
 
 
 class UazDBPipeline(object):
     """
     Keeps advertisement data in PostgreSQL database defined in settings.py.
+    If DB_BATCH_SIZE is greater than 1, items are buffered and stored by
+    batches: one existence query, one insert and one commit per batch.
+    With TRACK_CHANGES stored advertisements are updated by their summaries
+    from listing pages (price changes and last sighting) and by their
+    rendered pages.
     """
 
-    def __init__(self):
-        engine = db_connect()
+    dictionaries = (
+        (Source, 'name'), (AdType, 'name'), (Currency, 'name'),
+        (Region, 'name'), (Manufacturer, 'name'), (Model, 'name'),
+        (Modification, 'name'), (Gear, 'name'), (MileageUnits, 'code'),
+        (VolumeUnits, 'code'), (Transmission, 'name'),
+        (TechCondition, 'name'), (BodyType, 'name'), (Fuel, 'name'),
+    )
+
+    stall_check_interval = 1  # seconds, if DB_BATCH_TIMEOUT isn't set
+
+    def __init__(self, stats=None, database=None, settings=None,
+                 crawler=None):
+        """Connects to the database.
+
+        Kwargs:
+            stats (scrapy.statscol.StatsCollector): crawler stats.
+            database (dict): connection parameters (DATABASE setting if
+                             None).
+            settings (scrapy.settings.Settings): crawler settings (project
+                                                 settings if None).
+            crawler (scrapy.crawler.Crawler): crawler, whose engine is
+                                              checked for a stall.
+        """
+        if settings is None:
+            settings = get_project_settings()
+        self.crawler = crawler
+        engine = db_connect(database or settings.get('DATABASE'))
         create_tables(engine)
         self.Session = sessionmaker(bind=engine)
+        self.stats = stats
+        self.references = ReferenceCache(
+            settings.getint('DB_SELLER_CACHE_SIZE', 10000))
+        self.batch_size = max(settings.getint('DB_BATCH_SIZE', 1), 1)
+        self.batch_timeout = settings.getfloat('DB_BATCH_TIMEOUT', 0)
+        self.track_changes = settings.getbool('TRACK_CHANGES', False)
+        self.batch = []
+        self.flusher = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats, settings=crawler.settings, crawler=crawler)
+
+    def open_spider(self, spider):
+        """Loads reference tables into the cache. In batching mode starts
+           periodic flushing of the batch (see UazDBPipeline.tick)."""
+        self.preload_references()
+        if self.batch_size > 1:
+            self.flusher = task.LoopingCall(self.tick)
+            self.flusher.start(self.batch_timeout if self.batch_timeout > 0
+                               else self.stall_check_interval, now=False)
+
+    def preload_references(self):
+        """Loads dictionary tables into the cache."""
+        session = self.Session()
+        for cls, fieldname in self.dictionaries:
+            self.references.preload(session, cls, fieldname)
+        session.close()
+
+    def close_spider(self, spider):
+        """Stores the rest of buffered items."""
+        if self.flusher is not None and self.flusher.running:
+            self.flusher.stop()
+        self.flush()
 
     def process_item(self, item, spider):
         """Search an advertisement among old ones in the database and
            keeps it if it's new.
 
         Args:
-            item (uaz.items.Advertisement): result of a page processing by
-                                            irr spider.
+            item (uaz.items.Advertisement or
+                  uaz.items.AdvertisementSummary): result of a page
+                                                   processing by irr spider.
             spider (uaz.spiders.IrrSpider): spider instance.
 
         Raises:
@@ -50,45 +236,388 @@ class UazDBPipeline(object):
 
         Returns:
             uaz.items.Advertisement: processed item.
+            twisted.internet.defer.Deferred: in batching mode, fires with
+                processed item (or fails with DropItem) when the batch
+                is stored.
         """
-        if item.get('foreign_id'):
-            session = self.Session()
-            if session.query(exists().where(
-                Advertisement.foreign_id == item.get('foreign_id'))
-            ).scalar():
-                raise DropItem("Advertisement has been scraped previously: {0}"
-                               .format(item.get('url')))
+        if not item.get('foreign_id'):
+            raise DropItem("Missing foreign id in {0}".format(item.get('url')))
+        if self.batch_size == 1:
+            with timed(self.stats, 'db/item'):
+                error = self.store([item])[0]
+            if error is not None:
+                raise error
+            return item
+        deferred = timed_deferred(self.stats, 'db/item', Deferred())
+        self.batch.append((item, deferred))
+        if len(self.batch) >= self.batch_size or self.stalled():
+            self.flush()
+        return deferred
+
+    def stalled(self):
+        """Returns True if the crawl can't go on until buffered items are
+           stored: the engine has no more requests to download (requests of
+           other workers of a sharded crawl don't count), or it
+           stopped downloading because responses of the waiting items
+           exceed SCRAPER_SLOT_MAX_ACTIVE_SIZE."""
+        if self.crawler is None or self.crawler.engine is None \
+                or self.crawler.engine.slot is None:
+            return False
+        engine = self.crawler.engine
+        if engine.scraper.slot is not None \
+                and engine.scraper.slot.needs_backout():
+            return True
+        return not engine.downloader.active \
+            and engine.slot.start_requests is None \
+            and not len(engine.slot.scheduler)
+
+    def tick(self):
+        """Flushes the batch every DB_BATCH_TIMEOUT seconds or, if the
+           timeout isn't set, when the crawl is stalled (e.g. the last items
+           arrived while pages were still downloading)."""
+        if self.batch_timeout > 0 or self.stalled():
+            self.flush()
+
+    def flush(self):
+        """Stores buffered items and fires their deferreds."""
+        batch, self.batch = self.batch, []
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        """Stores a batch of items.
+
+        Args:
+            batch (list): pairs of an item and its deferred.
+        """
+        self.resolve_batch(
+            self.store_batch([item for item, deferred in batch]), batch)
+
+    def store_batch(self, items):
+        """Stores a batch of items. If the batch can't be stored (one broken
+           item rolls back the whole transaction), its items are stored one
+           by one, so only the broken ones fail.
+
+        Args:
+            items (list): items of the batch.
+
+        Returns:
+            list: errors by items as UazDBPipeline.store returns them, and
+                  twisted.python.failure.Failure for every item, which
+                  couldn't be stored.
+        """
+        try:
+            return self.store(items)
+        except Exception:
+            if len(items) == 1:
+                return [Failure()]
+        self.inc_stat('db/batch_retries')
+        errors = []
+        for item in items:
+            try:
+                errors.extend(self.store([item]))
+            except Exception:
+                errors.append(Failure())
+        return errors
+
+    def resolve_batch(self, errors, batch):
+        """Fires deferreds of a stored batch.
+
+        Args:
+            errors (list): result of UazDBPipeline.store.
+            batch (list): pairs of an item and its deferred.
+        """
+        for (item, deferred), error in zip(batch, errors):
+            if error is None:
+                deferred.callback(item)
             else:
-                adparams = dict(item)
-                adparams['seller'] = self.process_reference(
-                    session, 'seller', name=adparams.get('seller'),
-                    url=adparams.get('seller_url'))
-                try:
-                    del adparams['seller_url']
-                except KeyError:
-                    pass
-                for attr in ('mileage_units', 'volume_units'):
-                    adparams[attr] = self.process_reference(
-                        session, attr, code=adparams.get(attr))
-                for attr in (
-                    'source', 'ad_type', 'currency', 'manufacturer', 'model',
-                    'modification', 'gear', 'transmission', 'tech_condition',
-                    'body_type', 'fuel', 'region',
-                ):
-                    adparams[attr] = self.process_reference(
-                        session, attr, name=adparams.get(attr))
-                advertisement = Advertisement(**adparams)
-                session.add(advertisement)
-                session.commit()
-                session.close()
+                deferred.errback(error)
+
+    def fail_batch(self, failure, batch):
+        """Fails deferreds of a batch, which couldn't be stored.
+
+        Args:
+            failure (twisted.python.failure.Failure): storing error.
+            batch (list): pairs of an item and its deferred.
+        """
+        for item, deferred in batch:
+            deferred.errback(failure)
+
+    def store(self, items):
+        """Keeps new advertisements from the list in the database. With
+           TRACK_CHANGES stored advertisements are updated (see
+           UazDBPipeline.update_rows and UazDBPipeline.store_summaries).
+
+        Args:
+            items (list): uaz.items.Advertisement and
+                          uaz.items.AdvertisementSummary instances with
+                          foreign_id.
+
+        Returns:
+            list: None for every stored item (and every summary) and DropItem
+                  exception for every item, which exists in the database or
+                  repeats in the list.
+        """
+        start = default_timer()
+        now = datetime.now()
+        ads = [item for item in items
+               if not isinstance(item, AdvertisementSummary)]
+        summaries = [item for item in items
+                     if isinstance(item, AdvertisementSummary)]
+        session = self.Session()
+        try:
+            sources = dict((name, self.process_reference(
+                session, 'source', name=name)) for name in set(
+                    item.get('source') for item in ads))
+            keys = [(item.get('foreign_id'), sources[item.get('source')])
+                    for item in ads]
+            known = set(session.query(
+                Advertisement.foreign_id, Advertisement.source_id).filter(
+                    Advertisement.foreign_id.in_(set(
+                        foreign_id for foreign_id, source_id in keys)),
+                    Advertisement.source_id.in_(set(sources.values())))) \
+                if ads else set()
+            rows, changed = [], []
+            for item, key in zip(ads, keys):
+                if key not in known:
+                    known.add(key)
+                    row = self.advertisement_row(
+                        self.process_references(session, item))
+                    row['last_seen'] = now
+                    rows.append(row)
+                elif self.track_changes:
+                    changed.append(item)
+            stored = set()
+            if rows:
+                stored.update(tuple(key) for key in session.execute(
+                    InsertOnConflict(
+                        Advertisement.__table__, unique_index(Advertisement)
+                    ).values(rows).returning(Advertisement.foreign_id,
+                                             Advertisement.source_id)))
+            if changed:
+                self.inc_stat('db/updated',
+                              self.update_rows(session, changed, now))
+            if summaries and self.track_changes:
+                self.store_summaries(session, summaries, now)
+            session.commit()
+        except Exception:
+            session.rollback()
+            self.references.rollback()
+            raise
         else:
-            raise DropItem("Missing foreign id in {0}".format(item.get('url')))
+            self.references.commit()
+        finally:
+            session.close()
+            observe(self.stats, 'db/store', default_timer() - start)
+            if self.stats is not None:
+                self.stats.set_value('references/hits', self.references.hits)
+                self.stats.set_value('references/misses',
+                                     self.references.misses)
+        errors, keys = [], iter(keys)
+        for item in items:
+            if isinstance(item, AdvertisementSummary):
+                errors.append(None)
+                continue
+            key = next(keys)
+            if key in stored:
+                stored.remove(key)
+                errors.append(None)
+            else:
+                errors.append(DropItem(
+                    "Advertisement has been scraped previously: {0}"
+                    .format(item.get('url'))))
+        return errors
 
-        return item
+    def update(self, items):
+        """Replaces data of stored advertisements with data of the items
+           (matched by foreign_id and source), e.g. after fixes of the
+           parser.
+
+        Args:
+            items (list): uaz.items.Advertisement instances with foreign_id.
+                          If an item has no url or publication date, stored
+                          value is kept.
+
+        Returns:
+            int: number of updated advertisements.
+        """
+        session = self.Session()
+        try:
+            updated = self.update_rows(session, items)
+            session.commit()
+        except Exception:
+            session.rollback()
+            self.references.rollback()
+            raise
+        else:
+            self.references.commit()
+        finally:
+            session.close()
+        return updated
+
+    def update_rows(self, session, items, seen=None):
+        """Replaces data of stored advertisements with data of the items
+           (matched by foreign_id and source) in the transaction.
+
+        Args:
+            session (sqlalchemy.orm.Session): DB session instance.
+            items (list): uaz.items.Advertisement instances with foreign_id.
+                          If an item has no url or publication date, stored
+                          value is kept.
+
+        Kwargs:
+            seen (datetime.datetime): time of the sighting of the
+                                      advertisements, their price changes
+                                      are recorded (None - an old sighting,
+                                      e.g. a stored page).
+
+        Returns:
+            int: number of updated advertisements.
+        """
+        table = Advertisement.__table__
+        statement = table.update().where(
+            (table.c.foreign_id == bindparam('b_foreign_id')) &
+            (table.c.source_id == bindparam('b_source_id')))
+        groups, prices = {}, []
+        for item in items:
+            row = self.advertisement_row(
+                self.process_references(session, item))
+            if 'url' not in item:
+                del row['url']
+            if 'published' not in item:
+                del row['published']
+            if seen is None:
+                del row['last_seen']
+            else:
+                row['last_seen'] = seen
+                prices.append((row['foreign_id'], row['source_id'],
+                               row['price']))
+            row['b_foreign_id'] = row.pop('foreign_id')
+            row['b_source_id'] = row.pop('source_id')
+            groups.setdefault(frozenset(row), []).append(row)
+        if prices:
+            self.record_price_changes(session, prices, seen)
+        updated = 0
+        for rows in groups.itervalues():
+            updated += session.execute(statement, rows).rowcount
+        return updated
+
+    def store_summaries(self, session, summaries, seen):
+        """Updates prices and time of the last sighting of stored
+           advertisements by their summaries from listing pages. Summaries
+           of unknown advertisements are ignored (their pages are rendered).
+
+        Args:
+            session (sqlalchemy.orm.Session): DB session instance.
+            summaries (list): uaz.items.AdvertisementSummary instances with
+                              foreign_id.
+            seen (datetime.datetime): time of the sighting.
+        """
+        prices = [(item.get('foreign_id'), self.process_reference(
+            session, 'source', name=item.get('source')), item.get('price'))
+            for item in summaries]
+        self.record_price_changes(session, prices, seen)
+        foreign_ids, source_ids, prices = zip(*prices)
+        session.execute(text(
+            u"UPDATE {0} AS a SET last_seen = :seen, "
+            u"price = coalesce(o.price, a.price) "
+            u"FROM unnest(CAST(:foreign_ids AS integer[]), "
+            u"CAST(:source_ids AS integer[]), "
+            u"CAST(:prices AS double precision[])) "
+            u"AS o(foreign_id, source_id, price) "
+            u"WHERE a.foreign_id = o.foreign_id "
+            u"AND a.source_id = o.source_id"
+            .format(Advertisement.__tablename__)
+        ), dict(seen=seen, foreign_ids=list(foreign_ids),
+                source_ids=list(source_ids), prices=list(prices)))
+        self.inc_stat('db/summaries', len(summaries))
+
+    def record_price_changes(self, session, prices, changed):
+        """Records differences between stored and new prices of
+           advertisements.
+
+        Args:
+            session (sqlalchemy.orm.Session): DB session instance.
+            prices (list): tuples of foreign_id, source id and new price
+                           (None - unknown, not recorded).
+            changed (datetime.datetime): time of the change.
+        """
+        foreign_ids, source_ids, prices = zip(*prices)
+        recorded = session.execute(text(
+            u"INSERT INTO {0} (advertisement_id, old_price, new_price, "
+            u"changed) SELECT a.id, a.price, o.price, :changed "
+            u"FROM unnest(CAST(:foreign_ids AS integer[]), "
+            u"CAST(:source_ids AS integer[]), "
+            u"CAST(:prices AS double precision[])) "
+            u"AS o(foreign_id, source_id, price) "
+            u"JOIN {1} AS a ON a.foreign_id = o.foreign_id "
+            u"AND a.source_id = o.source_id "
+            u"WHERE o.price IS NOT NULL AND a.price IS DISTINCT FROM o.price"
+            .format(PriceChange.__tablename__, Advertisement.__tablename__)
+        ), dict(changed=changed, foreign_ids=list(foreign_ids),
+                source_ids=list(source_ids), prices=list(prices))).rowcount
+        self.inc_stat('db/price_changes', recorded)
+
+    def inc_stat(self, key, count=1):
+        if self.stats is not None and count:
+            self.stats.inc_value(key, count)
+
+    def process_references(self, session, item):
+        """Replaces reference values of an advertisement with records of
+           reference tables.
+
+        Args:
+            session (sqlalchemy.orm.Session): DB session instance.
+            item (uaz.items.Advertisement): advertisement data.
+
+        Returns:
+            dict: advertisement attributes.
+        """
+        adparams = dict(item)
+        adparams['seller'] = self.process_reference(
+            session, 'seller', name=adparams.get('seller'),
+            url=adparams.get('seller_url'))
+        try:
+            del adparams['seller_url']
+        except KeyError:
+            pass
+        for attr in ('mileage_units', 'volume_units'):
+            adparams[attr] = self.process_reference(
+                session, attr, code=adparams.get(attr))
+        for attr in (
+            'source', 'ad_type', 'currency', 'manufacturer', 'model',
+            'modification', 'gear', 'transmission', 'tech_condition',
+            'body_type', 'fuel', 'region',
+        ):
+            adparams[attr] = self.process_reference(
+                session, attr, name=adparams.get(attr))
+        return adparams
+
+    def advertisement_row(self, adparams):
+        """Converts advertisement attributes into values of table columns.
+
+        Args:
+            adparams (dict): advertisement attributes.
+
+        Returns:
+            dict: values for every column of advertisement table.
+        """
+        row = dict.fromkeys(column.name for column in
+                            Advertisement.__table__.columns
+                            if not column.primary_key)
+        mapper = class_mapper(Advertisement)
+        for attr, value in adparams.iteritems():
+            if attr in row:
+                row[attr] = value
+            else:
+                column = list(mapper.get_property(attr).local_columns)[0]
+                row[column.name] = value
+        return row
 
     def process_reference(self, session, refname, **fields):
         """Search for a record with specified attributes in a reference table
-           or creates new record if such doesn't exists.
+           or creates new record if such doesn't exists. Records are searched
+           in the cache first, then upserted (safe for concurrent writers).
 
         Args:
             session (sqlalchemy.orm.Session): DB session instance.
@@ -96,7 +625,7 @@ class UazDBPipeline(object):
             fields (dict): search conditions or initial attributes.
 
         Returns:
-            one of uaz.models.* instance: desired reference record.
+            int: id of desired reference record.
             None: if nothing to seek for and nothing to create.
         """
         if all(value is None for value in fields.itervalues()):
@@ -107,34 +636,188 @@ class UazDBPipeline(object):
                 if '_' in refname else refname.title(), None
             )
             assert cls is not None
-            instance = session.query(cls).filter_by(**fields).first()
-            if instance:
-                return instance
-            else:
-                instance = cls(**fields)
-                session.add(instance)
-                return instance
+            key = self.references.key(**fields)
+            record_id = self.references.get(cls, key)
+            if record_id is not None:
+                return record_id
+            with timed(self.stats, 'db/reference'):  # only cache misses
+                record_id = session.execute(
+                    InsertOnConflict(cls.__table__, unique_index(cls),
+                                     update=True)
+                    .values(**fields).returning(cls.__table__.c.id)
+                ).scalar()
+            self.references.add(cls, key, record_id, created=True)
+            return record_id
+
+
+class UazAsyncDBPipeline(UazDBPipeline):
+    """
+    Keeps advertisement data in PostgreSQL database like UazDBPipeline, but
+    batches are stored by a pool of worker threads, so the reactor isn't
+    blocked by database round-trips. If DB_WRITE_QUEUE_SIZE items are waiting
+    to be stored, the engine stops downloading new pages until the queue
+    drains.
+    """
+
+    def __init__(self, stats=None, database=None, settings=None,
+                 crawler=None):
+        """Connects to the database and initializes worker threads.
+
+        Kwargs:
+            stats (scrapy.statscol.StatsCollector): crawler stats.
+            database (dict): connection parameters (DATABASE setting if
+                             None).
+            settings (scrapy.settings.Settings): crawler settings (project
+                                                 settings if None).
+            crawler (scrapy.crawler.Crawler): crawler, which is paused if
+                                              the queue is full.
+        """
+        if settings is None:
+            settings = get_project_settings()
+        super(UazAsyncDBPipeline, self).__init__(stats, database, settings,
+                                                 crawler)
+        threads_number = max(settings.getint('DB_WRITE_THREADS', 1), 1)
+        self.threadpool = ThreadPool(threads_number, threads_number,
+                                     u'UazAsyncDBPipeline')
+        self.queue_size = settings.getint('DB_WRITE_QUEUE_SIZE', 1000)
+        self.queued = 0
+        self.writing = set()
+        self.paused = False
+
+    def open_spider(self, spider):
+        """Starts worker threads."""
+        self.threadpool.start()
+        super(UazAsyncDBPipeline, self).open_spider(spider)
+
+    def close_spider(self, spider):
+        """Stores the rest of buffered items and waits for all writes.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when worker threads stop.
+        """
+        super(UazAsyncDBPipeline, self).close_spider(spider)
+        deferred = DeferredList(list(self.writing))
+        deferred.addBoth(lambda _: self.threadpool.stop())
+        return deferred
+
+    def process_item(self, item, spider):
+        """Puts an advertisement into the queue of items to store.
+
+        Args:
+            item (uaz.items.Advertisement): result of a page processing by
+                                            irr spider.
+            spider (uaz.spiders.IrrSpider): spider instance.
+
+        Raises:
+            DropItem: if data received from spider (item) haven't foreign_id
+                      information.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with processed item (or
+                fails with DropItem) when the item is stored.
+        """
+        if not item.get('foreign_id'):
+            raise DropItem("Missing foreign id in {0}".format(item.get('url')))
+        deferred = timed_deferred(self.stats, 'db/item', Deferred())
+        self.batch.append((item, deferred))
+        self.queued += 1
+        if self.queued >= self.queue_size:
+            self.pause()
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        elif not self.writing and self.stalled():
+            self.flush()
+        return deferred
+
+    def write(self, batch):
+        """Stores a batch of items in a worker thread.
+
+        Args:
+            batch (list): pairs of an item and its deferred.
+        """
+        deferred = threads.deferToThreadPool(
+            reactor, self.threadpool, self.store_batch,
+            [item for item, item_deferred in batch])
+        deferred.addCallbacks(self.resolve_batch, self.fail_batch,
+                              callbackArgs=(batch,), errbackArgs=(batch,))
+        deferred.addBoth(self.written, deferred, len(batch))
+        self.writing.add(deferred)
+
+    def written(self, result, deferred, size):
+        self.writing.discard(deferred)
+        self.queued -= size
+        if self.queued < self.queue_size:
+            self.unpause()
+        if self.batch and not self.writing and self.stalled():
+            self.flush()
+        return result
+
+    def pause(self):
+        """Stops downloading of new pages."""
+        if not self.paused and self.crawler is not None:
+            self.paused = True
+            self.crawler.engine.pause()
+            if self.stats is not None:
+                self.stats.inc_value('db/write_queue_full')
+
+    def unpause(self):
+        """Resumes downloading of new pages."""
+        if self.paused:
+            self.paused = False
+            self.crawler.engine.unpause()
 
 
 class UazExcelPipeline(object):
     """
     Prints data of "new" advertisements (not seen previously) into excel file.
+    The file is written when the spider is closed and, if XLS_CHECKPOINT_ROWS
+    or XLS_CHECKPOINT_TIMEOUT is set, periodically during the crawl.
     """
 
-    def __init__(self):
-        """Initializes excel workbook and sheet."""
-        settings = get_project_settings()
+    MAX_ROWS = 65536  # rows limit of a sheet in xls format
+
+    def __init__(self, stats=None, settings=None):
+        """Initializes excel workbook and sheet.
+
+        Kwargs:
+            stats (scrapy.statscol.StatsCollector): crawler stats.
+            settings (scrapy.settings.Settings): crawler settings (project
+                                                 settings if None).
+        """
+        if settings is None:
+            settings = get_project_settings()
+        self.stats = stats
         self.filename = u'{0}.xls'.format(datetime.now().strftime(
             settings.get('XLS_FILENAME', '%Y%m%d%H%M%S')))
         self.dataorder = settings.get('XLS_DATA_ORDER', [])
         self.date_style = xlwt.XFStyle()
         self.date_style.num_format_str = settings.get('XLS_DATE_FORMAT',
                                                       'D.M.YY')
+        self.sheet_title = settings.get('XLS_SHEET_TITLE', u'UAZ')
+        self.checkpoint_rows = settings.getint('XLS_CHECKPOINT_ROWS', 0)
+        self.checkpoint_timeout = settings.getfloat('XLS_CHECKPOINT_TIMEOUT', 0)
+        self.checkpointer = None
+        self.unsaved = 0
         self.wb = xlwt.Workbook(encoding='utf-8')
-        self.ws = self.wb.add_sheet(settings.get('XLS_SHEET_TITLE', u'UAZ'))
-        self.rownum = 0
+        self.sheets = 0
         self.define_header_style()
-        self.print_header()
+        self.add_sheet()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats, crawler.settings)
+
+    def open_spider(self, spider):
+        """Starts periodic saving if XLS_CHECKPOINT_TIMEOUT is set."""
+        if self.checkpoint_timeout > 0:
+            self.checkpointer = task.LoopingCall(self.save)
+            self.checkpointer.start(self.checkpoint_timeout, now=False)
+
+    def close_spider(self, spider):
+        """Writes the excel file."""
+        if self.checkpointer is not None and self.checkpointer.running:
+            self.checkpointer.stop()
+        self.save()
 
     def process_item(self, item, spider):
         """Prints received from spider data into excel spreadsheet.
@@ -146,6 +829,11 @@ class UazExcelPipeline(object):
         Returns:
             uaz.items.Advertisement: processed item.
         """
+        if isinstance(item, AdvertisementSummary):
+            return item  # not a new advertisement
+        start = default_timer()
+        if self.rownum >= self.MAX_ROWS:
+            self.add_sheet()
         for colnum in xrange(len(self.dataorder)):
             attr = self.dataorder[colnum][0]
             if attr == u'url':
@@ -158,10 +846,31 @@ class UazExcelPipeline(object):
                     self.ws.write(self.rownum, colnum, value, self.date_style)
                 else:
                     self.ws.write(self.rownum, colnum, value)
-        self.wb.save(self.filename)
         self.rownum += 1
+        self.unsaved += 1
+        if self.checkpoint_rows and self.unsaved >= self.checkpoint_rows:
+            self.save()
+        observe(self.stats, 'xls/item', default_timer() - start)
         return item
 
+    def save(self):
+        """Writes the excel file if there are unsaved rows."""
+        if self.unsaved:
+            with timed(self.stats, 'xls/save'):
+                self.wb.save(self.filename)
+            self.unsaved = 0
+
+    def add_sheet(self):
+        """Adds new sheet to the workbook and prints table headers into it."""
+        self.sheets += 1
+        if self.sheets == 1:
+            title = self.sheet_title
+        else:  # sheet titles are unique and not longer than 31 characters
+            title = u'{0} ({1})'.format(self.sheet_title[:24], self.sheets)
+        self.ws = self.wb.add_sheet(title)
+        self.rownum = 0
+        self.print_header()
+
     def print_header(self):
         """Prints table headers into excel spreadsheet."""
         for colnum in xrange(len(self.dataorder)):
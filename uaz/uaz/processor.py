@@ -9,12 +9,63 @@
 """
 
 import re
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 from dateutil.parser import parse as datetime_parse
 
 
+# bytes deleted from utf-8 encoded numbers: everything except digits,
+# separators and dashes (spaces, letters, units, currency signs)
+NON_NUMERIC = b''.join(chr(code) for code in xrange(256)
+                       if chr(code) not in b'0123456789.,-')
+
+# dashes of ranges ("120–150") in utf-8 (figure, en, em dashes and minus)
+DASHES = tuple(dash.encode('utf-8')
+               for dash in (u'\u2012', u'\u2013', u'\u2014', u'\u2212'))
+
+# groups of digits with separators between them ("230.150.23", "2,7")
+NUMBER_RE = re.compile(br'\d+(?:[.,]\d+)*')
+
+# dash between numbers ("120-150"), the rest of a range is ignored
+RANGE_RE = re.compile(br'(?<=\d)-+(?=\d)')
+
+PENNY_RE = re.compile(br'[.,]\d{2}$')
+
+# commas between groups of three digits are thousands separators
+# ("1,500 км", "1,500,000"), a decimal dot may follow ("1,500.5")
+COMMA_THOUSANDS_RE = re.compile(br'^\d{1,3}(?:,\d{3})+(?:\.\d+)?$')
+
+
+def numeric_groups(raw):
+    """Extracts digits and separators between them. Thousands separators
+       (spaces), units and other symbols are deleted in one pass by
+       str.translate, then numbers are found by the precompiled regular
+       expression. Only the first value of a range is used.
+
+    Args:
+        raw (str or unicode): source string.
+
+    Returns:
+        str: digits with dots and commas between them ("230.150.23").
+    """
+    if isinstance(raw, unicode):
+        raw = raw.encode('utf-8')
+    if b'\xe2' in raw:
+        for dash in DASHES:
+            raw = raw.replace(dash, b'-')
+    text = raw.translate(None, NON_NUMERIC)
+    if b'-' in text:
+        text = RANGE_RE.split(text, 1)[0]
+    return b''.join(NUMBER_RE.findall(text))
+
+
 def only_digits(raw, force_int=False):
-    """Strips all not digit characters from string.
+    """Strips all not digit characters from string. A dot or a comma between
+       digits is a decimal separator ("2.7 л", "2,7 л"), spaces and commas
+       before groups of three digits are thousands separators ("1 500 км",
+       "1,500 км"). Only the first value of a range is used ("120-150
+       л.с.").
 
     Args:
         raw (str or unicode): source string.
@@ -24,21 +75,21 @@ def only_digits(raw, force_int=False):
 
     Returns:
         int or float: in dependence of "raw" argument content.
-        None: if raw is None, empty or not contains digits.
+        None: if raw is None, empty or not contains digits (or contains
+              several separators).
     """
     if isinstance(raw, (unicode, str)) and len(raw):
-        if not force_int and re.search(r'\d\.\d', raw):
-            try:
-                return float(u''.join(u'{0}'.format(one) for one in raw
-                                      if one.isdigit() or one == one.__class__(u'.')))
-            except (TypeError, ValueError):
-                return None
-        else:
-            try:
-                return int(u''.join(u'{0}'.format(one) for one in raw
-                                    if one.isdigit()))
-            except (TypeError, ValueError):
-                return None
+        number = numeric_groups(raw)
+        if b',' in number and COMMA_THOUSANDS_RE.match(number):
+            number = number.replace(b',', b'')
+        digits = number.translate(None, b'.,')
+        if not digits:
+            return None
+        if force_int or len(digits) == len(number):
+            return int(digits)
+        if len(number) - len(digits) == 1:
+            return float(number.replace(b',', b'.'))
+        return None
     elif isinstance(raw, (float, int)):
         return raw
     else:
@@ -46,7 +97,8 @@ def only_digits(raw, force_int=False):
 
 
 def only_price(raw):
-    """Strips all not digit characters from string, allows for a penny.
+    """Strips all not digit characters from string, allows for a penny (two
+       digits after the last dot or comma).
 
     Args:
         raw (str or unicode): source string.
@@ -56,14 +108,13 @@ def only_price(raw):
         None: if raw is None, empty or not contains digits.
     """
     if isinstance(raw, (unicode, str)) and len(raw):
-        digits = only_digits(raw, force_int=True)
-        if digits is None:
+        number = numeric_groups(raw)
+        digits = number.translate(None, b'.,')
+        if not digits:
             return None
-        if re.search(r'\d(\.|,)\d{2}(\D|$)', raw) and len(unicode(digits)) >= 4:
-            return float(u'{0}.{1}'.format(unicode(digits)[:-2],
-                                           unicode(digits)[-2:]))
-        else:
-            return float(digits)
+        if len(digits) >= 4 and PENNY_RE.search(number):
+            return float(b'{0}.{1}'.format(digits[:-2], digits[-2:]))
+        return float(digits)
     else:
         return None
 
@@ -104,12 +155,147 @@ RU_EN_MONTHS = (
 )
 
 
-def datetime_interpretation(raw):
+RU_MONTHS = dict((ru, number)
+                 for number, (ru, en) in enumerate(RU_EN_MONTHS, 1))
+
+RELATIVE_DAYS = {u'сегодня': 0, u'вчера': 1, u'позавчера': 2}
+
+DATETIME_RE = re.compile(
+    ur'^\s*(?:(?P<day>\d{1,2})\s+(?P<month>[^\W\d_]+)'
+    ur'(?:\s+(?P<year>\d{4})(?:\s*г\.)?)?|(?P<relative>[^\W\d_]+))'
+    ur'(?:\s*,?\s*(?:в\s+)?(?P<hour>\d{1,2}):(?P<minute>\d{2}))?\s*$',
+    re.UNICODE)
+
+
+class DatetimeParser(object):
+    """
+    Converts dates in formats of irr.ru ("27 декабря 2013", "сегодня, 14:05",
+    "вчера") by a precompiled regular expression. Other formats are passed to
+    dateutil; the number of such fallbacks is reported to crawler's stats
+    (if the parser has them). Parsed values of recent strings are kept in a
+    bounded LRU cache.
+    """
+
+    def __init__(self, cache_size=1024, stats=None):
+        """Initializes cache and counters.
+
+        Kwargs:
+            cache_size (int): max number of cached strings.
+            stats (scrapy.statscol.StatsCollector): crawler stats.
+        """
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.fallbacks = 0
+        self.stats = stats
+
+    def __call__(self, raw, now=None, relative=True):
+        """Converts human-readable datetime into datetime instance.
+
+        Args:
+            raw (unicode): source string with datetime data.
+
+        Kwargs:
+            now (datetime): time, which relative dates (and dates without a
+                            year) are resolved against (None - current
+                            time).
+            relative (bool): resolve relative dates and dates without a
+                             year (otherwise None is returned for them).
+
+        Returns:
+            datetime: result datetime instance.
+            None: if couldn't read value.
+        """
+        try:
+            value = self.cache.pop(raw)
+        except KeyError:
+            value = self.parse(raw)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[raw] = value
+        if isinstance(value, tuple):
+            if not relative and value[0] is None:
+                return None
+            return self.resolve(*value, now=now)
+        return value
+
+    def parse(self, raw):
+        """Parses a string without the cache.
+
+        Returns:
+            tuple: year (None if omitted), month, day, hour, minute and
+                   number of days ago (for relative dates), which are
+                   resolved on every call.
+            datetime: result of dateutil for unknown formats.
+            None: if couldn't read value.
+        """
+        match = DATETIME_RE.match(raw)
+        if match:
+            hour, minute = (int(match.group('hour') or 0),
+                            int(match.group('minute') or 0))
+            relative = match.group('relative')
+            if relative is not None:
+                if relative.lower() in RELATIVE_DAYS:
+                    return (None, None, None, hour, minute,
+                            RELATIVE_DAYS[relative.lower()])
+            elif match.group('month').lower() in RU_MONTHS:
+                return (match.group('year') and int(match.group('year')),
+                        RU_MONTHS[match.group('month').lower()],
+                        int(match.group('day')), hour, minute, None)
+        return self.fallback(raw)
+
+    def fallback(self, raw):
+        """Parses a string of unknown format by dateutil."""
+        self.fallbacks += 1
+        if self.stats is not None:
+            self.stats.inc_value('datetime/dateutil_fallbacks')
+        try:
+            for ru, en in RU_EN_MONTHS:
+                if ru in raw:
+                    raw = raw.replace(ru, en)
+                    break
+            return datetime_parse(raw)
+        except:
+            return None
+
+    @staticmethod
+    def resolve(year, month, day, hour, minute, days_ago, now=None):
+        """Builds datetime for parsed values, relative to the current date
+           (or to the date of now). Date without a year is considered as the
+           last occurrence of this day."""
+        try:
+            if days_ago is not None:
+                today = (now or datetime.now()).date() - timedelta(
+                    days=days_ago)
+                return datetime(today.year, today.month, today.day, hour,
+                                minute)
+            if year is None:
+                today = (now or datetime.now()).date()
+                year = today.year
+                if (month, day) > (today.month, today.day):
+                    year -= 1
+            return datetime(year, month, day, hour, minute)
+        except ValueError:
+            return None
+
+
+datetime_parser = DatetimeParser()
+
+
+def datetime_interpretation(raw, loader_context=None):
     """Converts human-readable datetime into normal datetime instance.
 
     Args:
         raw (str or unicode): source string with datetime data.
 
+    Kwargs:
+        loader_context (dict): context of the item loader: "now" - time of
+                               the page download, relative dates are
+                               resolved against it (current time if
+                               omitted); "relative_dates" - False if the time
+                               is unknown (relative dates aren't resolved);
+                               "datetime_parser" - DatetimeParser of the
+                               spider (the shared one if omitted).
+
     Returns:
         datetime: result datetime instance.
         None: if couldn't read value.
@@ -120,13 +306,9 @@ def datetime_interpretation(raw):
                 raw = unicode(raw, 'utf-8')
             except UnicodeDecodeError:
                 return None
-        try:
-            for ru, en in RU_EN_MONTHS:
-                if ru in raw:
-                    raw = raw.replace(ru, en)
-                    break
-            return datetime_parse(raw)
-        except:
-            return None
+        context = loader_context or {}
+        parser = context.get('datetime_parser') or datetime_parser
+        return parser(raw, context.get('now'),
+                      context.get('relative_dates', True))
     else:
         return None
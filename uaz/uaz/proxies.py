@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: proxies
+   :platform: Unix
+   :synopsis: Pool of proxies with their own browsers, rate limits and
+              health scores
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import random
+from timeit import default_timer
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import maybeDeferred
+
+from scrapy import log
+from scrapy.http import Response
+
+from .browser import BrowserPool
+from .metrics import observe
+
+
+def proxy_list(settings):
+    """Returns proxies of PROXY_PARAMS: one address (host:port), a list of
+       addresses or comma separated addresses.
+
+    Args:
+        settings (scrapy.settings.Settings): project settings.
+
+    Returns:
+        list: proxy addresses ([None] - direct connection).
+    """
+    proxies = settings.get('PROXY_PARAMS')
+    if isinstance(proxies, basestring):
+        proxies = proxies.split(',')
+    proxies = [proxy.strip() for proxy in proxies or () if proxy.strip()]
+    return proxies or [None]
+
+
+class ProxySlot(object):
+    """
+    Proxy of the pool: its browsers, the browser's session for http client
+    (see uaz.handlers.HybridDownloadHandler) and its health: smoothed latency,
+    consecutive failures and cooldown.
+    """
+
+    def __init__(self, address, browsers):
+        """
+        Args:
+            address (str): proxy address (host:port) or None (direct
+                           connection).
+            browsers (uaz.browser.BrowserPool): browsers using the proxy.
+        """
+        self.address = address
+        self.browsers = browsers
+        self.session = None
+        self.latency = None  # unknown until the first page
+        self.active = 0  # requests in progress
+        self.next_request = 0  # time of the next request by the rate limit
+        self.failures = 0  # consecutive failures
+        self.strikes = 0  # consecutive cooldowns
+        self.cooldown_until = 0
+
+    @property
+    def name(self):
+        return self.address or 'direct'
+
+    def start_time(self, now):
+        """Returns the earliest time of the next request through the proxy
+           (allowed by the rate limit and the cooldown)."""
+        return max(now, self.next_request, self.cooldown_until)
+
+    def expected_time(self, now):
+        """Returns the time when a response of the next request through the
+           proxy is expected. Proxies with unknown latency are tried
+           first."""
+        return self.start_time(now) + (self.latency or 0) * (
+            1 + self.active // self.browsers.size)
+
+
+class ProxyPool(object):
+    """
+    Routes requests to proxies of PROXY_PARAMS. Every proxy has its own
+    browsers (SELENIUM_POOL_SIZE instances) and its own rate limit
+    (PROXY_DOWNLOAD_DELAY). A request goes to the proxy, which is expected
+    to give the response first (by its rate limit, latency and load). A
+    proxy is cooled down (gets no requests for PROXY_COOLDOWN seconds,
+    doubled for every next cooldown in a row) when it gives a ban-looking
+    page (PROXY_BAN_STATUSES, PROXY_BAN_MARKERS) or fails PROXY_MAX_FAILURES
+    times in a row. Requests banned by a proxy are repeated through other
+    proxies PROXY_BAN_RETRY_TIMES times, while some of them aren't cooled
+    down.
+    """
+
+    latency_weight = 0.3  # weight of the last latency in smoothed one
+    max_cooldown_factor = 16  # max growth of cooldowns in a row
+
+    def __init__(self, settings):
+        """Configures proxies and their browsers (nothing is started until
+           the first page is requested).
+
+        Args:
+            settings (scrapy.settings.Settings): project settings.
+        """
+        self.settings = settings
+        self.slots = [ProxySlot(address, BrowserPool(settings, address))
+                      for address in proxy_list(settings)]
+        self.delay = settings.getfloat('PROXY_DOWNLOAD_DELAY', 0)
+        self.randomize_delay = settings.getbool('RANDOMIZE_DOWNLOAD_DELAY',
+                                                True)
+        self.max_failures = max(settings.getint('PROXY_MAX_FAILURES', 3), 1)
+        self.cooldown = settings.getfloat('PROXY_COOLDOWN', 300)
+        self.ban_retry_times = settings.getint('PROXY_BAN_RETRY_TIMES', 2)
+        self.ban_statuses = set(int(status) for status in
+                                settings.getlist('PROXY_BAN_STATUSES'))
+        self.ban_markers = tuple(
+            marker.decode('utf-8') if isinstance(marker, str) else marker
+            for marker in settings.getlist('PROXY_BAN_MARKERS'))
+        # markers for bodies of http responses
+        self.ban_markers_bytes = tuple(marker.encode('utf-8')
+                                       for marker in self.ban_markers)
+        self._stats = None
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @stats.setter
+    def stats(self, stats):
+        self._stats = stats
+        for slot in self.slots:
+            slot.browsers.stats = stats
+
+    def render(self, url, session=False):
+        """Loads a page by a browser of the best proxy (see
+           uaz.browser.BrowserPool.render)."""
+        return self.fetch(self.render_by, url, session)
+
+    def render_by(self, slot, url, session=False):
+        return slot.browsers.render(url, session)
+
+    def fetch(self, download, *args, **kwargs):
+        """Downloads a page through the best proxy.
+
+        Args:
+            download (callable): downloads a page through a proxy: takes
+                                 ProxySlot (and args, kwargs), returns
+                                 scrapy.http.Response or page tuple of
+                                 uaz.browser.BrowserPool.render or deferred
+                                 firing with them.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with result of download.
+        """
+        return self._fetch(download, args, kwargs, 0)
+
+    def _fetch(self, download, args, kwargs, attempt):
+        slot, wait = self.choose()
+        if wait > 0:
+            deferred = task.deferLater(reactor, wait, self._download, slot,
+                                       download, args, kwargs)
+        else:
+            deferred = self._download(slot, download, args, kwargs)
+        deferred.addCallback(self._downloaded, slot, download, args, kwargs,
+                             attempt)
+        return deferred
+
+    def _download(self, slot, download, args, kwargs):
+        slot.active += 1
+        start = default_timer()
+        deferred = maybeDeferred(download, slot, *args, **kwargs)
+        deferred.addCallbacks(self.succeeded, self.failed,
+                              callbackArgs=(slot, start), errbackArgs=(slot,))
+        return deferred
+
+    def _downloaded(self, result, slot, download, args, kwargs, attempt):
+        if not self.banned(result):
+            slot.strikes = 0
+            return result
+        self.cool_down(slot, 'ban')
+        if attempt >= self.ban_retry_times or not self.available():
+            return result
+        self.inc_stat('proxy/ban_retries')
+        return self._fetch(download, args, kwargs, attempt + 1)
+
+    def choose(self):
+        """Chooses the proxy for the next request and reserves its time by
+           the rate limit.
+
+        Returns:
+            tuple: ProxySlot and seconds to wait before the request.
+        """
+        now = default_timer()
+        slot = min(self.slots, key=lambda slot: slot.expected_time(now))
+        start = slot.start_time(now)
+        slot.next_request = start + self.download_delay()
+        return slot, start - now
+
+    def available(self):
+        """Returns True if some proxies aren't cooled down."""
+        now = default_timer()
+        return any(slot.cooldown_until <= now for slot in self.slots)
+
+    def download_delay(self):
+        if self.randomize_delay:
+            return random.uniform(0.5 * self.delay, 1.5 * self.delay)
+        return self.delay
+
+    def banned(self, result):
+        """Checks whether a page looks like a ban of the proxy.
+
+        Args:
+            result: scrapy.http.Response or page tuple of
+                    uaz.browser.BrowserPool.render.
+
+        Returns:
+            bool: True if the page has a ban status or a ban marker.
+        """
+        if isinstance(result, Response):
+            return result.status in self.ban_statuses or any(
+                marker in result.body for marker in self.ban_markers_bytes)
+        return any(marker in result[1] for marker in self.ban_markers)
+
+    def succeeded(self, result, slot, start):
+        """Updates health of a proxy after a downloaded page."""
+        slot.active -= 1
+        latency = default_timer() - start
+        if slot.latency is None:
+            slot.latency = latency
+        else:
+            slot.latency += self.latency_weight * (latency - slot.latency)
+        slot.failures = 0
+        observe(self.stats, 'proxy/{0}'.format(slot.name), latency)
+        return result
+
+    def failed(self, failure, slot):
+        """Updates health of a proxy after a failed download."""
+        slot.active -= 1
+        slot.failures += 1
+        self.inc_stat('proxy/failures')
+        if slot.failures >= self.max_failures:
+            self.cool_down(slot, 'failures')
+        return failure
+
+    def cool_down(self, slot, reason):
+        """Stops requests through a proxy for a while. Its session is
+           dropped, so the next page is rendered by browser.
+
+        Args:
+            slot (ProxySlot): the proxy.
+            reason (str): "ban" or "failures".
+        """
+        slot.strikes += 1
+        seconds = self.cooldown * min(2 ** (slot.strikes - 1),
+                                      self.max_cooldown_factor)
+        slot.cooldown_until = max(slot.cooldown_until,
+                                  default_timer() + seconds)
+        slot.failures = 0
+        slot.session = None
+        self.inc_stat('proxy/cooldowns')
+        self.inc_stat('proxy/cooldowns/{0}'.format(reason))
+        log.msg(format=u'Proxy %(proxy)s is cooled down for %(seconds)ds '
+                       u'(%(reason)s)', level=log.WARNING,
+                proxy=slot.name, seconds=seconds, reason=reason)
+
+    def inc_stat(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
+    def stop(self):
+        """Stops browsers of all proxies."""
+        for slot in self.slots:
+            slot.browsers.stop()
@@ -0,0 +1,685 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: scheduler
+   :platform: Unix
+   :synopsis: Schedulers of resumable crawls (the queue and requests in
+              progress are kept in the journal of the job directory) and of
+              sharded crawls (the frontier is shared in the database)
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import cPickle as pickle
+import os
+import os.path as op
+import socket
+from timeit import default_timer
+
+from sqlalchemy import text
+
+from twisted.internet import reactor, task, threads
+from twisted.internet.defer import DeferredList
+from twisted.python.threadpool import ThreadPool
+
+from scrapy import log
+from scrapy.core.scheduler import Scheduler
+from scrapy.utils.request import request_fingerprint
+from scrapy.utils.reqser import request_to_dict, request_from_dict
+
+from .models import create_tables, db_connect, unique_index, InsertOnConflict
+from .models import FrontierRequest
+
+
+class ResumableScheduler(Scheduler):
+    """
+    Keeps the state of the crawl in JOBDIR, so a crawl stopped by a crash,
+    an outage or a reboot is resumed where it stopped. The queue of the
+    standard scheduler is saved only when the crawl is closed gracefully, so
+    this scheduler keeps requests in memory and appends every queued request
+    and every completed one to the journal of the job. A request is
+    completed when the engine is done with it: the page is downloaded
+    (rendered), the spider processed it, and its items passed the pipelines
+    (UazAsyncDBPipeline stored them). The journal is written in this order,
+    so any part of it from the beginning is a consistent state.
+
+    When the crawl is resumed, queued requests and requests in progress are
+    queued again, completed ones are seen by the dupefilter, and start
+    requests completed before aren't repeated. The job state is removed
+    when the crawl is finished, so the next run starts over.
+    """
+
+    journal_name = 'requests.journal'
+    compact_after = 10000  # records in the journal before its compaction
+
+    def __init__(self, dupefilter, jobdir=None, *args, **kwargs):
+        # the queue is kept in memory (and in the journal)
+        super(ResumableScheduler, self).__init__(dupefilter, None, *args,
+                                                 **kwargs)
+        self.jobdir = jobdir
+        self.crawler = None
+        self.journal = None
+        self.pending = {}  # journal keys and fingerprints of queued requests
+        self.active = {}  # the same of requests in progress
+        self.seen = set()  # fingerprints of completed requests
+        self.completed = set()  # start requests completed by the job
+        self.skipped = set()  # completed start requests dropped by this run
+        self.counter = 0
+        self.records = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super(ResumableScheduler, cls).from_crawler(crawler)
+        scheduler.crawler = crawler
+        return scheduler
+
+    @property
+    def journal_path(self):
+        return op.join(self.jobdir, self.journal_name)
+
+    def open(self, spider):
+        """Opens the queue. Queues again requests, which weren't completed
+           by the stopped crawl."""
+        result = super(ResumableScheduler, self).open(spider)
+        if self.jobdir is None:
+            return result
+        resumed, self.seen, self.completed = self.load_journal()
+        self.compact()
+        fingerprints = getattr(self.df, 'fingerprints', None)
+        if fingerprints is not None:
+            fingerprints.update(self.seen)
+        for data in resumed:
+            try:
+                request = request_from_dict(data, spider)
+            except ValueError as exc:
+                log.msg(format=u'Unable to resume request of %(url)s: '
+                               u'%(reason)s', level=log.ERROR, spider=spider,
+                        url=data.get('url'), reason=exc)
+                continue
+            if not request.dont_filter:
+                self.df.request_seen(request)
+            self.push(request)
+            self.stats.inc_value('scheduler/resumed', spider=spider)
+        if resumed:
+            log.msg(format=u'Resuming crawl (%(count)d requests scheduled)',
+                    spider=spider, count=len(resumed))
+        return result
+
+    def close(self, reason):
+        """Closes the queue and the journal. The job state is removed if the
+           crawl is finished."""
+        self.checkpoint()
+        result = super(ResumableScheduler, self).close(reason)
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.jobdir is not None and reason == 'finished':
+            self.remove_job()
+        return result
+
+    def enqueue_request(self, request):
+        """Queues a request, which isn't seen yet, and records it in the
+           journal. Start requests completed before the crawl was resumed
+           are dropped once (they aren't filtered by the dupefilter)."""
+        if request.dont_filter and self.completed:
+            fingerprint = request_fingerprint(request)
+            if fingerprint in self.completed \
+                    and fingerprint not in self.skipped:
+                self.skipped.add(fingerprint)
+                self.stats.inc_value('scheduler/completed_skipped',
+                                     spider=self.spider)
+                return
+        if not request.dont_filter and self.df.request_seen(request):
+            self.df.log(request, self.spider)
+            return
+        self.push(request)
+        self.stats.inc_value('scheduler/enqueued', spider=self.spider)
+
+    def push(self, request):
+        """Puts a request into the queue and the journal."""
+        self._mqpush(request)
+        self.stats.inc_value('scheduler/enqueued/memory', spider=self.spider)
+        if self.journal is None:
+            return
+        try:
+            data = request_to_dict(request, self.spider)
+        except ValueError:
+            return  # not serializable, can't be resumed
+        fingerprint = request_fingerprint(request)
+        if self.write(('queued', self.counter + 1, fingerprint, data)):
+            self.counter += 1
+            self.pending[request] = (self.counter, fingerprint)
+
+    def next_request(self):
+        """Takes the next request from the queue, it's in progress until the
+           engine completes it."""
+        self.checkpoint()
+        request = super(ResumableScheduler, self).next_request()
+        if request is not None and request in self.pending:
+            self.active[request] = self.pending.pop(request)
+        return request
+
+    def checkpoint(self):
+        """Records completion of requests, which the engine doesn't process
+           anymore."""
+        if not self.active or self.crawler is None \
+                or self.crawler.engine is None \
+                or self.crawler.engine.slot is None:
+            return
+        inprogress = self.crawler.engine.slot.inprogress
+        for request in [request for request in self.active
+                        if request not in inprogress]:
+            key, fingerprint = self.active.pop(request)
+            self.seen.add(fingerprint)
+            if self.start_request(request.dont_filter, request.meta):
+                self.completed.add(fingerprint)
+            self.write(('done', key))
+        if self.records > self.compact_after + len(self.pending) \
+                + len(self.active):
+            self.compact()
+
+    def write(self, record):
+        """Appends a record to the journal.
+
+        Returns:
+            bool: False if the record isn't serializable.
+        """
+        try:
+            data = pickle.dumps(record, protocol=2)
+        except (pickle.PicklingError, TypeError):
+            return False
+        self.journal.write(data)
+        self.journal.flush()
+        self.records += 1
+        return True
+
+    def load_journal(self):
+        """Reads the journal of the stopped crawl.
+
+        Returns:
+            tuple: serialized requests, which weren't completed (list),
+                   fingerprints of completed requests (set) and fingerprints
+                   of completed start requests (set).
+        """
+        queued, seen, completed = {}, set(), set()
+        if not op.exists(self.journal_path):
+            return [], seen, completed
+        with open(self.journal_path, 'rb') as journal:
+            while True:
+                try:
+                    record = pickle.load(journal)
+                except Exception:
+                    break  # the end or the last record cut by the crash
+                if record[0] == 'queued':
+                    queued[record[1]] = record[2:]
+                elif record[0] == 'done' and record[1] in queued:
+                    fingerprint, data = queued.pop(record[1])
+                    seen.add(fingerprint)
+                    if self.start_request(data['dont_filter'],
+                                          data['meta']):
+                        completed.add(fingerprint)
+                elif record[0] == 'seen':
+                    seen.add(record[1])
+                    if record[2]:
+                        completed.add(record[1])
+        return [queued[key][1] for key in sorted(queued)], seen, completed
+
+    @staticmethod
+    def start_request(dont_filter, meta):
+        """Returns True if a request isn't filtered by the dupefilter and
+           isn't a retry."""
+        return dont_filter and 'retry_times' not in meta
+
+    def compact(self):
+        """Rewrites the journal with fingerprints of completed requests and
+           requests, which aren't completed yet."""
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path + '.tmp', 'wb')
+        self.records = 0
+        for fingerprint in self.seen:
+            self.write(('seen', fingerprint, fingerprint in self.completed))
+        queued = dict(self.pending)
+        queued.update(self.active)
+        for request, (key, fingerprint) in sorted(queued.iteritems(),
+                                                  key=lambda pair: pair[1]):
+            self.write(('queued', key, fingerprint,
+                        request_to_dict(request, self.spider)))
+        os.fsync(self.journal.fileno())
+        os.rename(self.journal_path + '.tmp', self.journal_path)
+
+    def remove_job(self):
+        """Removes the journal, seen requests and the spider state of the
+           finished job."""
+        for name in ('requests.seen', self.journal_name):
+            if op.exists(op.join(self.jobdir, name)):
+                os.remove(op.join(self.jobdir, name))
+        # SpiderState extension stores the state after the scheduler is
+        # closed, the next run gets it empty
+        if isinstance(getattr(self.spider, 'state', None), dict):
+            self.spider.state.clear()
+
+
+# current time in UTC on the database server (workers on different hosts
+# compare leases by the same clock)
+NOW = u"(now() AT TIME ZONE 'UTC')"
+
+
+class Frontier(object):
+    """
+    Requests of a sharded crawl in crawl_frontier table, shared by workers
+    (crawler processes on one or several hosts). A request is added once per
+    job (by its fingerprint). Workers claim pending requests with row locks
+    skipping rows locked by others, and lease them: a request of a stopped
+    worker is claimed by another one when the lease expires, but not more
+    than max_attempts times.
+    """
+
+    def __init__(self, engine, job, worker, lease=600, max_attempts=3):
+        """
+        Args:
+            engine (sqlalchemy.engine.Engine): database engine.
+            job (str): name of the crawl shared by workers.
+            worker (str): name of the worker.
+
+        Kwargs:
+            lease (float): seconds before claimed requests may be claimed
+                           by other workers.
+            max_attempts (int): claims of a request before it's abandoned.
+        """
+        self.engine = engine
+        self.job = job
+        self.worker = worker
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def execute(self, statement, **params):
+        with self.engine.begin() as connection:
+            result = connection.execute(text(statement), job=self.job,
+                                        worker=self.worker, lease=self.lease,
+                                        max_attempts=self.max_attempts,
+                                        **params)
+            return result.fetchall() if result.returns_rows \
+                else result.rowcount
+
+    def add(self, rows):
+        """Adds requests, which aren't in the frontier yet.
+
+        Args:
+            rows (list): dicts with fingerprint, url, request and priority.
+
+        Returns:
+            int: number of added requests.
+        """
+        if not rows:
+            return 0
+        for row in rows:
+            row.update(job=self.job, attempts=0)
+        table = FrontierRequest.__table__
+        with self.engine.begin() as connection:
+            return len(connection.execute(InsertOnConflict(
+                table, unique_index(FrontierRequest)).values(rows).returning(
+                    table.c.id)).fetchall())
+
+    def claim(self, size):
+        """Leases pending requests with the highest priority.
+
+        Args:
+            size (int): max number of requests.
+
+        Returns:
+            list: tuples of id, fingerprint, pickled request and number of
+                  claims of the request.
+        """
+        return self.execute(
+            u"UPDATE crawl_frontier SET worker = :worker, "
+            u"attempts = attempts + 1, "
+            u"leased_until = {0} + :lease * interval '1 second' "
+            u"WHERE id IN (SELECT id FROM crawl_frontier WHERE job = :job "
+            u"AND done IS NULL AND attempts < :max_attempts "
+            u"AND (leased_until IS NULL OR leased_until < {0}) "
+            u"ORDER BY priority DESC, id LIMIT :size "
+            u"FOR UPDATE SKIP LOCKED) "
+            u"RETURNING id, fingerprint, request, attempts".format(NOW),
+            size=size)
+
+    def renew(self, ids):
+        """Prolongs leases of requests claimed by the worker."""
+        if ids:
+            self.execute(
+                u"UPDATE crawl_frontier "
+                u"SET leased_until = {0} + :lease * interval '1 second' "
+                u"WHERE id = ANY(CAST(:ids AS integer[])) "
+                u"AND worker = :worker AND done IS NULL".format(NOW),
+                ids=list(ids))
+
+    def complete(self, ids):
+        """Marks requests as completed."""
+        if ids:
+            self.execute(
+                u"UPDATE crawl_frontier SET done = {0}, leased_until = NULL "
+                u"WHERE id = ANY(CAST(:ids AS integer[]))".format(NOW),
+                ids=list(ids))
+
+    def release(self, ids):
+        """Returns claimed requests, which the worker won't process, to
+           other workers (the claim isn't counted)."""
+        if ids:
+            self.execute(
+                u"UPDATE crawl_frontier SET worker = NULL, "
+                u"leased_until = NULL, attempts = attempts - 1 "
+                u"WHERE id = ANY(CAST(:ids AS integer[])) "
+                u"AND worker = :worker AND done IS NULL",
+                ids=list(ids))
+
+    def has_pending(self):
+        """Returns True if the job has requests to claim or requests leased
+           by workers (they may add new requests)."""
+        return bool(self.execute(
+            u"SELECT EXISTS (SELECT 1 FROM crawl_frontier WHERE job = :job "
+            u"AND done IS NULL AND (attempts < :max_attempts "
+            u"OR leased_until > {0}))".format(NOW))[0][0])
+
+    def finish(self):
+        """Removes requests of the job if nothing is pending.
+
+        Returns:
+            int: number of abandoned requests (claimed max_attempts times
+                 and never completed), None if the job isn't finished.
+        """
+        if self.has_pending():
+            return None
+        abandoned = self.execute(
+            u"SELECT count(*) FROM crawl_frontier WHERE job = :job "
+            u"AND done IS NULL")[0][0]
+        self.execute(
+            u"DELETE FROM crawl_frontier WHERE job = :job AND NOT EXISTS ("
+            u"SELECT 1 FROM crawl_frontier WHERE job = :job "
+            u"AND done IS NULL AND (attempts < :max_attempts "
+            u"OR leased_until > {0}))".format(NOW))
+        return abandoned
+
+
+class FrontierScheduler(Scheduler):
+    """
+    Scheduler of a sharded crawl: several workers (crawler processes with
+    their own browsers and proxies, on one or several hosts) crawl the same
+    job from the frontier in the database (see Frontier). New requests are
+    added to the frontier (it replaces the dupefilter), the worker claims
+    FRONTIER_CLAIM_SIZE requests at once and keeps leases of requests until
+    the engine completes them. Repeated requests of claimed ones (retries)
+    stay with the worker. The worker finishes when the frontier has neither
+    pending requests nor requests leased by other workers.
+
+    Queries to the frontier run in a thread of the scheduler one by one (in
+    order of calls), so the reactor isn't blocked by database round-trips.
+    Claimed requests are queued when the claim returns, the scheduler has
+    pending requests while any query is in progress.
+    """
+
+    claim_interval = 1  # seconds before the next claim after an empty one
+    pending_ttl = 1  # seconds of caching of pending requests check
+
+    def __init__(self, dupefilter, jobdir=None, *args, **kwargs):
+        # claimed requests are kept in memory, the frontier is the database
+        super(FrontierScheduler, self).__init__(dupefilter, None, *args,
+                                                **kwargs)
+        self.crawler = None
+        self.frontier = None
+        self.outbox = []  # requests to add to the frontier
+        self.rows = {}  # frontier ids of queued requests
+        self.active = {}  # frontier ids of requests in progress
+        self.owned = {}  # frontier ids of claimed requests by fingerprints
+        self.renewer = None
+        self.next_claim = 0
+        self.claiming = False
+        self.pending = (0, True)  # time and result of the last check
+        self.threadpool = ThreadPool(1, 1, u'FrontierScheduler')
+        self.calls = set()  # queries in progress
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super(FrontierScheduler, cls).from_crawler(crawler)
+        scheduler.crawler = crawler
+        return scheduler
+
+    def open(self, spider):
+        """Connects to the frontier and starts renewing of leases."""
+        result = super(FrontierScheduler, self).open(spider)
+        settings = self.crawler.settings
+        engine = db_connect(settings.get('DATABASE'))
+        create_tables(engine)
+        self.frontier = Frontier(
+            engine, settings.get('FRONTIER_JOB') or spider.name,
+            settings.get('FRONTIER_WORKER') or u'{0}-{1}'.format(
+                socket.gethostname(), os.getpid()),
+            settings.getfloat('FRONTIER_LEASE', 600),
+            settings.getint('FRONTIER_MAX_ATTEMPTS', 3))
+        self.claim_size = settings.getint('FRONTIER_CLAIM_SIZE') \
+            or settings.getint('CONCURRENT_REQUESTS', 1)
+        self.threadpool.start()
+        self.renewer = task.LoopingCall(self.renew)
+        self.renewer.start(self.frontier.lease / 3.0, now=False)
+        log.msg(format=u'Worker %(worker)s of sharded crawl %(job)s',
+                spider=spider, worker=self.frontier.worker,
+                job=self.frontier.job)
+        return result
+
+    def close(self, reason):
+        """Returns requests, which weren't started, to the frontier. Removes
+           the frontier of the job if the crawl is finished.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when all queries are
+                                             done.
+        """
+        if self.renewer is not None and self.renewer.running:
+            self.renewer.stop()
+        self.flush()
+        self.checkpoint()
+        self.call(self.frontier.release, set(self.rows.itervalues())
+                  - set(self.active.itervalues())).addErrback(self.failed)
+        if reason == 'finished':
+            self.call(self.frontier.finish).addCallbacks(self.finished,
+                                                         self.failed)
+        deferred = DeferredList(list(self.calls))
+        deferred.addBoth(lambda _: self.threadpool.stop())
+        deferred.addBoth(
+            lambda _: super(FrontierScheduler, self).close(reason))
+        return deferred
+
+    def finished(self, abandoned):
+        if abandoned:
+            self.stats.set_value('frontier/abandoned', abandoned,
+                                 spider=self.spider)
+
+    def call(self, func, *args):
+        """Runs a query to the frontier in the thread of the scheduler.
+
+        Args:
+            func (callable): method of the frontier.
+            args: its arguments.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with the result of the
+                                             query.
+        """
+        deferred = threads.deferToThreadPool(reactor, self.threadpool, func,
+                                             *args)
+        self.calls.add(deferred)
+        deferred.addBoth(self.called, deferred)
+        return deferred
+
+    def called(self, result, deferred):
+        """Asks the engine to look at the scheduler again when queries are
+           done (the engine closes an idle spider)."""
+        self.calls.discard(deferred)
+        if not self.calls:
+            self.wake(0)
+        return result
+
+    def failed(self, failure):
+        log.err(failure, u'Query to the frontier failed', spider=self.spider)
+
+    def enqueue_request(self, request):
+        """Adds a request to the frontier (on the next claim). Repeated
+           requests of claimed ones and requests, which can't be serialized,
+           are queued by the worker."""
+        fingerprint = request_fingerprint(request)
+        if request.dont_filter and fingerprint in self.owned:
+            self.rows[request] = self.owned[fingerprint]
+            self.push(request, 'frontier/repeated')
+            return
+        try:
+            data = pickle.dumps(request_to_dict(request, self.spider),
+                                protocol=2)
+        except (ValueError, pickle.PicklingError, TypeError):
+            self.push(request, 'frontier/local')
+            return
+        self.outbox.append({'fingerprint': fingerprint, 'url': request.url,
+                            'request': data, 'priority': request.priority})
+
+    def push(self, request, stat):
+        self._mqpush(request)
+        self.stats.inc_value(stat, spider=self.spider)
+        self.stats.inc_value('scheduler/enqueued/memory', spider=self.spider)
+        self.stats.inc_value('scheduler/enqueued', spider=self.spider)
+
+    def next_request(self):
+        """Returns a claimed request. Adds new requests to the frontier,
+           completes processed ones and claims more if none is left."""
+        self.flush()
+        self.checkpoint()
+        if not len(self.mqs) and not self.claiming:
+            if default_timer() >= self.next_claim:
+                self.claim()
+            else:
+                # the engine doesn't poll an idle scheduler
+                self.wake(self.next_claim - default_timer())
+        request = self.mqs.pop()
+        if request is None:
+            return None
+        if request in self.rows:
+            self.active[request] = self.rows.pop(request)
+        self.stats.inc_value('scheduler/dequeued/memory', spider=self.spider)
+        self.stats.inc_value('scheduler/dequeued', spider=self.spider)
+        return request
+
+    def has_pending_requests(self):
+        if len(self):
+            return True
+        self.flush()
+        self.checkpoint()
+        if self.calls:
+            # queries in progress may add or claim requests
+            return True
+        checked, pending = self.pending
+        if default_timer() - checked >= self.pending_ttl:
+            self.call(self.frontier.has_pending).addCallbacks(self.checked,
+                                                              self.failed)
+            return True
+        return pending
+
+    def checked(self, pending):
+        self.pending = (default_timer(), pending)
+
+    def __len__(self):
+        return len(self.mqs) + len(self.outbox)
+
+    def flush(self):
+        """Adds new requests to the frontier."""
+        if not self.outbox:
+            return
+        rows, self.outbox = self.outbox, []
+        self.call(self.frontier.add, rows).addCallbacks(
+            self.added, self.failed, callbackArgs=(len(rows),))
+        self.next_claim = 0
+
+    def added(self, added, size):
+        self.stats.inc_value('frontier/added', added, spider=self.spider)
+        if added < size:
+            self.stats.inc_value('frontier/duplicates', size - added,
+                                 spider=self.spider)
+
+    def claim(self):
+        """Claims requests from the frontier (they are queued when the claim
+           returns)."""
+        self.claiming = True
+        deferred = self.call(self.frontier.claim, self.claim_size)
+        deferred.addCallbacks(self.claimed, self.claim_failed)
+        deferred.addBoth(self.woken)
+
+    def claim_failed(self, failure):
+        self.next_claim = default_timer() + self.claim_interval
+        self.failed(failure)
+
+    def woken(self, _):
+        """Asks the engine for the next request after a claim."""
+        self.claiming = False
+        self.wake(self.next_claim - default_timer())
+
+    def claimed(self, claimed):
+        """Queues claimed requests.
+
+        Args:
+            claimed (list): rows returned by Frontier.claim.
+        """
+        if not claimed:
+            self.next_claim = default_timer() + self.claim_interval
+            return
+        self.stats.inc_value('frontier/claimed', len(claimed),
+                             spider=self.spider)
+        for row_id, fingerprint, data, attempts in claimed:
+            try:
+                request = request_from_dict(pickle.loads(str(data)),
+                                            self.spider)
+            except Exception as exc:
+                log.msg(format=u'Unable to load request %(id)d of the '
+                               u'frontier: %(reason)s', level=log.ERROR,
+                        spider=self.spider, id=row_id, reason=exc)
+                self.call(self.frontier.complete,
+                          [row_id]).addErrback(self.failed)
+                continue
+            if attempts > 1:
+                self.stats.inc_value('frontier/reclaimed', spider=self.spider)
+            self.owned[fingerprint] = row_id
+            self.rows[request] = row_id
+            self._mqpush(request)
+
+    def wake(self, delay):
+        """Asks the engine for the next request after delay seconds (other
+           workers may add requests to the frontier meanwhile)."""
+        engine = self.crawler.engine
+        if engine is not None and engine.slot is not None:
+            engine.slot.nextcall.schedule(max(delay, 0))
+
+    def checkpoint(self):
+        """Completes frontier requests, which the engine doesn't process
+           anymore (with their repeated requests)."""
+        if not self.active or self.crawler.engine is None \
+                or self.crawler.engine.slot is None:
+            return
+        inprogress = self.crawler.engine.slot.inprogress
+        finished = set(self.active.pop(request) for request in
+                       [request for request in self.active
+                        if request not in inprogress])
+        done = finished - set(self.active.itervalues()) \
+            - set(self.rows.itervalues())
+        if not done:
+            return
+        self.call(self.frontier.complete, done).addErrback(self.failed)
+        self.stats.inc_value('frontier/completed', len(done),
+                             spider=self.spider)
+        for fingerprint in [fingerprint for fingerprint, row_id
+                            in self.owned.iteritems() if row_id in done]:
+            del self.owned[fingerprint]
+
+    def renew(self):
+        """Prolongs leases of claimed requests.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when leases are renewed.
+        """
+        return self.call(self.frontier.renew, set(self.rows.itervalues())
+                         | set(self.active.itervalues())).addErrback(
+                             self.failed)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+# Scrapy settings for uaz project
+#
+# For simplicity, this file contains only the most important settings by
+# default. All the other settings are documented here:
+#
+#     http://doc.scrapy.org/en/latest/topics/settings.html
+#
+
+BOT_NAME = 'uaz'
+
+SPIDER_MODULES = ['uaz.spiders']
+NEWSPIDER_MODULE = 'uaz.spiders'
+COMMANDS_MODULE = 'uaz.commands'
+
+DOWNLOAD_DELAY = 6  # seconds between requests to a site through direct connection (requests through proxies of PROXY_PARAMS are delayed by PROXY_DOWNLOAD_DELAY of every proxy instead)
+RANDOMIZE_DOWNLOAD_DELAY = True
+
+CONCURRENT_REQUESTS = 2  # no use to set it above SELENIUM_POOL_SIZE multiplied by number of proxies
+CONCURRENT_SPIDERS = 1
+
+DATABASE = {
+    'drivername': 'postgres',
+    'host': '127.0.0.1',
+    'port': 5432,
+    'username': 'uazcrawl',
+    'password': 'removed',
+    'database': 'uazcrawl',
+}
+
+BENCH_DATABASE = dict(DATABASE, database='uaz_bench')
+
+DB_BATCH_SIZE = 50  # number of ads stored in database at once (1 - store every ad immediately)
+DB_BATCH_TIMEOUT = 30  # seconds between forced stores of incomplete batch (0 - wait for full batch)
+DB_SELLER_CACHE_SIZE = 10000  # number of sellers kept in memory (other references are kept entirely)
+DB_WRITE_THREADS = 2  # number of threads storing ads for UazAsyncDBPipeline
+DB_WRITE_QUEUE_SIZE = 1000  # UazAsyncDBPipeline pauses downloading if so many ads are waiting to be stored
+
+ITEM_PIPELINES = {
+    'uaz.pipelines.UazDBPipeline': 100,  # stores received data in postgresql database ('uaz.pipelines.UazAsyncDBPipeline' - in worker threads)
+    'uaz.pipelines.UazExcelPipeline': 200,  # prints received data in excel file
+}
+
+DOWNLOADER_MIDDLEWARES = {
+    'uaz.middlewares.KnownAdvertisementMiddleware': 50,  # skips ads stored in database previously
+}
+
+SPIDER_MIDDLEWARES = {
+    'uaz.middlewares.IncrementalCrawlMiddleware': 600,  # stops pagination at ads seen previously
+}
+
+DOWNLOAD_HANDLERS = {  # SeleniumDownloadHandler - render every page by browser; HybridDownloadHandler - plain http with browser's session, browser only for challenges; ProxyDownloadHandler - never use browser
+    'http': 'uaz.handlers.SeleniumDownloadHandler',
+    'https': 'uaz.handlers.SeleniumDownloadHandler',
+}
+
+HYBRID_CHALLENGE_STATUSES = [403, 429, 503]  # http responses with these statuses are rendered by browser
+HYBRID_CHALLENGE_MARKERS = [  # http responses containing any of these strings are rendered by browser
+    'jschl_vc', 'challenge-form', 'cf-browser-verification', 'ddos-guard',
+]
+
+XSESSION_VISIBLE = False  # False - run as daemon (works without running Xserver);
+                          # True - show virtual display in window (require running Xserver)
+XSESSION_DISPLAY_RESOLUTION = (800, 600)
+PROXY_PARAMS = 'relay:8123'  # our proxy server: polipo+tor (a list or comma separated addresses - pool of proxies, every one with its own browsers; None - direct connection)
+PROXY_DOWNLOAD_DELAY = 6  # seconds between requests through a proxy (randomized by RANDOMIZE_DOWNLOAD_DELAY)
+PROXY_MAX_FAILURES = 3  # failed downloads in a row before a proxy is cooled down
+PROXY_COOLDOWN = 300  # seconds without requests through a cooled down proxy (doubled for every next cooldown in a row, up to 16 times)
+PROXY_BAN_RETRY_TIMES = 2  # number of repeated downloads of a banned page through other proxies
+PROXY_BAN_STATUSES = [407, 429]  # pages with these statuses (after browser fallback of HybridDownloadHandler) look like a ban of the proxy
+PROXY_BAN_MARKERS = [  # pages containing any of these strings (after browser fallback of HybridDownloadHandler) look like a ban of the proxy
+    'g-recaptcha', 'h-captcha', 'cf-error-details',
+]
+SELENIUM_POOL_SIZE = 2  # number of webdriver instances of every proxy rendering pages in parallel
+SELENIUM_HEADLESS = True  # use native headless mode of firefox (56+) instead of xsession in virtual display
+SELENIUM_PROFILE_DIR = None  # pre-warmed firefox profile copied for every browser (created by the first browser if missing; None - new profile)
+SELENIUM_LEAN_PROFILE = True  # don't load images, fonts, plugins and blocked hosts, don't wait for full page load
+SELENIUM_BLOCKED_HOSTS = [  # ad and analytics domains (with subdomains) blocked by lean profile
+    'google-analytics.com', 'googletagmanager.com', 'googlesyndication.com',
+    'doubleclick.net', 'googleadservices.com', 'mc.yandex.ru', 'an.yandex.ru',
+    'adfox.ru', 'adriver.ru', 'begun.ru', 'top-fwz1.mail.ru',
+    'counter.yadro.ru', 'tns-counter.ru', 'facebook.net', 'criteo.com',
+]
+SELENIUM_WAIT_FOR = (  # page is rendered when all elements of any group are found (css selectors)
+    ('h1.title3', 'li[class*="cf_block_"]'),  # advertisement page
+    ('a.add_title',),  # listing page
+)
+SELENIUM_WAIT_TIMEOUT = 10  # max seconds of waiting for SELENIUM_WAIT_FOR elements
+SELENIUM_PAGE_LOAD_TIMEOUT = 60  # seconds before loading of a page is aborted (0 - wait forever)
+SELENIUM_SCRIPT_TIMEOUT = 30  # seconds before a script of a page is aborted (0 - wait forever)
+SELENIUM_RETRY_TIMES = 2  # number of repeated loads of a page after timeouts or browser crashes
+SELENIUM_RETRY_BACKOFF = 5  # seconds before the first repeated load, doubled for every next one
+SELENIUM_RESTART_PAGES = 500  # restart browser after so many pages (0 - never)
+SELENIUM_MAX_RSS = 1024  # restart browser if it takes more megabytes of memory (0 - no limit)
+
+TRACK_CHANGES = False  # record prices and last sightings of stored ads from listings, render ads with changed summary again (False - stored ads aren't updated from listings)
+
+KNOWN_ADS_ENABLED = True  # don't render pages of ads stored in database previously
+KNOWN_ADS_BLOOM_FILTER = False  # keep known ids in bloom filter instead of set (for large histories)
+KNOWN_ADS_BLOOM_CAPACITY = 1000000  # expected number of stored ads
+KNOWN_ADS_BLOOM_ERROR_RATE = 0.001  # share of new ads skipped as known ones by bloom filter
+
+PAGINATION_FANOUT = True  # request all pages of a listing from its first page at once (False - page by page)
+PAGINATION_MAX_PAGES = 0  # don't request pages of a listing beyond this number at once (0 - unlimited)
+
+INCREMENTAL_CRAWL = False  # stop following pagination on pages with only ads seen by the previous complete crawl (False - crawl whole listing, marks aren't recorded)
+
+SCHEDULER = 'uaz.scheduler.ResumableScheduler'  # keeps its queue and requests in progress in the journal of JOBDIR, so a stopped crawl resumes without losing them ('uaz.scheduler.FrontierScheduler' - sharded crawl by several workers from the frontier in DATABASE)
+JOBDIR = None  # directory of the crawl state (scheduler queue, seen requests, requests in progress, spider state); a crawl stopped by a crash or an outage resumes from it, the state is removed when the crawl is finished (None - every run starts over)
+FRONTIER_JOB = None  # name of the sharded crawl, workers with the same name share the frontier (None - spider name)
+FRONTIER_WORKER = None  # name of the worker in the frontier (None - hostname and pid)
+FRONTIER_LEASE = 600  # seconds before requests of a stopped worker are claimed by other workers
+FRONTIER_CLAIM_SIZE = 0  # requests claimed by the worker at once (0 - CONCURRENT_REQUESTS)
+FRONTIER_MAX_ATTEMPTS = 3  # claims of a request before it's abandoned (its worker stopped every time)
+
+HTTPCACHE_ENABLED = False  # keep pages rendered by browser on disk (served instead of downloading while fresh, re-parsed by "scrapy reparse")
+HTTPCACHE_STORAGE = 'uaz.httpcache.RenderedPageStorage'
+HTTPCACHE_DIR = 'httpcache'  # relative to .scrapy directory of the project
+HTTPCACHE_LISTING_EXPIRATION_SECS = 3600  # lifetime of cached listing pages (0 - never expire)
+HTTPCACHE_AD_EXPIRATION_SECS = 0  # lifetime of cached ad pages (0 - never expire)
+HTTPCACHE_MAX_SIZE = 2048  # cache size limit in megabytes, the oldest pages are removed (0 - unlimited)
+
+EXTENSIONS = {
+    'uaz.metrics.PrometheusExporter': 500,  # exports stats and latency histograms for prometheus
+}
+
+METRICS_PROMETHEUS_FILE = None  # path of prometheus text file with stats (e.g. for node_exporter; None - don't export)
+METRICS_EXPORT_INTERVAL = 60  # seconds between exports during the crawl (0 - only when spider is closed)
+
+XLS_FILENAME = "%Y%m%d%H%M%S"  # xls filename for excelpipeline (formats with datetime.strftime)
+XLS_SHEET_TITLE = u'УАЗ irr.ru'  # XLS spreadsheet title
+XLS_DATE_FORMAT = "D.M.YY"  # Date formatting in xls spreadsheet
+XLS_CHECKPOINT_ROWS = 0  # write xls file after every N new rows (0 - only when spider is closed)
+XLS_CHECKPOINT_TIMEOUT = 300  # write xls file with new rows every N seconds (0 - only when spider is closed)
+XLS_DATA_ORDER = (  # Columns in xls spreadsheet; format: (item's field name, title in header)
+                  (u'manufacturer', u'Производитель'),
+                  (u'model', u'Модель'),
+                  (u'modification', u'Модификация'),
+                  (u'release_year', u'Год выпуска'),
+                  (u'price', u'Стоимость, значение'),
+                  (u'currency', u'Стоимость, валюта'),
+                  (u'region', u'Регион'),
+                  (u'fuel', u'Тип топлива'),
+                  (u'mileage', u'Пробег, значение'),
+                  (u'mileage_units', u'Пробег, единицы'),
+                  (u'volume', u'Объем двигателя, значение'),
+                  (u'volume_units', u'Объем двигателя, единицы'),
+                  (u'horsepower', u'Мощность, л.с.'),
+                  (u'transmission', u'Трансмиссия'),
+                  (u'published', u'Дата публикации'),
+                  (u'title', u'Заголовок'),
+                  (u'url', u'URL-адрес'),
+                  (u'ad_type', u'Тип объявления'),
+                  (u'source', u'Источник данных'),
+)
@@ -9,21 +9,25 @@
 
 """
 
+import re
+from urlparse import urljoin
+
+from lxml import etree
+
+from scrapy import Selector
 from scrapy.contrib.spiders import CrawlSpider, Rule
 from scrapy.contrib.linkextractors import LinkExtractor
 from scrapy.contrib.loader import ItemLoader
 from scrapy.contrib.loader.processor import TakeFirst, MapCompose, Identity
-from scrapy import Selector
-from scrapy.utils.project import get_project_settings
+from scrapy.http import Request
+from scrapy.selector.lxmldocument import LxmlDocument
 
-from selenium import webdriver
-from selenium.webdriver.common.proxy import Proxy, ProxyType
-
-from pyvirtualdisplay import Display
-
-from uaz.items import Advertisement
+from uaz.proxies import ProxyPool
+from uaz.extractor import XPathExtractor
+from uaz.metrics import timed
+from uaz.items import Advertisement, AdvertisementSummary
 from uaz.processor import only_digits, only_price, only_letters
-from uaz.processor import datetime_interpretation
+from uaz.processor import datetime_interpretation, DatetimeParser
 
 
 class IrrAdvertisementLoader(ItemLoader):
@@ -58,6 +62,7 @@ class IrrSpider(CrawlSpider):
     """
     name = 'irr'
     allowed_domains = ['irr.ru']
+    source = 'irr.ru'  # source of stored advertisements
     start_urls = [
         "http://irr.ru/cars/passenger/%D1%83%D0%B0%D0%B7/",
     ]
@@ -65,41 +70,242 @@ class IrrSpider(CrawlSpider):
         Rule(LinkExtractor(
             restrict_xpaths=['//ul[contains(@class, "same_adds_paging")]'
                              '/li[contains(@class, "current")]'
-                             '/following-sibling::li/a']), follow=True),
+                             '/following-sibling::li/a']),
+            'parse_listing', follow=True),
         Rule(LinkExtractor(
             restrict_xpaths=['//a[contains(@class, "add_title")]']),
-            'parse_advertisement'),
+            'parse_advertisement', process_request='attach_summary'),
     ]
 
+    stats = None  # crawler stats, when the spider is bound to a crawler
+    pagination_fanout = True  # schedule all pages of a listing at once
+    pagination_max_pages = 0  # limit of scheduled pages (0 - unlimited)
+    track_changes = False  # summaries of ads are extracted from listings
+
+    advertisement_id_re = re.compile(r'advert(\d+)\.html')
+    page_url_re = re.compile(r'/page(\d+)/')
+
+    extractor = XPathExtractor(
+        (
+            ('foreign_id', 'div', 'grey_info',
+             'span[contains(@class, "number")]/text()'),
+            ('ad_type', 'div', 'grey_info',
+             'span[contains(@class, "partner")]/text()'),
+            ('published', 'div', 'grey_info',
+             'span[contains(@class, "data")]/text()'),
+            ('views', None, None, '//span[@id="advCountViewsButton"]/text()'),
+            ('title', 'h1', 'title3', 'text()'),
+            ('price', 'div', 'credit_cost', 'text()'),
+            ('currency', 'div', 'credit_cost', 'u/text()'),
+            ('seller', 'ul', 'form_info',
+             u'li/p[contains(text(), "Продавец")]/following-sibling::p'
+             u'/text()'),
+            ('seller_url', 'ul', 'form_info',
+             u'li/p[contains(text(), "Продавец")]/following-sibling::p'
+             u'/a/@href'),
+            ('description', 'div', 'content_left',
+             'p[contains(@class, "text")]/text()'),
+            ('region', 'a', 'address_link', 'text()'),
+            ('photos', 'div', 'slide', 'a/@href'),
+        ) + tuple(
+            (attr, 'li', 'cf_block_{0}'.format(elem_cls), 'p[2]/text()')
+            for attr, elem_cls in (
+                ('manufacturer', 'make'), ('model', 'model'),
+                ('modification', 'modification'), ('fuel', 'turbo'),
+                ('mileage', 'mileage'), ('mileage_units', 'mileage'),
+                ('volume', 'volume'), ('volume_units', 'volume'),
+                ('transmission', 'transmittion'),  # isn't a misprint
+                ('release_year', 'car-year'),
+                ('tech_condition', 'condition'),
+                ('body_type', 'bodytype'), ('horsepower', 'engine-power'),
+                ('gear', 'gear'),
+            )
+        )
+    )
+
+    # advertisement blocks of a listing page and their fields
+    listing_item_xpath = etree.XPath(
+        '//a[contains(@class, "add_title")]'
+        '/ancestor::div[contains(@class, "add_list")][1]')
+    listing_extractor = XPathExtractor((
+        ('url', 'a', 'add_title', '@href'),
+        ('title', 'a', 'add_title', 'text()'),
+        ('price', 'div', 'add_cost', 'text()'),
+        ('published', 'div', 'add_data', 'text()'),
+    ))
+
     def __init__(self, *args, **kwargs):
         """
-        Initializes spider. Starts xsession in virtual display and
-        webdriver instance in this xsession. If PROXY_PARAMS defined in
-        settings.py it'll specify proxy for webdriver instance.
+        Initializes spider. The pool of proxies with their webdriver
+        instances, which download pages for SeleniumDownloadHandler (and
+        HybridDownloadHandler, ProxyDownloadHandler), is created by crawler's
+        settings (see IrrSpider.set_crawler).
         """
         super(IrrSpider, self).__init__(*args, **kwargs)
-        settings = get_project_settings()
-        self.xsession = Display(
-            visible=settings.get('XSESSION_VISIBLE', False),
-            size=settings.get('XSESSION_DISPLAY_RESOLUTION', (800, 600)),
-        )
-        self.xsession.start()
-        proxy = settings.get('PROXY_PARAMS')
-        if proxy:
-            proxy = Proxy({
-                'proxyType': ProxyType.MANUAL,
-                'httpProxy': proxy,
-                'ftpProxy': proxy,
-                'sslProxy': proxy,
-                'noProxy': proxy,
-            })
-        self.browser = webdriver.Firefox(proxy=proxy)
-        self.browser.maximize_window()
+        self.browsers = None
+        self.datetime_parser = None
+        self.listing_summaries = {}
+
+    def set_crawler(self, crawler):
+        """Binds the spider to a crawler. Creates the pool of proxies and
+           browsers by crawler's settings (browsers are started by the first
+           download, not here). Requests through proxies are delayed by every
+           proxy (PROXY_DOWNLOAD_DELAY), so DOWNLOAD_DELAY is applied only to
+           direct connection. Fallbacks of the datetime parser of the spider
+           and latencies of rendering and parsing are counted in crawler's
+           stats."""
+        super(IrrSpider, self).set_crawler(crawler)
+        self.browsers = ProxyPool(crawler.settings)
+        if any(slot.address for slot in self.browsers.slots):
+            self.download_delay = 0
+        self.stats = self.browsers.stats = crawler.stats
+        self.datetime_parser = DatetimeParser(stats=crawler.stats)
+        self.pagination_fanout = crawler.settings.getbool(
+            'PAGINATION_FANOUT', True)
+        self.pagination_max_pages = crawler.settings.getint(
+            'PAGINATION_MAX_PAGES', 0)
+        self.track_changes = crawler.settings.getbool('TRACK_CHANGES', False)
 
     def closed(self, *args, **kwargs):
-        """Spider closing callback. Stops webdriver instance and xsession."""
-        self.browser.close()
-        self.xsession.stop()
+        """Spider closing callback. Stops webdriver instances and xsession."""
+        if self.browsers is not None:
+            self.browsers.stop()
+
+    @classmethod
+    def foreign_id_from_url(cls, url):
+        """Extracts an advertisement id from url of its page.
+
+        Args:
+            url (unicode or str): advertisement page url.
+
+        Returns:
+            int: advertisement id on irr.ru.
+            None: if url doesn't lead to an advertisement page.
+        """
+        match = cls.advertisement_id_re.search(url)
+        return int(match.group(1)) if match else None
+
+    def parse_start_url(self, response):
+        """Processing of the first page of a listing: with PAGINATION_FANOUT
+           all other pages of the listing are requested at once, so they are
+           rendered concurrently (instead of following the pagination page
+           by page).
+
+        Args:
+            response (scrapy.http.Response): the first page of a listing.
+
+        Returns:
+            list: requests of listing pages and summaries of advertisements.
+        """
+        result = self.parse_listing(response)
+        if not self.pagination_fanout:
+            return result
+        requests = self.pagination_requests(response,
+                                            self.pagination_max_pages)
+        if self.stats is not None:
+            self.stats.inc_value('pagination/fanout', len(requests))
+        return requests + result
+
+    def parse_listing(self, response):
+        """Processing of a listing page. With TRACK_CHANGES summaries of
+           advertisements are extracted, they are attached to requests of
+           advertisement pages (see IrrSpider.attach_summary).
+
+        Args:
+            response (scrapy.http.Response): listing page.
+
+        Returns:
+            list: uaz.items.AdvertisementSummary instances.
+        """
+        if not self.track_changes:
+            return []
+        summaries = self.load_summaries(
+            response, datetime_parser=self.datetime_parser)
+        for summary in summaries:
+            self.listing_summaries[summary['foreign_id']] = (
+                summary.get('price'), summary.get('published'))
+        return summaries
+
+    def attach_summary(self, request):
+        """Puts summary of an advertisement from the listing page (price and
+           publication date) into meta of the request of its page, so
+           KnownAdvertisementMiddleware renders changed advertisements only.
+
+        Args:
+            request (scrapy.http.Request): request of advertisement page.
+
+        Returns:
+            scrapy.http.Request: the request.
+        """
+        summary = self.listing_summaries.pop(
+            self.foreign_id_from_url(request.url), None)
+        if summary is not None:
+            request.meta['summary'] = summary
+        return request
+
+    @classmethod
+    def load_summaries(cls, response, **context):
+        """Extracts summaries of advertisements from a listing page.
+
+        Args:
+            response (scrapy.http.Response): listing page.
+
+        Kwargs:
+            context: context of the item loader (see
+                     uaz.processor.datetime_interpretation).
+
+        Returns:
+            list: uaz.items.AdvertisementSummary instances with foreign_id.
+        """
+        summaries = []
+        for node in cls.listing_item_xpath(LxmlDocument(response)):
+            summary = IrrAdvertisementLoader(AdvertisementSummary(),
+                                             **context)
+            summary.add_value('source', cls.source)
+            for field, values in cls.listing_extractor.extract_node(node):
+                if field == 'url':
+                    values = [urljoin(response.url, url) for url in values]
+                summary.add_value(field, values)
+            summary = summary.load_item()
+            foreign_id = cls.foreign_id_from_url(summary.get('url', ''))
+            if foreign_id is not None:
+                summary['foreign_id'] = foreign_id
+                summaries.append(summary)
+        return summaries
+
+    @classmethod
+    def pagination_requests(cls, response, max_pages=0):
+        """Creates requests of pages of a listing from 2 to the last one in
+           the paging block. Earlier pages get higher priority (every page
+           is above advertisements). If the paging block doesn't show the
+           last page, the rest is found by the pagination rule.
+
+        Args:
+            response (scrapy.http.Response): the first page of a listing.
+
+        Kwargs:
+            max_pages (int): limit of the page number (0 - unlimited).
+
+        Returns:
+            list: requests with the page number in meta.
+        """
+        pages = []
+        for href in Selector(response).xpath(
+                '//ul[contains(@class, "same_adds_paging")]/li/a/@href') \
+                .extract():
+            match = cls.page_url_re.search(href)
+            if match:
+                pages.append((int(match.group(1)), urljoin(response.url,
+                                                           href)))
+        if not pages:
+            return []
+        last, template = max(pages)
+        if max_pages:
+            last = min(last, max_pages)
+        return [Request(cls.page_url_re.sub('/page{0}/'.format(page),
+                                            template, 1),
+                        priority=last - page + 1, meta={'page': page})
+                for page in xrange(2, last + 1)]
 
     def parse_advertisement(self, response):
         """Processing of one page with an advertisement data.
@@ -112,41 +318,28 @@ class IrrSpider(CrawlSpider):
             uaz.items.Advertisement: extracted advertisement data like an item.
         """
         self.log(u'Scraping ad from {0}'.format(response.url))
-        hxs = Selector(response)
-        ad = IrrAdvertisementLoader(Advertisement(), hxs)
-        ad.add_value('source', self.allowed_domains[0])
+        with timed(self.stats, 'parse'):
+            return self.load_advertisement(
+                response, datetime_parser=self.datetime_parser)
+
+    @classmethod
+    def load_advertisement(cls, response, **context):
+        """Extracts advertisement data from a page. Doesn't need spider
+           instance (and browser), so it's used to re-parse stored pages too.
+
+        Args:
+            response (scrapy.http.Response): page with an advertisement.
+
+        Kwargs:
+            context: context of the item loader (see
+                     uaz.processor.datetime_interpretation).
+
+        Returns:
+            uaz.items.Advertisement: extracted advertisement data like an item.
+        """
+        ad = IrrAdvertisementLoader(Advertisement(), **context)
+        ad.add_value('source', cls.source)
         ad.add_value('url', response.url)
-        ad.add_xpath('foreign_id', '//div[contains(@class, "grey_info")]'
-                     '/span[contains(@class, "number")]/text()')
-        ad.add_xpath('title', '//h1[contains(@class, "title3")]/text()')
-        ad.add_xpath('views', '//span[@id="advCountViewsButton"]/text()')
-        ad.add_xpath('price', '//div[contains(@class, "credit_cost")]/text()')
-        ad.add_xpath('currency', '//div[contains(@class, "credit_cost")]'
-                     '/u/text()')
-        ad.add_xpath('ad_type', '//div[contains(@class, "grey_info")]'
-                     '/span[contains(@class, "partner")]/text()')
-        ad.add_xpath('seller', u'//ul[contains(@class, "form_info")]'
-                     u'/li/p[contains(text(), "Продавец")]'
-                     u'/following-sibling::p/text()')
-        ad.add_xpath('seller_url', u'//ul[contains(@class, "form_info")]'
-                     u'/li/p[contains(text(), "Продавец")]'
-                     u'/following-sibling::p/a/@href')
-        ad.add_xpath('published', '//div[contains(@class, "grey_info")]'
-                     '/span[contains(@class, "data")]/text()')
-        ad.add_xpath('description', '//div[contains(@class, "content_left")]'
-                     '/p[contains(@class, "text")]/text()')
-        ad.add_xpath('region', '//a[contains(@class, "address_link")]/text()')
-        for attr, elem_cls in (
-            ('manufacturer', 'make'), ('model', 'model'),
-            ('modification', 'modification'), ('fuel', 'turbo'),
-            ('mileage', 'mileage'), ('mileage_units', 'mileage'),
-            ('volume', 'volume'), ('volume_units', 'volume'),
-            ('transmission', 'transmittion'),  # "transmittion" isn't a misprint
-            ('release_year', 'car-year'), ('tech_condition', 'condition'),
-            ('body_type', 'bodytype'), ('horsepower', 'engine-power'),
-            ('gear', 'gear'),
-        ):
-            ad.add_xpath(attr, '//li[contains(@class, "cf_block_{0}")]'
-                         '/p[2]/text()'.format(elem_cls))
-        ad.add_xpath('photos', '//div[contains(@class, "slide")]/a/@href')
+        for field, values in cls.extractor.extract(response):
+            ad.add_value(field, values)
         return ad.load_item()
@@ -4,6 +4,18 @@ import unittest
 
 from uaz.tests.test_processor import *
 from uaz.tests.test_irr import *
+from uaz.tests.test_middlewares import *
+from uaz.tests.test_pipelines import *
+from uaz.tests.test_httpcache import *
+from uaz.tests.test_reparse import *
+from uaz.tests.test_extractor import *
+from uaz.tests.test_benchmarks import *
+from uaz.tests.test_metrics import *
+from uaz.tests.test_browser import *
+from uaz.tests.test_handlers import *
+from uaz.tests.test_proxies import *
+from uaz.tests.test_scheduler import *
+from uaz.tests.test_models import *
 
 if __name__ == '__main__':
     unittest.main()
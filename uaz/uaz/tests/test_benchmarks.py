@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_benchmarks
+   :platform: Unix
+   :synopsis: Testing of helpers of the benchmark suite
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import sys
+import unittest
+from cStringIO import StringIO
+from urlparse import urlparse
+
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+
+from uaz.benchmarks.replay import SyntheticSite
+from uaz.benchmarks.suite import Stage, synthetic_pages, FIRST_FOREIGN_ID
+from uaz.benchmarks.suite import SyntheticSpider, bench_database
+from uaz.spiders.irr_spider import IrrSpider
+
+
+class BenchmarkSuiteTestCase(unittest.TestCase):
+
+    def test_synthetic_pages(self):
+        ids = [IrrSpider.load_advertisement(HtmlResponse(url, body=body))
+               ['foreign_id'] for url, body in synthetic_pages(3)]
+        self.assertEqual(ids, range(FIRST_FOREIGN_ID, FIRST_FOREIGN_ID + 3))
+
+    def test_synthetic_source(self):
+        url, body = synthetic_pages(1)[0]
+        ad = SyntheticSpider.load_advertisement(HtmlResponse(url, body=body))
+        self.assertEqual(ad['source'], SyntheticSpider.source)
+        self.assertNotEqual(SyntheticSpider.source, IrrSpider.source)
+        self.assertFalse(set(SyntheticSpider.start_urls) &
+                         set(IrrSpider.start_urls))
+
+    def test_bench_database(self):
+        database = {'host': 'localhost', 'port': 5432, 'database': 'uaz'}
+        scratch = dict(database, database='uaz_bench')
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.assertIsNone(bench_database(Settings({
+                'DATABASE': database, 'BENCH_DATABASE': None})))
+            self.assertIsNone(bench_database(Settings({
+                'DATABASE': database, 'BENCH_DATABASE': dict(database)})))
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(bench_database(Settings({
+            'DATABASE': database, 'BENCH_DATABASE': scratch})), scratch)
+
+    def test_stage_report(self):
+        stage = Stage('test', 'item')
+        stage.latencies = [0.001 * num for num in xrange(1, 101)]
+        stage.items = 200
+        report = stage.report()
+        self.assertAlmostEqual(report['p50_ms'], 51)
+        self.assertAlmostEqual(report['p99_ms'], 100)
+        self.assertAlmostEqual(report['items_per_sec'], 200 / 5.05)
+
+    def test_synthetic_site(self):
+        site = SyntheticSite(5, per_page=3)
+        status, body = site.page('/cars/passenger/uaz/page2/')
+        listing = HtmlResponse('http://irr.ru/cars/passenger/uaz/page2/',
+                               body=body)
+        self.assertEqual(status, 200)
+        self.assertEqual([request.url for request in
+                          IrrSpider.pagination_requests(listing)],
+                         ['http://irr.ru/cars/passenger/uaz/page2/'])
+        summaries = IrrSpider.load_summaries(listing)
+        self.assertEqual([summary['foreign_id'] for summary in summaries],
+                         [FIRST_FOREIGN_ID + 1, FIRST_FOREIGN_ID])
+        status, body = site.page(urlparse(summaries[0]['url']).path)
+        ad = IrrSpider.load_advertisement(HtmlResponse(summaries[0]['url'],
+                                                       body=body))
+        self.assertEqual(status, 200)
+        for field in ('foreign_id', 'price', 'published'):
+            self.assertEqual(ad[field], summaries[0][field])
+        self.assertEqual(site.page('/cars/passenger/uaz/page3/')[0], 404)
+        self.assertEqual(site.served, {'listing': 1, 'advertisement': 1,
+                                       'missing': 1})
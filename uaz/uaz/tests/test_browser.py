@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_browser
+   :platform: Unix
+   :synopsis: Testing of page loading helpers from "browser" module
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import unittest
+from base64 import b64decode
+from threading import Event, Lock
+from time import sleep, time
+
+from twisted.internet import reactor
+
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+from uaz.browser import BrowserPool, proxy_autoconfig
+
+
+class BrowserStub(object):
+    """Browser, which renders the page in a few attempts."""
+
+    def __init__(self, elements, attempts=3):
+        self.elements = elements
+        self.attempts = attempts
+        self.current_url = None
+        self.page_source = u'<html></html>'
+
+    def get(self, url):
+        self.current_url = url
+
+    def find_elements_by_css_selector(self, css):
+        self.attempts -= 1
+        return [css] if self.attempts <= 0 and css in self.elements else []
+
+    def quit(self):
+        pass
+
+
+class FailingBrowserStub(BrowserStub):
+    """Browser, which fails to load pages."""
+
+    def __init__(self, error):
+        super(FailingBrowserStub, self).__init__([])
+        self.error = error
+        self.loads = 0
+
+    def get(self, url):
+        self.loads += 1
+        raise self.error
+
+
+class BlockingBrowserStub(BrowserStub):
+    """Browser, which loads pages until the gate is opened."""
+
+    def __init__(self, gate):
+        super(BlockingBrowserStub, self).__init__([])
+        self.gate = gate
+
+    def get(self, url):
+        self.current_url = url
+        self.gate.enter()
+
+
+class Gate(object):
+    """Holds loading browsers, counts pages loaded at the same time."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.opened = Event()
+        self.loading = 0
+        self.max_loading = 0
+
+    def enter(self):
+        with self.lock:
+            self.loading += 1
+            self.max_loading = max(self.max_loading, self.loading)
+        self.opened.wait(5)
+        with self.lock:
+            self.loading -= 1
+
+
+def wait_until(condition, timeout=5):
+    """Runs the reactor until the condition is met (results of worker
+       threads are delivered by the reactor)."""
+    deadline = time() + timeout
+    while not condition() and time() < deadline:
+        reactor.iterate(0.01)
+    return condition()
+
+
+class XsessionStub(object):
+
+    def is_alive(self):
+        return True
+
+    def stop(self):
+        pass
+
+
+class BrowserPoolStub(BrowserPool):
+    """Pool of stub browsers, which are created in specified order."""
+
+    def __init__(self, browsers, **settings):
+        self.created = list(browsers)
+        settings.setdefault('SELENIUM_RETRY_BACKOFF', 0)
+        super(BrowserPoolStub, self).__init__(Settings(settings))
+        self.stats = get_crawler().stats
+
+    def create_xsession(self):
+        return XsessionStub()
+
+    def create_browser(self):
+        return self.created.pop(0)
+
+
+class BrowserPoolTestCase(unittest.TestCase):
+    URL = 'http://irr.ru/cars/passenger/UAZ-advert241452769.html'
+    WAIT_FOR = (('h1.title3', 'li.cf_block_make'), ('a.add_title',))
+
+    def test_wait_for_elements(self):
+        stats = get_crawler().stats
+        browser = BrowserStub(['h1.title3', 'li.cf_block_make'])
+        self.assertEqual(
+            BrowserPool.load_page(browser, self.URL, stats, self.WAIT_FOR, 5),
+            (self.URL, u'<html></html>'))
+        self.assertLessEqual(browser.attempts, 0)
+        self.assertIsNone(stats.get_value('download/wait_timeout'))
+
+    def test_wait_timeout(self):
+        stats = get_crawler().stats
+        BrowserPool.load_page(BrowserStub(['h1.title3']), self.URL, stats,
+                              self.WAIT_FOR, 0.2)
+        self.assertEqual(stats.get_value('download/wait_timeout'), 1)
+
+    def test_proxy_autoconfig(self):
+        url = proxy_autoconfig('relay:8123', ['mc.yandex.ru'])
+        script = b64decode(url.split(',', 1)[1])
+        self.assertIn('var blocked = ["mc.yandex.ru"];', script)
+        self.assertIn("return 'PROXY relay:8123';", script)
+        self.assertIn("return 'DIRECT';", b64decode(
+            proxy_autoconfig(None, []).split(',', 1)[1]))
+
+    def test_lazy_start(self):
+        pool = BrowserPoolStub([BrowserStub([])])
+        self.assertEqual(pool.browsers, [None])
+        self.assertIsNone(pool.xsession)
+        try:
+            pool.fetch(0, self.URL)
+            self.assertIsInstance(pool.browsers[0], BrowserStub)
+        finally:
+            pool.stop()
+        self.assertEqual(pool.stats.get_value('browser/starts'), 1)
+        BrowserPoolStub([]).stop()
+
+    def test_restart_after_crash(self):
+        crashed = FailingBrowserStub(WebDriverException())
+        pool = BrowserPoolStub([crashed, BrowserStub([])],
+                               SELENIUM_RETRY_TIMES=1)
+        try:
+            self.assertEqual(pool.fetch(0, self.URL)[0], self.URL)
+        finally:
+            pool.stop()
+        self.assertEqual(pool.stats.get_value('browser/restarts/crash'), 1)
+        self.assertEqual(pool.stats.get_value('browser/retries'), 1)
+
+    def test_retries_exhausted(self):
+        hung = FailingBrowserStub(TimeoutException())
+        pool = BrowserPoolStub([hung], SELENIUM_RETRY_TIMES=2)
+        try:
+            self.assertRaises(TimeoutException, pool.fetch, 0, self.URL)
+        finally:
+            pool.stop()
+        self.assertEqual(hung.loads, 3)
+        self.assertEqual(pool.stats.get_value('browser/timeouts'), 3)
+        self.assertIsNone(pool.stats.get_value('browser/restarts'))
+
+    def test_restart_after_pages(self):
+        second = BrowserStub([])
+        pool = BrowserPoolStub([BrowserStub([]), second],
+                               SELENIUM_RESTART_PAGES=2)
+        try:
+            for _ in xrange(3):
+                pool.fetch(0, self.URL)
+            self.assertIs(pool.browsers[0], second)
+        finally:
+            pool.stop()
+        self.assertEqual(pool.pages[0], 1)
+        self.assertEqual(pool.stats.get_value('browser/restarts/pages'), 1)
+
+    def test_render_concurrency(self):
+        gate = Gate()
+        pool = BrowserPoolStub([BlockingBrowserStub(gate),
+                                BlockingBrowserStub(gate)],
+                               SELENIUM_POOL_SIZE=2)
+        results = []
+        try:
+            for num in xrange(3):
+                pool.render('{0}?{1}'.format(self.URL, num)).addBoth(
+                    results.append)
+            deadline = time() + 5
+            while gate.loading < 2 and time() < deadline:
+                sleep(0.01)
+            # both browsers are busy, the third page waits for one of them
+            self.assertEqual(gate.loading, 2)
+            self.assertEqual(pool.idle.pending, [])
+            self.assertEqual(len(pool.idle.waiting), 1)
+            gate.opened.set()
+            self.assertTrue(wait_until(lambda: len(results) == 3))
+        finally:
+            gate.opened.set()
+            pool.stop()
+        self.assertEqual(gate.max_loading, 2)
+        self.assertEqual(sorted(url for url, source in results),
+                         ['{0}?{1}'.format(self.URL, num)
+                          for num in xrange(3)])
+        self.assertEqual(sorted(pool.idle.pending), [0, 1])
+
+    def test_released_after_failure(self):
+        pool = BrowserPoolStub([FailingBrowserStub(WebDriverException()),
+                                BrowserStub([])])
+        results = []
+        try:
+            for _ in xrange(2):
+                pool.render(self.URL).addBoth(results.append)
+            self.assertTrue(wait_until(lambda: len(results) == 2))
+        finally:
+            pool.stop()
+        self.assertTrue(results[0].check(WebDriverException))
+        self.assertEqual(results[1][0], self.URL)
+        self.assertEqual(pool.idle.pending, [0])
+        self.assertEqual(pool.stats.get_value('browser/restarts/crash'), 1)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_extractor
+   :platform: Unix
+   :synopsis: Testing of field extraction by "extractor" module
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+from scrapy.http import HtmlResponse
+
+from uaz.benchmarks.parse import load_advertisement_by_queries
+from uaz.extractor import XPathExtractor
+from uaz.spiders.irr_spider import IrrSpider
+
+from .spider_testcase import SpiderTestCase
+
+
+class XPathExtractorTestCase(SpiderTestCase):
+
+    def test_relative_to_containers(self):
+        extractor = XPathExtractor((
+            ('title', 'div', 'head', 'h1/text()'),
+            ('tags', 'li', 'tag_', 'text()'),
+            ('missing', 'div', 'absent', 'text()'),
+        ))
+        response = HtmlResponse('http://irr.ru/', body=(
+            '<div class="head clear"><h1>UAZ</h1></div><h1>other</h1>'
+            '<ul><li class="tag_a">a</li><li>b</li><li class="tag_c">c</li>'
+            '</ul>'))
+        self.assertEqual(dict(extractor.extract(response)), {
+            'title': [u'UAZ'], 'tags': [u'a', u'c'], 'missing': []})
+
+    def test_relative_to_root(self):
+        extractor = XPathExtractor((
+            ('title', 'div', 'head', 'h1/text()'),
+            ('views', None, None, '//span[@id="views"]/text()'),
+        ))
+        response = HtmlResponse('http://irr.ru/', body=(
+            '<div class="head"><h1>UAZ</h1></div>'
+            '<div class="info"><span id="views">75</span></div>'))
+        self.assertEqual(dict(extractor.extract(response)), {
+            'title': [u'UAZ'], 'views': [u'75']})
+
+    def test_views_outside_info_block(self):
+        response = HtmlResponse('http://irr.ru/', body=(
+            '<div class="grey_info"></div>'
+            '<div class="counter"><span id="advCountViewsButton">75</span>'
+            '</div>'))
+        self.assertEqual(IrrSpider.load_advertisement(response)['views'], 75)
+
+    def test_same_as_per_field_queries(self):
+        response = self.response_from_file(
+            'sample1.html', 'http://irr.ru/cars/passenger/UAZ-3163-Patriot-'
+            '3163-2013-g-v-advert241452769.html')
+        self.assertEqual(dict(IrrSpider.load_advertisement(response)),
+                         dict(load_advertisement_by_queries(response)))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_handlers
+   :platform: Unix
+   :synopsis: Testing of download handlers from "handlers" module
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import unittest
+
+from twisted.internet import defer
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+from scrapy.statscol import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+
+from uaz.handlers import HybridDownloadHandler
+from uaz.proxies import ProxyPool
+
+
+AD_PAGE = '<html><body><h1 class="title3">UAZ</h1>' \
+          '<ul><li class="cf_block_make">UAZ</li></ul></body></html>'
+CHALLENGE_PAGE = '<html><body><form id="challenge-form">' \
+                 '<input name="jschl_vc"></form></body></html>'
+
+
+class BrowserPoolStub(object):
+    size = 1
+
+    def __init__(self):
+        self.urls = []
+
+    def render(self, url, session=False):
+        self.urls.append(url)
+        return defer.succeed((url, AD_PAGE.decode('utf-8'), {
+            'cookies': [{'name': 'sid', 'value': '42', 'domain': '.irr.ru'},
+                        {'name': 'other', 'value': '1',
+                         'domain': 'example.com'}],
+            'user_agent': 'Firefox',
+        }))
+
+
+class HttpHandlerStub(object):
+
+    def __init__(self, body, status=200):
+        self.body = body
+        self.status = status
+        self.requests = []
+
+    def download_request(self, request, spider):
+        self.requests.append(request)
+        return defer.succeed(HtmlResponse(request.url, status=self.status,
+                                          body=self.body))
+
+
+class SpiderStub(object):
+
+    def __init__(self):
+        self.browsers = ProxyPool(Settings({'PROXY_PARAMS': 'relay:8123'}))
+        self.rendered = self.browsers.slots[0].browsers = BrowserPoolStub()
+        self.stats = MemoryStatsCollector(get_crawler())
+
+
+class HybridDownloadHandlerTestCase(unittest.TestCase):
+    URL = 'http://irr.ru/cars/passenger/UAZ-advert241452769.html'
+
+    def setUp(self):
+        self.spider = SpiderStub()
+        self.handler = HybridDownloadHandler(Settings({
+            'SELENIUM_WAIT_FOR': (('h1.title3', 'li[class*="cf_block_"]'),),
+            'HYBRID_CHALLENGE_STATUSES': [503],
+            'HYBRID_CHALLENGE_MARKERS': ['jschl_vc'],
+        }))
+
+    def download(self, http):
+        self.handler.http = http
+        responses = []
+        self.handler.download_request(Request(self.URL), self.spider) \
+            .addCallback(responses.append)
+        return responses[0]
+
+    def test_session(self):
+        http = HttpHandlerStub(AD_PAGE)
+        self.download(http)
+        self.assertEqual(len(self.spider.rendered.urls), 1)
+        self.assertEqual(http.requests, [])
+        response = self.download(http)
+        self.assertEqual(response.body, AD_PAGE)
+        self.assertEqual(len(self.spider.rendered.urls), 1)
+        request = http.requests[0]
+        self.assertEqual(request.headers['Cookie'], 'sid=42')
+        self.assertEqual(request.headers['User-Agent'], 'Firefox')
+        self.assertEqual(request.meta['proxy'], 'http://relay:8123')
+        self.assertEqual(self.spider.stats.get_value('hybrid/http_pages'), 1)
+
+    def test_fallback(self):
+        self.download(HttpHandlerStub(AD_PAGE))
+        for http in (HttpHandlerStub(CHALLENGE_PAGE),
+                     HttpHandlerStub(AD_PAGE, 503),
+                     HttpHandlerStub('<html><body></body></html>')):
+            response = self.download(http)
+            self.assertEqual(len(http.requests), 1)
+            self.assertEqual(response.body, AD_PAGE)
+        self.assertEqual(len(self.spider.rendered.urls), 4)
+        stats = self.spider.stats
+        self.assertEqual(stats.get_value('hybrid/browser_fallbacks'), 3)
+        self.assertEqual(
+            stats.get_value('hybrid/browser_fallbacks/challenge'), 2)
+        self.assertEqual(stats.get_value('hybrid/browser_fallbacks/markup'),
+                         1)
+        self.assertEqual(stats.get_value('hybrid/http_pages'), None)
+
+    def test_not_found(self):
+        self.download(HttpHandlerStub(''))
+        response = self.download(HttpHandlerStub('', 404))
+        self.assertEqual(response.status, 404)
+        self.assertEqual(len(self.spider.rendered.urls), 1)
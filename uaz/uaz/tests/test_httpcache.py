@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_httpcache
+   :platform: Unix
+   :synopsis: Testing of rendered pages storage from "httpcache" module
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from time import time
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+
+from uaz.httpcache import RenderedPageStorage
+
+from .spider_testcase import SpiderTestCase
+from .test_middlewares import SpiderStub
+
+
+class RenderedPageStorageTestCase(SpiderTestCase):
+    LISTING_URL = 'http://irr.ru/cars/passenger/uaz/'
+    AD_URL = 'http://irr.ru/cars/passenger/UAZ-advert241452769.html'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spider = SpiderStub()
+        self.spider.name = 'irr'
+        self.storage = RenderedPageStorage(Settings({
+            'HTTPCACHE_DIR': self.directory,
+            'HTTPCACHE_LISTING_EXPIRATION_SECS': 60,
+            'HTTPCACHE_AD_EXPIRATION_SECS': 3600,
+            'HYBRID_CHALLENGE_MARKERS': ['jschl_vc'],
+            'PROXY_BAN_MARKERS': ['g-recaptcha'],
+        }))
+        self.storage.open_spider(self.spider)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, url, age=0):
+        response = self.response_from_file('sample1.html', url)
+        self.storage.store_response(self.spider, response.request, response)
+        path = self.storage.page_path(self.spider, url)
+        os.utime(path, (time() - age, time() - age))
+        return response
+
+    def test_retrieve(self):
+        response = self.store(self.AD_URL)
+        cached = self.storage.retrieve_response(self.spider,
+                                                Request(self.AD_URL))
+        self.assertEqual(cached.url, response.url)
+        self.assertEqual(cached.body, response.body)
+        self.assertLess(os.path.getsize(
+            self.storage.page_path(self.spider, self.AD_URL)),
+            len(response.body) / 2)
+
+    def test_status_and_headers(self):
+        response = HtmlResponse(self.AD_URL, status=200, body='<html></html>',
+                                headers={'Content-Type': 'text/html',
+                                         'Set-Cookie': ['a=1', 'b=2']})
+        self.storage.store_response(self.spider, Request(self.AD_URL),
+                                    response)
+        cached = self.storage.retrieve_response(self.spider,
+                                                Request(self.AD_URL))
+        self.assertEqual(cached.status, 200)
+        self.assertEqual(cached.headers['Content-Type'], 'text/html')
+        self.assertEqual(cached.headers.getlist('Set-Cookie'), ['a=1', 'b=2'])
+
+    def test_not_stored(self):
+        for status, body in ((404, '<html></html>'),
+                             (503, '<html></html>'),
+                             (200, '<form id="challenge-form">'
+                                   '<input name="jschl_vc"></form>'),
+                             (200, '<div class="g-recaptcha"></div>')):
+            self.storage.store_response(
+                self.spider, Request(self.AD_URL),
+                HtmlResponse(self.AD_URL, status=status, body=body))
+            self.assertIsNone(self.storage.retrieve_response(
+                self.spider, Request(self.AD_URL)))
+        self.assertEqual(self.storage.size, 0)
+
+    def test_missing(self):
+        self.assertIsNone(self.storage.retrieve_response(
+            self.spider, Request(self.AD_URL)))
+
+    def test_expiration(self):
+        self.store(self.AD_URL, age=600)
+        self.store(self.LISTING_URL, age=600)
+        self.assertIsNotNone(self.storage.retrieve_response(
+            self.spider, Request(self.AD_URL)))
+        self.assertIsNone(self.storage.retrieve_response(
+            self.spider, Request(self.LISTING_URL)))
+
+    def test_eviction(self):
+        self.store(self.LISTING_URL, age=600)
+        size = self.storage.size
+        self.storage.max_size = size * 1.5
+        self.store(self.AD_URL)
+        self.assertLessEqual(self.storage.size, self.storage.max_size)
+        self.assertFalse(os.path.exists(
+            self.storage.page_path(self.spider, self.LISTING_URL)))
+        self.assertTrue(os.path.exists(
+            self.storage.page_path(self.spider, self.AD_URL)))
+
+    def test_refresh(self):
+        self.store(self.AD_URL)
+        self.assertIsNone(self.storage.retrieve_response(
+            self.spider, Request(self.AD_URL, meta={'refresh_cache': True})))
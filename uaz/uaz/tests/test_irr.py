@@ -10,6 +10,10 @@
 
 from datetime import datetime
 
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from uaz.processor import datetime_parser
 from uaz.spiders.irr_spider import IrrSpider
 
 from .spider_testcase import SpiderTestCase
@@ -24,6 +28,27 @@ class IrrSpiderTestCase(SpiderTestCase):
         self.spider.closed()
         del self.spider
 
+    def test_download_delay(self):
+        self.spider.set_crawler(get_crawler({'PROXY_PARAMS': None}))
+        self.assertFalse(hasattr(self.spider, 'download_delay'))
+        spider = IrrSpider()
+        spider.set_crawler(get_crawler({'PROXY_PARAMS': 'relay:8123'}))
+        self.assertEqual(spider.download_delay, 0)
+
+    def test_datetime_fallbacks(self):
+        crawler = get_crawler({'PROXY_PARAMS': None})
+        self.spider.set_crawler(crawler)
+        response = self.response_from_file('sample1.html',
+                                           'http://irr.ru/sample1/')
+        response = response.replace(body=response.body.replace(
+            u'27 декабря 2013'.encode('utf-8'), b'December 15, 2013'))
+        ad = self.spider.parse_advertisement(response)
+        self.assertEqual(ad['published'], datetime(2013, 12, 15))
+        self.assertEqual(crawler.stats.get_value(
+            'datetime/dateutil_fallbacks'), 1)
+        # the shared parser isn't bound to the crawler
+        self.assertIsNone(datetime_parser.stats)
+
     def test_parse_advertisement(self):
         adurl = 'http://irr.ru/sample1/'
         ad = self.spider.parse_advertisement(
@@ -81,3 +106,69 @@ class IrrSpiderTestCase(SpiderTestCase):
                     value, ad.get(field),
                     u'unexpected value in field "{0}": {1} != {2}'.format(
                         field, value, ad.get(field)))
+
+
+class IrrPaginationTestCase(SpiderTestCase):
+    LISTING_URL = 'http://irr.ru/cars/passenger/uaz/'
+    LISTING = '<html><body><ul class="same_adds_paging">' \
+              '<li class="current"><a href="/cars/passenger/uaz/">1</a></li>' \
+              '<li><a href="/cars/passenger/uaz/page2/">2</a></li>' \
+              '<li><a href="/cars/passenger/uaz/page3/">3</a></li>' \
+              '<li>...</li>' \
+              '<li><a href="/cars/passenger/uaz/page6/">6</a></li>' \
+              '</ul></body></html>'
+
+    def listing(self, body):
+        return HtmlResponse(self.LISTING_URL, body=body,
+                            request=Request(self.LISTING_URL))
+
+    def test_pagination_requests(self):
+        requests = IrrSpider.pagination_requests(self.listing(self.LISTING))
+        self.assertEqual([request.url for request in requests], [
+            '{0}page{1}/'.format(self.LISTING_URL, page)
+            for page in xrange(2, 7)])
+        self.assertEqual([request.meta['page'] for request in requests],
+                         range(2, 7))
+        self.assertEqual([request.priority for request in requests],
+                         range(5, 0, -1))
+
+    def test_pagination_limit(self):
+        requests = IrrSpider.pagination_requests(self.listing(self.LISTING),
+                                                 max_pages=3)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(IrrSpider.pagination_requests(
+            self.listing('<html><body></body></html>')), [])
+
+
+class IrrListingTestCase(SpiderTestCase):
+    LISTING_URL = 'http://irr.ru/cars/passenger/uaz/'
+    LISTING = u'<html><body>' \
+              u'<div class="add_list add_type4">' \
+              u'<a class="add_title" href="/cars/passenger/UAZ-' \
+              u'advert241452769.html">УАЗ 3163 Patriot</a>' \
+              u'<div class="add_cost">559 989 руб.</div>' \
+              u'<div class="add_data">27 декабря 2013</div></div>' \
+              u'<div class="add_list">' \
+              u'<a class="add_title" href="/cars/passenger/UAZ-' \
+              u'advert241452770.html">УАЗ Hunter</a></div>' \
+              u'<div class="add_list">' \
+              u'<a class="add_title" href="/cars/">banner</a></div>' \
+              u'</body></html>'
+
+    def test_load_summaries(self):
+        summaries = IrrSpider.load_summaries(HtmlResponse(
+            self.LISTING_URL, body=self.LISTING.encode('utf-8'),
+            encoding='utf-8', request=Request(self.LISTING_URL)))
+        self.assertEqual([dict(summary) for summary in summaries], [{
+            'source': u'irr.ru',
+            'foreign_id': 241452769,
+            'url': u'http://irr.ru/cars/passenger/UAZ-advert241452769.html',
+            'title': u'УАЗ 3163 Patriot',
+            'price': 559989.0,
+            'published': datetime(2013, 12, 27),
+        }, {
+            'source': u'irr.ru',
+            'foreign_id': 241452770,
+            'url': u'http://irr.ru/cars/passenger/UAZ-advert241452770.html',
+            'title': u'УАЗ Hunter',
+        }])
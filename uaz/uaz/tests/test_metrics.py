@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_metrics
+   :platform: Unix
+   :synopsis: Testing of latency histograms and their export from "metrics"
+              module
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from scrapy.utils.test import get_crawler
+from twisted.internet.defer import Deferred
+
+from uaz.metrics import Histogram, PrometheusExporter
+from uaz.metrics import observe, timed, timed_deferred
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.crawler = get_crawler()
+        self.stats = self.crawler.stats
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.01, 0.1, 1))
+        for seconds in (0.005, 0.05, 0.05, 0.5, 5):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.cumulative(),
+                         [(0.01, 1), (0.1, 3), (1, 4), ('+Inf', 5)])
+        self.assertEqual(histogram.percentile(50), 0.1)
+        self.assertIsNone(histogram.percentile(99))
+
+    def test_hooks(self):
+        with timed(self.stats, 'parse'):
+            pass
+        deferred = timed_deferred(self.stats, 'db/item', Deferred())
+        deferred.callback(None)
+        observe(None, 'parse', 1)
+        self.assertEqual(self.stats.get_value('latency/parse').count, 1)
+        self.assertEqual(self.stats.get_value('latency/db/item').count, 1)
+
+    def test_prometheus_export(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'uaz.prom')
+            self.crawler.settings.set('METRICS_PROMETHEUS_FILE', filename)
+            exporter = PrometheusExporter.from_crawler(self.crawler)
+            observe(self.stats, 'download/page_load', 2)
+            self.stats.set_value('item_scraped_count', 3)
+            exporter.export()
+            with open(filename) as metrics:
+                lines = metrics.read().splitlines()
+        finally:
+            shutil.rmtree(directory)
+        for line in (
+            '# TYPE uaz_latency_seconds histogram',
+            'uaz_latency_seconds_bucket{stage="download/page_load",le="1"} 0',
+            'uaz_latency_seconds_bucket{stage="download/page_load",le="2.5"} 1',
+            'uaz_latency_seconds_count{stage="download/page_load"} 1',
+            'uaz_stat{name="item_scraped_count"} 3',
+        ):
+            self.assertIn(line, lines)
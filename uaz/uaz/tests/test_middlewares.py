@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_middlewares
+   :platform: Unix
+   :synopsis: Testing of custom middlewares from "middlewares" module
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import unittest
+from datetime import datetime
+
+from scrapy.http import Request, HtmlResponse
+from scrapy.exceptions import IgnoreRequest
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.test import get_crawler
+
+from uaz.items import Advertisement
+from uaz.middlewares import BloomFilter, KnownAdvertisementMiddleware
+from uaz.middlewares import IncrementalCrawlMiddleware, summary_key
+from uaz.models import CrawlMark, create_tables, db_connect
+from uaz.spiders.irr_spider import IrrSpider
+
+BENCH_DATABASE = get_project_settings().get('BENCH_DATABASE')
+
+
+class SpiderStub(object):
+    allowed_domains = IrrSpider.allowed_domains
+    source = IrrSpider.source
+    foreign_id_from_url = IrrSpider.foreign_id_from_url
+
+
+class KnownAdvertisementMiddlewareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.crawler = get_crawler()
+        self.spider = SpiderStub()
+        self.middleware = KnownAdvertisementMiddleware.from_crawler(
+            self.crawler)
+        self.middleware.known.add(241452769)
+
+    def test_foreign_id_from_url(self):
+        for url, result in (
+            ('http://irr.ru/cars/passenger/UAZ-3163-Patriot-3163-2013-g-v-'
+             'advert241452769.html', 241452769),
+            ('http://irr.ru/cars/passenger/uaz/page2/', None),
+        ):
+            self.assertEqual(IrrSpider.foreign_id_from_url(url), result)
+
+    def test_known_advertisement_skipped(self):
+        request = Request('http://irr.ru/cars/passenger/UAZ-3163-Patriot-'
+                          '3163-2013-g-v-advert241452769.html')
+        self.assertRaises(IgnoreRequest, self.middleware.process_request,
+                          request, self.spider)
+        self.assertEqual(
+            self.crawler.stats.get_value('known_ads/skipped'), 1)
+
+    def test_new_advertisement_passed(self):
+        for request in (
+            Request('http://irr.ru/cars/passenger/UAZ-advert241452770.html'),
+            Request('http://irr.ru/cars/passenger/uaz/page2/'),
+        ):
+            self.assertIsNone(
+                self.middleware.process_request(request, self.spider))
+        self.assertIsNone(self.crawler.stats.get_value('known_ads/skipped'))
+
+    def test_scraped_advertisement_remembered(self):
+        self.middleware.item_scraped({'foreign_id': 241452770}, self.spider)
+        self.assertIn(241452770, self.middleware.known)
+
+    def test_changed_advertisement_passed(self):
+        self.middleware.track_changes = True
+        published = datetime(2013, 12, 27, 15, 30)
+        self.middleware.summaries.add(
+            summary_key(241452769, 559989, published.replace(hour=0)))
+        url = 'http://irr.ru/cars/passenger/UAZ-advert241452769.html'
+        self.assertRaises(IgnoreRequest, self.middleware.process_request,
+                          Request(url, meta={'summary': (559989.0,
+                                                         published)}),
+                          self.spider)
+        changed = Request(url, meta={'summary': (499000.0, published)})
+        self.assertIsNone(self.middleware.process_request(changed,
+                                                          self.spider))
+        self.assertTrue(changed.meta.get('refresh_cache'))
+        self.assertEqual(
+            self.crawler.stats.get_value('known_ads/changed'), 1)
+
+
+class IncrementalCrawlMiddlewareTestCase(unittest.TestCase):
+    START_URL = 'http://irr.ru/cars/passenger/uaz/'
+
+    def setUp(self):
+        self.crawler = get_crawler({'INCREMENTAL_CRAWL': True})
+        self.spider = SpiderStub()
+        self.middleware = IncrementalCrawlMiddleware.from_crawler(
+            self.crawler)
+        self.middleware.marks[self.START_URL] = 241452769
+
+    def listing_output(self, *ids):
+        request = Request(self.START_URL + 'page2/',
+                          meta={'start_url': self.START_URL})
+        response = HtmlResponse(request.url, request=request, body='')
+        result = [Request('http://irr.ru/cars/passenger/UAZ-advert{0}.html'
+                          .format(foreign_id)) for foreign_id in ids]
+        result.append(Request(self.START_URL + 'page3/'))
+        return self.middleware.process_spider_output(
+            response, result, self.spider)
+
+    def test_start_url_propagated(self):
+        requests = list(self.middleware.process_start_requests(
+            [Request(self.START_URL)], self.spider))
+        self.assertEqual(requests[0].meta['start_url'], self.START_URL)
+        for request in self.listing_output(241452770):
+            self.assertEqual(request.meta['start_url'], self.START_URL)
+
+    def test_pagination_followed_with_new_ads(self):
+        output = self.listing_output(241452770, 241452700)
+        self.assertEqual(len(output), 3)
+        self.assertEqual(self.middleware.seen[self.START_URL], 241452770)
+
+    def test_pagination_stopped_with_old_ads(self):
+        output = self.listing_output(241452769, 241452700)
+        self.assertEqual([request.url for request in output], [
+            'http://irr.ru/cars/passenger/UAZ-advert241452769.html',
+            'http://irr.ru/cars/passenger/UAZ-advert241452700.html',
+        ])
+        self.assertEqual(self.crawler.stats.get_value(
+            'incremental/pagination_stopped'), 1)
+
+    def test_fanout_dropped_for_crawled_listing(self):
+        request = Request(self.START_URL, meta={'start_url': self.START_URL})
+        response = HtmlResponse(request.url, request=request, body='')
+        output = self.middleware.process_spider_output(response, [
+            Request('http://irr.ru/cars/passenger/UAZ-advert241452770.html'),
+            Request(self.START_URL + 'page2/'),
+            Request(self.START_URL + 'page2/', meta={'page': 2}),
+            Request(self.START_URL + 'page3/', meta={'page': 3}),
+        ], self.spider)
+        self.assertEqual([request.meta.get('page') for request in output],
+                         [None, None])
+        self.assertEqual(self.crawler.stats.get_value(
+            'incremental/fanout_dropped'), 2)
+        del self.middleware.marks[self.START_URL]
+        self.assertEqual(len(self.middleware.process_spider_output(
+            response, [Request(self.START_URL + 'page2/', meta={'page': 2})],
+            self.spider)), 1)
+
+    def test_items_passed(self):
+        request = Request('http://irr.ru/cars/passenger/UAZ-advert1.html',
+                          meta={'start_url': self.START_URL})
+        response = HtmlResponse(request.url, request=request, body='')
+        item = Advertisement(foreign_id=1)
+        self.assertEqual(self.middleware.process_spider_output(
+            response, [item], self.spider), [item])
+
+
+@unittest.skipUnless(BENCH_DATABASE, 'BENCH_DATABASE is not set')
+class CrawlMarkTestCase(unittest.TestCase):
+    START_URL = 'http://irr.ru/cars/passenger/uaz/test/'
+
+    def setUp(self):
+        self.engine = db_connect(BENCH_DATABASE)
+        create_tables(self.engine)
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
+        self.engine.dispose()
+
+    def cleanup(self):
+        self.engine.execute(CrawlMark.__table__.delete().where(
+            CrawlMark.start_url == self.START_URL))
+
+    def crawl(self, foreign_id):
+        """Finishes a crawl, which has seen the advertisement, and returns
+           marks loaded by the next crawl."""
+        middleware = IncrementalCrawlMiddleware.from_crawler(get_crawler({
+            'INCREMENTAL_CRAWL': True, 'DATABASE': BENCH_DATABASE}))
+        middleware.seen = {self.START_URL: foreign_id}
+        middleware.spider_closed(SpiderStub(), 'finished')
+        middleware.spider_opened(SpiderStub())
+        return middleware.marks[self.START_URL]
+
+    def test_marks(self):
+        self.assertEqual(self.crawl(241452769), 241452769)
+        self.assertEqual(self.crawl(241452700), 241452769)
+        self.assertEqual(self.crawl(241452770), 241452770)
+        self.assertEqual(self.engine.execute(
+            CrawlMark.__table__.count().where(
+                CrawlMark.start_url == self.START_URL)).scalar(), 1)
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_membership(self):
+        bloom = BloomFilter(1000, 0.001)
+        for foreign_id in xrange(1000):
+            bloom.add(foreign_id * 7)
+        self.assertEqual(len(bloom), 1000)
+        for foreign_id in xrange(1000):
+            self.assertIn(foreign_id * 7, bloom)
+        false_positives = sum(1 for foreign_id in xrange(10000, 20000)
+                              if foreign_id * 7 + 1 in bloom)
+        self.assertLess(false_positives, 100)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_models
+   :platform: Unix
+   :synopsis: Testing of the database upgrade from "models" module
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import unittest
+from datetime import datetime
+
+from scrapy.utils.project import get_project_settings
+
+from uaz.models import CrawlMark, create_tables, db_connect, migrate
+
+BENCH_DATABASE = get_project_settings().get('BENCH_DATABASE')
+
+
+@unittest.skipUnless(BENCH_DATABASE, 'BENCH_DATABASE is not set')
+class MigrateTestCase(unittest.TestCase):
+    START_URL = 'http://irr.ru/cars/passenger/uaz/migrate/'
+    INDEX = 'crawl_mark_start_url_key'
+
+    def setUp(self):
+        self.engine = db_connect(BENCH_DATABASE)
+        create_tables(self.engine)
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
+        migrate(self.engine)
+        self.engine.dispose()
+
+    def cleanup(self):
+        self.engine.execute(CrawlMark.__table__.delete().where(
+            CrawlMark.start_url == self.START_URL))
+
+    def test_missing_unique_index(self):
+        # crawl_mark of a previous version
+        self.engine.execute(u"DROP INDEX {0}".format(self.INDEX))
+        for foreign_id in (241452769, 241452770):
+            self.engine.execute(CrawlMark.__table__.insert().values(
+                start_url=self.START_URL, foreign_id=foreign_id,
+                updated=datetime.now()))
+        # create_tables doesn't change existing tables
+        create_tables(self.engine)
+        self.assertEqual(self.marks(), [241452769, 241452770])
+        self.assertEqual(migrate(self.engine), [self.INDEX])
+        self.assertEqual(self.marks(), [241452769])
+        self.assertEqual(migrate(self.engine), [])
+
+    def marks(self):
+        return sorted(foreign_id for foreign_id, in self.engine.execute(
+            CrawlMark.__table__.select().with_only_columns(
+                [CrawlMark.foreign_id]).where(
+                    CrawlMark.start_url == self.START_URL)))
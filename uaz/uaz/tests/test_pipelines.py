@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_pipelines
+   :platform: Unix
+   :synopsis: Testing of helpers from "pipelines" module
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from Queue import Queue
+from threading import Event, Thread
+
+from twisted.python.failure import Failure
+
+from scrapy.exceptions import DropItem
+from scrapy.settings import Settings
+from scrapy.utils.project import get_project_settings
+
+from uaz.items import Advertisement, AdvertisementSummary
+from uaz.models import Seller, Manufacturer, PriceChange, Source
+from uaz.models import Advertisement as AdvertisementModel
+from uaz.pipelines import ReferenceCache, UazDBPipeline, UazExcelPipeline
+from uaz.pipelines import UazAsyncDBPipeline
+
+from .test_browser import wait_until
+
+BENCH_DATABASE = get_project_settings().get('BENCH_DATABASE')
+
+
+class ReferenceCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ReferenceCache(seller_cache_size=2)
+
+    def test_hits_and_misses(self):
+        key = self.cache.key(name=u'УАЗ')
+        self.assertIsNone(self.cache.get(Manufacturer, key))
+        self.cache.add(Manufacturer, key, 1)
+        self.assertEqual(self.cache.get(Manufacturer, key), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_key_ignores_fields_order(self):
+        self.assertEqual(self.cache.key(name=u'МегаМоторс', url=None),
+                         self.cache.key(url=None, name=u'МегаМоторс'))
+
+    def test_sellers_bounded(self):
+        keys = [self.cache.key(name=name, url=None)
+                for name in (u'first', u'second', u'third')]
+        self.cache.add(Seller, keys[0], 1)
+        self.cache.add(Seller, keys[1], 2)
+        self.assertEqual(self.cache.get(Seller, keys[0]), 1)
+        self.cache.add(Seller, keys[2], 3)
+        self.assertEqual(self.cache.get(Seller, keys[0]), 1)
+        self.assertIsNone(self.cache.get(Seller, keys[1]))
+        self.assertEqual(self.cache.get(Seller, keys[2]), 3)
+
+    def test_rollback(self):
+        old, new = self.cache.key(name=u'old'), self.cache.key(name=u'new')
+        self.cache.add(Manufacturer, old, 1, created=True)
+        self.cache.commit()
+        self.cache.add(Manufacturer, new, 2, created=True)
+        self.cache.rollback()
+        self.assertEqual(self.cache.get(Manufacturer, old), 1)
+        self.assertIsNone(self.cache.get(Manufacturer, new))
+
+    def test_concurrent_transactions(self):
+        first, second = Writer(), Writer()
+        committed = self.cache.key(name=u'committed')
+        rolled_back = self.cache.key(name=u'rolled back')
+        first.call(self.cache.add, Manufacturer, committed, 1, created=True)
+        second.call(self.cache.add, Manufacturer, rolled_back, 2,
+                    created=True)
+        # uncommitted records of other transactions aren't seen
+        self.assertIsNone(second.call(self.cache.get, Manufacturer,
+                                      committed))
+        self.assertEqual(second.call(self.cache.get, Manufacturer,
+                                     rolled_back), 2)
+        first.call(self.cache.commit)
+        second.call(self.cache.rollback)
+        self.assertEqual(second.call(self.cache.get, Manufacturer,
+                                     committed), 1)
+        for writer in (first, second):
+            self.assertIsNone(writer.call(self.cache.get, Manufacturer,
+                                          rolled_back))
+            writer.stop()
+
+
+class Writer(Thread):
+    """Writing thread, which calls functions one by one."""
+
+    def __init__(self):
+        super(Writer, self).__init__()
+        self.daemon = True
+        self.calls, self.results = Queue(), Queue()
+        self.start()
+
+    def run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            func, args, kwargs = call
+            self.results.put(func(*args, **kwargs))
+
+    def call(self, func, *args, **kwargs):
+        self.calls.put((func, args, kwargs))
+        return self.results.get(timeout=5)
+
+    def stop(self):
+        self.calls.put(None)
+        self.join()
+
+
+class PipelineTestMixin(object):
+    """Stored test advertisements and their cleanup."""
+    FOREIGN_ID = 990000001
+    SOURCE = u'irr.ru'
+    OTHER_SOURCE = u'test.irr.ru'
+    pipeline_class = UazDBPipeline
+
+    def setUp(self):
+        self.pipeline = self.create_pipeline()
+        self.cleanup()
+
+    def create_pipeline(self, crawler=None, **settings):
+        pipeline = self.pipeline_class(database=BENCH_DATABASE,
+                                       settings=Settings(dict({
+                                           'TRACK_CHANGES': True},
+                                           **settings)),
+                                       crawler=crawler)
+        pipeline.preload_references()
+        return pipeline
+
+    def tearDown(self):
+        self.cleanup()
+
+    def cleanup(self):
+        session = self.pipeline.Session()
+        ads = session.query(AdvertisementModel.id).join(Source).filter(
+            AdvertisementModel.foreign_id.in_([self.FOREIGN_ID,
+                                               self.FOREIGN_ID + 1]),
+            Source.name.in_([self.SOURCE, self.OTHER_SOURCE])).subquery()
+        session.query(PriceChange).filter(PriceChange.advertisement_id.in_(
+            ads)).delete(synchronize_session=False)
+        session.query(AdvertisementModel).filter(
+            AdvertisementModel.id.in_(ads)).delete(synchronize_session=False)
+        session.query(Source).filter(Source.name == self.OTHER_SOURCE).delete(
+            synchronize_session=False)
+        session.commit()
+        session.close()
+
+    def item(self, cls, price, foreign_id=FOREIGN_ID,
+             title=u'УАЗ 3163 Patriot'):
+        return cls(source=self.SOURCE, foreign_id=foreign_id,
+                   url=u'http://irr.ru/cars/passenger/UAZ-advert{0}.html'
+                   .format(foreign_id), title=title,
+                   price=price, published=datetime(2014, 1, 10))
+
+    def stored(self, foreign_id=FOREIGN_ID):
+        """Returns the stored price and the recorded price changes."""
+        session = self.pipeline.Session()
+        ad = session.query(AdvertisementModel).join(Source).filter(
+            AdvertisementModel.foreign_id == foreign_id,
+            Source.name == self.SOURCE).one()
+        changes = [(change.old_price, change.new_price) for change in
+                   session.query(PriceChange).filter(
+                       PriceChange.advertisement_id == ad.id)
+                   .order_by(PriceChange.id)]
+        session.close()
+        return ad.price, changes
+
+
+@unittest.skipUnless(BENCH_DATABASE, 'BENCH_DATABASE is not set')
+class UazDBPipelineTestCase(PipelineTestMixin, unittest.TestCase):
+
+    def test_price_changes(self):
+        self.pipeline.store([self.item(Advertisement, 500000.0)])
+        self.assertEqual(self.stored(), (500000.0, []))
+        # summary from a listing page
+        for _ in xrange(2):
+            self.pipeline.store([self.item(AdvertisementSummary, 480000.0)])
+            self.assertEqual(self.stored(),
+                             (480000.0, [(500000.0, 480000.0)]))
+        # page of the advertisement rendered again
+        for _ in xrange(2):
+            errors = self.pipeline.store([self.item(Advertisement, 450000.0)])
+            self.assertIsInstance(errors[0], DropItem)
+        self.assertEqual(self.stored(), (450000.0, [(500000.0, 480000.0),
+                                                    (480000.0, 450000.0)]))
+
+    def test_update(self):
+        self.pipeline.store([self.item(Advertisement, 500000.0)])
+        item = self.item(Advertisement, 450000.0)
+        item['source'] = self.OTHER_SOURCE
+        self.assertEqual(self.pipeline.update([item]), 0)
+        self.assertEqual(self.stored(), (500000.0, []))
+        self.assertEqual(self.pipeline.update(
+            [self.item(Advertisement, 450000.0)]), 1)
+        self.assertEqual(self.stored(), (450000.0, []))
+
+    def test_update_without_published(self):
+        self.pipeline.store([self.item(Advertisement, 500000.0)])
+        item = self.item(Advertisement, 450000.0)
+        del item['published']
+        self.assertEqual(self.pipeline.update([item]), 1)
+        session = self.pipeline.Session()
+        ad = session.query(AdvertisementModel).filter(
+            AdvertisementModel.foreign_id == self.FOREIGN_ID).one()
+        self.assertEqual(ad.published, datetime(2014, 1, 10))
+        self.assertEqual(ad.price, 450000.0)
+        session.close()
+
+    def test_same_id_of_other_source(self):
+        self.pipeline.store([self.item(Advertisement, 500000.0)])
+        item = self.item(Advertisement, 450000.0)
+        item['source'] = self.OTHER_SOURCE
+        self.assertEqual(self.pipeline.store([item]), [None])
+        self.assertIsInstance(self.pipeline.store([item])[0], DropItem)
+        self.assertEqual(self.stored(), (500000.0, []))
+
+    def test_broken_item(self):
+        pipeline = self.create_pipeline(DB_BATCH_SIZE=2)
+        results = []
+        for item in (self.item(Advertisement, 500000.0),
+                     # too long for the title column
+                     self.item(Advertisement, 500000.0, self.FOREIGN_ID + 1,
+                               u'УАЗ' * 100)):
+            pipeline.process_item(item, None).addBoth(results.append)
+        self.assertEqual(results[0]['foreign_id'], self.FOREIGN_ID)
+        self.assertIsInstance(results[1], Failure)
+        self.assertEqual(self.stored(), (500000.0, []))
+
+    def test_stall(self):
+        crawler = CrawlerStub()
+        pipeline = self.create_pipeline(crawler, DB_BATCH_SIZE=10)
+        results = []
+        pipeline.process_item(self.item(Advertisement, 500000.0),
+                              None).addBoth(results.append)
+        self.assertEqual(results, [])
+        # responses of buffered items stopped the engine
+        crawler.engine.scraper.slot.backout = True
+        pipeline.process_item(self.item(AdvertisementSummary, 480000.0),
+                              None).addBoth(results.append)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(pipeline.batch, [])
+        self.assertEqual(self.stored(), (480000.0, [(500000.0, 480000.0)]))
+
+    def test_last_batch(self):
+        crawler = CrawlerStub()
+        pipeline = self.create_pipeline(crawler, DB_BATCH_SIZE=10,
+                                        DB_BATCH_TIMEOUT=0)
+        pipeline.open_spider(None)
+        results = []
+        try:
+            self.assertTrue(pipeline.flusher.running)
+            pipeline.process_item(self.item(Advertisement, 500000.0),
+                                  None).addBoth(results.append)
+            pipeline.tick()
+            self.assertEqual(results, [])
+            # the last page is downloaded
+            crawler.engine.downloader.active = set()
+            pipeline.tick()
+            self.assertEqual(len(results), 1)
+        finally:
+            pipeline.close_spider(None)
+        self.assertFalse(pipeline.flusher.running)
+        self.assertEqual(self.stored(), (500000.0, []))
+
+
+class CrawlerStub(object):
+    """Crawler with an engine, which is downloading pages."""
+
+    def __init__(self):
+        scraper_slot = type('ScraperSlotStub', (object,), {
+            'backout': False,
+            'needs_backout': lambda self: self.backout})()
+        self.engine = type('EngineStub', (object,), {
+            'paused': False,
+            'pause': lambda self: setattr(self, 'paused', True),
+            'unpause': lambda self: setattr(self, 'paused', False)})()
+        self.engine.slot = type('SlotStub', (object,), {})()
+        self.engine.slot.start_requests = None
+        self.engine.slot.scheduler = []
+        self.engine.downloader = type('DownloaderStub', (object,), {})()
+        self.engine.downloader.active = set(['http://irr.ru/'])
+        self.engine.scraper = type('ScraperStub', (object,), {})()
+        self.engine.scraper.slot = scraper_slot
+
+
+@unittest.skipUnless(BENCH_DATABASE, 'BENCH_DATABASE is not set')
+class UazAsyncDBPipelineTestCase(PipelineTestMixin, unittest.TestCase):
+    pipeline_class = UazAsyncDBPipeline
+
+    def tearDown(self):
+        closed = []
+        self.pipeline.close_spider(None).addBoth(closed.append)
+        self.assertTrue(wait_until(lambda: closed))
+        super(UazAsyncDBPipelineTestCase, self).tearDown()
+
+    def blocked_writes(self):
+        """Makes worker threads wait for the returned event before writes."""
+        release, store_batch = Event(), self.pipeline.store_batch
+
+        def blocked(items):
+            release.wait(5)
+            return store_batch(items)
+        self.pipeline.store_batch = blocked
+        return release
+
+    def test_write(self):
+        self.pipeline.open_spider(None)
+        release = self.blocked_writes()
+        results = []
+        self.pipeline.process_item(self.item(Advertisement, 500000.0),
+                                   None).addBoth(results.append)
+        self.assertEqual(len(self.pipeline.writing), 1)
+        self.assertEqual(self.pipeline.queued, 1)
+        release.set()
+        self.assertTrue(wait_until(lambda: results))
+        self.assertEqual(results[0]['foreign_id'], self.FOREIGN_ID)
+        self.assertEqual((self.pipeline.writing, self.pipeline.queued),
+                         (set(), 0))
+        self.assertEqual(self.stored(), (500000.0, []))
+
+    def test_queue_full(self):
+        crawler = CrawlerStub()
+        self.pipeline = self.create_pipeline(crawler, DB_BATCH_SIZE=1,
+                                             DB_WRITE_QUEUE_SIZE=2)
+        self.pipeline.open_spider(None)
+        release = self.blocked_writes()
+        results = []
+        for foreign_id in (self.FOREIGN_ID, self.FOREIGN_ID + 1):
+            self.pipeline.process_item(
+                self.item(Advertisement, 500000.0, foreign_id),
+                None).addBoth(results.append)
+        self.assertTrue(crawler.engine.paused)
+        self.assertEqual(len(self.pipeline.writing), 2)
+        # items are resolved only when they are stored
+        self.assertEqual(results, [])
+        release.set()
+        self.assertTrue(wait_until(lambda: len(results) == 2))
+        self.assertFalse(crawler.engine.paused)
+        self.assertEqual(sorted(item['foreign_id'] for item in results),
+                         [self.FOREIGN_ID, self.FOREIGN_ID + 1])
+        for foreign_id in (self.FOREIGN_ID, self.FOREIGN_ID + 1):
+            self.assertEqual(self.stored(foreign_id), (500000.0, []))
+
+    def test_last_batch_on_close(self):
+        self.pipeline = self.create_pipeline(DB_BATCH_SIZE=10)
+        self.pipeline.open_spider(None)
+        results = []
+        self.pipeline.process_item(self.item(Advertisement, 500000.0),
+                                   None).addBoth(results.append)
+        self.assertEqual(self.pipeline.writing, set())
+        closed = []
+        self.pipeline.close_spider(None).addBoth(closed.append)
+        self.assertTrue(wait_until(lambda: closed))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(self.stored(), (500000.0, []))
+
+
+class UazExcelPipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pipeline = UazExcelPipeline()
+        self.pipeline.filename = os.path.join(self.directory, u'ads.xls')
+        self.pipeline.dataorder = ((u'foreign_id', u'ID'),
+                                   (u'title', u'Заголовок'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def process_items(self, count):
+        for foreign_id in xrange(count):
+            self.pipeline.process_item(
+                Advertisement(foreign_id=foreign_id, title=u'УАЗ'), None)
+
+    def test_written_on_close(self):
+        self.process_items(3)
+        self.assertFalse(os.path.exists(self.pipeline.filename))
+        self.pipeline.close_spider(None)
+        self.assertTrue(os.path.exists(self.pipeline.filename))
+        self.assertEqual(self.pipeline.unsaved, 0)
+
+    def test_checkpoint(self):
+        self.pipeline.checkpoint_rows = 2
+        self.process_items(1)
+        self.assertFalse(os.path.exists(self.pipeline.filename))
+        self.process_items(2)
+        self.assertTrue(os.path.exists(self.pipeline.filename))
+        self.assertEqual(self.pipeline.unsaved, 1)
+
+    def test_sheet_rollover(self):
+        self.pipeline.MAX_ROWS = 3
+        self.process_items(5)
+        self.assertEqual(self.pipeline.sheets, 3)
+        self.assertEqual(self.pipeline.wb.get_sheet(1).name, u'{0} (2)'
+                         .format(self.pipeline.sheet_title))
+        self.assertEqual(
+            [sorted(self.pipeline.wb.get_sheet(num).get_rows().keys())
+             for num in xrange(1, 3)],
+            [[0, 1, 2], [0, 1]])
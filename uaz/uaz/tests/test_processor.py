@@ -9,10 +9,13 @@
 """
 
 import unittest
-from datetime import datetime
+from datetime import date, datetime, timedelta
+
+from scrapy.utils.test import get_crawler
 
 from uaz.processor import only_digits, only_price
 from uaz.processor import datetime_interpretation, only_letters
+from uaz.processor import DatetimeParser
 
 
 class DigitProcessorTestCase(unittest.TestCase):
@@ -38,6 +41,32 @@ class DigitProcessorTestCase(unittest.TestCase):
         ):
             self.assertEqual(only_price(raw), result)
 
+    def test_ranges_and_separators(self):
+        for raw, result in (
+            (u'120-150 л.с.', 120), (u'1\u00a0500 км', 1500),
+            (u'2,7 л', 2.7), (u'от 2.4 – 2.7 л', 2.4), (u'2.7 л.с.', 2.7),
+            (u'л.с.', None),
+            (u'1.500.5', None),
+        ):
+            self.assertEqual(only_digits(raw), result)
+        self.assertEqual(only_price(u'500 000 — 600 000 руб.'), 500000.0)
+
+    def test_comma_thousands(self):
+        for raw, result in (
+            (u'1,500 км', 1500), (u'125,000 км', 125000),
+            (u'1,500,000', 1500000), (u'1,500.5', 1500.5),
+            (u'2,75 л', 2.75), (u'1,5000', 1.5),
+        ):
+            self.assertEqual(only_digits(raw), result)
+        self.assertEqual(only_price(u'1,500,000 руб.'), 1500000.0)
+
+    def test_force_int(self):
+        for raw, result in (
+            (u'2.7 л', 27), (u'№ 241452769', 241452769), (u'1,500 км', 1500),
+            (u'л.с.', None),
+        ):
+            self.assertEqual(only_digits(raw, force_int=True), result)
+
     def test_datetime_interpretation(self):
         for raw, result in (
             (u'10 октября 2013', datetime(2013, 10, 10)),
@@ -57,6 +86,43 @@ class DigitProcessorTestCase(unittest.TestCase):
         ):
             self.assertEqual(datetime_interpretation(raw), result)
 
+    def test_datetime_relative(self):
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        for raw, result in (
+            (u'сегодня, 14:05', datetime(today.year, today.month, today.day,
+                                         14, 5)),
+            (u'Вчера', datetime(yesterday.year, yesterday.month,
+                                yesterday.day)),
+            (u'1 января', datetime(today.year, 1, 1)),
+            (u'27 декабря 2013, 9:30', datetime(2013, 12, 27, 9, 30)),
+            (u'32 декабря 2013', None),
+        ):
+            self.assertEqual(datetime_interpretation(raw), result)
+
+    def test_datetime_relative_to_fetch_time(self):
+        fetched = dict(now=datetime(2014, 1, 1, 12, 0))
+        unknown = dict(relative_dates=False)
+        for raw, context, result in (
+            (u'вчера, 14:05', fetched, datetime(2013, 12, 31, 14, 5)),
+            (u'5 января', fetched, datetime(2013, 1, 5)),
+            (u'вчера, 14:05', unknown, None),
+            (u'5 января', unknown, None),
+            (u'27 декабря 2013', unknown, datetime(2013, 12, 27)),
+        ):
+            self.assertEqual(datetime_interpretation(raw, context), result)
+
+    def test_datetime_parser_cache(self):
+        parser = DatetimeParser(cache_size=2, stats=get_crawler().stats)
+        for raw in (u'27 декабря 2013', u'December 15, 2013',
+                    u'27 декабря 2013', u'12/04/2013', u'December 15, 2013'):
+            parser(raw)
+        self.assertEqual(list(parser.cache),
+                         [u'12/04/2013', u'December 15, 2013'])
+        self.assertEqual(parser.fallbacks, 3)
+        self.assertEqual(
+            parser.stats.get_value('datetime/dateutil_fallbacks'), 3)
+
     def test_only_letters(self):
         for raw, result in (
             (u'172 л.с.', u'лс'), ('2.340л', u'л'), (u'2013 г.', u'г')
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_proxies
+   :platform: Unix
+   :synopsis: Testing of the pool of proxies
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import unittest
+
+from twisted.internet import defer
+
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+from scrapy.statscol import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+
+from uaz.proxies import ProxyPool, proxy_list
+
+
+AD_PAGE = '<html><body><h1 class="title3">UAZ</h1></body></html>'
+BAN_PAGE = '<html><body><div class="g-recaptcha"></div></body></html>'
+
+
+class ProxyPoolTestCase(unittest.TestCase):
+
+    def create_pool(self, **settings):
+        settings.setdefault('PROXY_PARAMS', ['first:8123', 'second:8123'])
+        pool = ProxyPool(Settings(dict({
+            'RANDOMIZE_DOWNLOAD_DELAY': False,
+            'PROXY_BAN_MARKERS': ['g-recaptcha'],
+            'PROXY_BAN_STATUSES': [429],
+        }, **settings)))
+        pool.stats = MemoryStatsCollector(get_crawler())
+        return pool
+
+    def download(self, pool, pages):
+        """Downloads a page by the pool, pages are bodies by proxies."""
+        results, proxies = [], []
+
+        def download_by(slot):
+            proxies.append(slot.address)
+            body = pages[slot.address]
+            if body is None:
+                return defer.fail(IOError('Connection refused'))
+            return HtmlResponse('http://irr.ru/', body=body)
+        pool.fetch(download_by).addBoth(results.append)
+        return results[0], proxies
+
+    def test_proxy_list(self):
+        self.assertEqual(proxy_list(Settings({'PROXY_PARAMS': 'relay:8123'})),
+                         ['relay:8123'])
+        self.assertEqual(proxy_list(Settings({
+            'PROXY_PARAMS': 'first:8123, second:8123'})),
+            ['first:8123', 'second:8123'])
+        self.assertEqual(proxy_list(Settings({'PROXY_PARAMS': None})), [None])
+
+    def test_fastest_proxy(self):
+        pool = self.create_pool(PROXY_DOWNLOAD_DELAY=10)
+        first, second = pool.slots
+        first.latency, second.latency = 2.0, 1.0
+        slot, wait = pool.choose()
+        self.assertIs(slot, second)
+        self.assertEqual(wait, 0)
+        # the fastest proxy is busy by its rate limit
+        slot, wait = pool.choose()
+        self.assertIs(slot, first)
+        self.assertEqual(wait, 0)
+        slot, wait = pool.choose()
+        self.assertIs(slot, second)
+        self.assertGreater(wait, 9)
+
+    def test_ban(self):
+        pool = self.create_pool()
+        response, proxies = self.download(pool, {'first:8123': BAN_PAGE,
+                                                 'second:8123': AD_PAGE})
+        self.assertEqual(response.body, AD_PAGE)
+        self.assertEqual(proxies, ['first:8123', 'second:8123'])
+        self.assertEqual(pool.stats.get_value('proxy/cooldowns/ban'), 1)
+        self.assertEqual(pool.stats.get_value('proxy/ban_retries'), 1)
+        # the banned proxy is cooled down
+        self.assertEqual(self.download(pool, {'second:8123': AD_PAGE})[1],
+                         ['second:8123'])
+
+    def test_all_banned(self):
+        pool = self.create_pool()
+        response, proxies = self.download(pool, {'first:8123': BAN_PAGE,
+                                                 'second:8123': BAN_PAGE})
+        # no retry through the first proxy, which is cooled down
+        self.assertEqual(response.body, BAN_PAGE)
+        self.assertEqual(proxies, ['first:8123', 'second:8123'])
+        self.assertEqual(pool.stats.get_value('proxy/ban_retries'), 1)
+        pool = self.create_pool(PROXY_PARAMS=['first:8123'])
+        response, proxies = self.download(pool, {'first:8123': BAN_PAGE})
+        self.assertEqual(proxies, ['first:8123'])
+        self.assertIsNone(pool.stats.get_value('proxy/ban_retries'))
+
+    def test_failures(self):
+        pool = self.create_pool(PROXY_MAX_FAILURES=2)
+        pages = {'first:8123': None, 'second:8123': AD_PAGE}
+        for _ in xrange(2):
+            failure, proxies = self.download(pool, pages)
+            self.assertTrue(failure.check(IOError))
+            self.assertEqual(proxies, ['first:8123'])
+        self.assertEqual(pool.stats.get_value('proxy/failures'), 2)
+        self.assertEqual(pool.stats.get_value('proxy/cooldowns/failures'), 1)
+        response, proxies = self.download(pool, pages)
+        self.assertEqual(proxies, ['second:8123'])
+        self.assertIsNone(pool.slots[0].session)
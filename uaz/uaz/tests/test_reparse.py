@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_reparse
+   :platform: Unix
+   :synopsis: Testing of stored pages parsing from "reparse" command
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import os
+import os.path as op
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from cStringIO import StringIO
+from datetime import datetime
+
+from scrapy.settings import Settings
+
+from uaz.commands.reparse import iter_pages, parse_page
+from uaz.httpcache import RenderedPageStorage
+
+from .spider_testcase import SpiderTestCase
+from .test_middlewares import SpiderStub
+
+
+class ReparseTestCase(SpiderTestCase):
+    AD_URL = u'http://irr.ru/cars/passenger/UAZ-advert241452769.html'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.page = op.join(self.RESPONSES_DIRECTORY, 'sample1.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def relative_response(self, **kwargs):
+        response = self.response_from_file('sample1.html', self.AD_URL)
+        return response.replace(body=response.body.replace(
+            u'27 декабря 2013'.encode('utf-8'),
+            u'вчера, 14:05'.encode('utf-8')), **kwargs)
+
+    def store(self, response):
+        spider = SpiderStub()
+        spider.name = 'irr'
+        storage = RenderedPageStorage(
+            Settings({'HTTPCACHE_DIR': self.directory}))
+        storage.store_response(spider, response.request, response)
+        pages = list(iter_pages([self.directory]))
+        self.assertEqual(len(pages), 1)
+        return pages[0][0]
+
+    def test_html_page(self):
+        item = parse_page(next(iter_pages([self.page])))
+        self.assertEqual(item['foreign_id'], 241452769)
+        self.assertNotIn('url', item)
+
+    def test_cached_page(self):
+        path = self.store(
+            self.response_from_file('sample1.html', self.AD_URL))
+        item = parse_page((path, None, None))
+        self.assertEqual(item['url'], self.AD_URL)
+        self.assertEqual(item['foreign_id'], 241452769)
+        self.assertEqual(item['published'], datetime(2013, 12, 27))
+
+    def test_relative_date_by_date_header(self):
+        path = self.store(self.relative_response(
+            headers={'Date': 'Wed, 01 Jan 2014 10:00:00 GMT'}))
+        self.assertEqual(parse_page((path, None, None))['published'],
+                         datetime(2013, 12, 31, 14, 5))
+
+    def test_relative_date_by_mtime(self):
+        path = self.store(self.relative_response())
+        mtime = time.mktime((2014, 1, 1, 12, 0, 0, 0, 0, -1))
+        os.utime(path, (mtime, mtime))
+        self.assertEqual(parse_page((path, None, None))['published'],
+                         datetime(2013, 12, 31, 14, 5))
+
+    def test_relative_date_of_html_page(self):
+        path = op.join(self.directory, 'relative.html')
+        with open(path, 'wb') as page:
+            page.write(self.relative_response().body)
+        item = parse_page(next(iter_pages([path])))
+        self.assertEqual(item['foreign_id'], 241452769)
+        self.assertNotIn('published', item)
+
+    def test_archive(self):
+        path = op.join(self.directory, 'pages.tar.gz')
+        archive = tarfile.open(path, 'w:gz')
+        archive.add(self.page, 'pages/sample1.html')
+        archive.close()
+        pages = list(iter_pages([path]))
+        self.assertEqual([name for name, content, mtime in pages],
+                         ['pages/sample1.html'])
+        self.assertEqual(parse_page(pages[0])['foreign_id'], 241452769)
+
+    def test_broken_page(self):
+        path = op.join(self.directory, 'broken.gz')
+        with open(path, 'wb') as page:
+            page.write('<html>')
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertIsNone(parse_page(next(iter_pages([path]))))
+        finally:
+            sys.stderr = stderr
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: test_scheduler
+   :platform: Unix
+   :synopsis: Testing of the schedulers of resumable and sharded crawls
+
+.. moduleauthor:: Anton Konyshev <anton.konyshev@gmail.com>
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Thread
+
+from scrapy.crawler import Crawler
+from scrapy.http import Request
+from scrapy.settings import Settings
+from scrapy.spider import Spider
+from scrapy.utils.project import get_project_settings
+
+from uaz.models import create_tables, db_connect
+from uaz.scheduler import Frontier, FrontierScheduler, ResumableScheduler
+
+from .test_browser import wait_until
+
+BENCH_DATABASE = get_project_settings().get('BENCH_DATABASE')
+
+
+class EngineStub(object):
+
+    def __init__(self):
+        self.slot = type('SlotStub', (object,), {})()
+        self.slot.inprogress = set()
+        self.slot.nextcall = type('CallStub', (object,), {
+            'schedule': lambda self, delay=0: None})()
+
+
+class ResumableSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.jobdir = tempfile.mkdtemp()
+        self.crawler = Crawler(Settings({'JOBDIR': self.jobdir}))
+        self.crawler.engine = EngineStub()
+        self.spider = Spider('test')
+
+    def tearDown(self):
+        shutil.rmtree(self.jobdir)
+
+    def open_scheduler(self):
+        scheduler = ResumableScheduler.from_crawler(self.crawler)
+        scheduler.open(self.spider)
+        return scheduler
+
+    def take(self, scheduler):
+        request = scheduler.next_request()
+        self.crawler.engine.slot.inprogress.add(request)
+        return request
+
+    def test_resumed_after_crash(self):
+        scheduler = self.open_scheduler()
+        scheduler.enqueue_request(Request('http://irr.ru/', dont_filter=True,
+                                          priority=2))
+        scheduler.enqueue_request(Request('http://irr.ru/advert1.html',
+                                          priority=1))
+        scheduler.enqueue_request(Request('http://irr.ru/advert2.html'))
+        start = self.take(scheduler)
+        self.take(scheduler)
+        self.crawler.engine.slot.inprogress.discard(start)
+        scheduler.checkpoint()
+        # the crash: nothing is closed properly
+        scheduler.journal.close()
+        scheduler.df.close('shutdown')
+        self.crawler.engine.slot.inprogress.clear()
+
+        scheduler = self.open_scheduler()
+        scheduler.enqueue_request(Request('http://irr.ru/', dont_filter=True))
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(sorted(self.take(scheduler).url for _ in xrange(2)),
+                         ['http://irr.ru/advert1.html',
+                          'http://irr.ru/advert2.html'])
+        self.assertEqual(self.crawler.stats.get_value('scheduler/resumed'), 2)
+        self.crawler.engine.slot.inprogress.clear()
+        scheduler.close('finished')
+        self.assertEqual(os.listdir(self.jobdir), [])
+
+
+class FrontierStub(object):
+    """Frontier in memory: rows are lists of id, fingerprint, pickled
+       request, attempts, worker and done flag."""
+
+    def __init__(self, worker, rows):
+        self.worker = worker
+        self.rows = rows
+        self.lease = 600
+
+    def add(self, rows):
+        known = set(row[1] for row in self.rows)
+        added = [row for row in rows if row['fingerprint'] not in known]
+        for row in added:
+            self.rows.append([len(self.rows) + 1, row['fingerprint'],
+                              row['request'], 0, None, False])
+        return len(added)
+
+    def claim(self, size):
+        claimed = [row for row in self.rows
+                   if row[4] is None and not row[5]][:size]
+        for row in claimed:
+            row[3] += 1
+            row[4] = self.worker
+        return [tuple(row[:4]) for row in claimed]
+
+    def select(self, ids):
+        return [row for row in self.rows if row[0] in ids]
+
+    def complete(self, ids):
+        for row in self.select(ids):
+            row[5] = True
+
+    def release(self, ids):
+        for row in self.select(ids):
+            row[3] -= 1
+            row[4] = None
+
+    def renew(self, ids):
+        pass
+
+    def has_pending(self):
+        return any(not row[5] for row in self.rows)
+
+    def finish(self):
+        if self.has_pending():
+            return None
+        del self.rows[:]
+        return 0
+
+
+class FrontierSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = []
+        self.spider = Spider('test')
+
+    def open_scheduler(self, worker):
+        crawler = Crawler(Settings({'CONCURRENT_REQUESTS': 2}))
+        crawler.engine = EngineStub()
+        scheduler = FrontierScheduler.from_crawler(crawler)
+        # Scheduler.open without connection to the database
+        super(FrontierScheduler, scheduler).open(self.spider)
+        scheduler.frontier = FrontierStub(worker, self.rows)
+        scheduler.claim_size = 2
+        scheduler.claim_interval = 0
+        scheduler.threadpool.start()
+        self.addCleanup(scheduler.threadpool.stop)
+        return scheduler
+
+    def settle(self, scheduler):
+        """Waits for queries to the frontier (their results are delivered
+           by the reactor)."""
+        self.assertTrue(wait_until(lambda: not scheduler.calls))
+
+    def take(self, scheduler):
+        request = scheduler.next_request()
+        self.settle(scheduler)
+        if request is None:
+            # claimed requests are queued when the claim returns
+            request = scheduler.next_request()
+            self.settle(scheduler)
+        if request is not None:
+            scheduler.crawler.engine.slot.inprogress.add(request)
+        return request
+
+    def test_shared_by_workers(self):
+        first = self.open_scheduler('first')
+        second = self.open_scheduler('second')
+        for num in xrange(3):
+            first.enqueue_request(Request(
+                'http://irr.ru/advert{0}.html'.format(num), dont_filter=True))
+            second.enqueue_request(Request(
+                'http://irr.ru/advert{0}.html'.format(num), dont_filter=True))
+        advert = self.take(first)
+        row = self.rows[first.active[advert] - 1]
+        self.assertEqual(len(self.rows), 3)
+        self.assertEqual(self.take(second).url, 'http://irr.ru/advert2.html')
+        self.assertEqual(self.take(second), None)
+        self.assertTrue(second.has_pending_requests())
+        self.settle(second)
+        self.assertTrue(second.has_pending_requests())
+
+        # retry of a claimed request stays with the worker
+        first.enqueue_request(advert.replace(dont_filter=True))
+        first.crawler.engine.slot.inprogress.discard(advert)
+        retry = self.take(first)
+        self.assertEqual(retry.url, advert.url)
+        self.assertEqual(row[5], False)
+        first.crawler.engine.slot.inprogress.discard(retry)
+        first.checkpoint()
+        self.settle(first)
+        self.assertEqual(row[5], True)
+
+        # requests of a stopped worker return to the frontier
+        closed = []
+        first.close('shutdown').addBoth(closed.append)
+        self.assertTrue(wait_until(lambda: closed))
+        self.assertFalse(first.calls)
+        self.assertEqual([row[3:6] for row in self.rows if not row[5]],
+                         [[0, None, False], [1, 'second', False]])
+        self.assertEqual(self.take(second).url, 'http://irr.ru/advert0.html')
+
+    def test_finished(self):
+        scheduler = self.open_scheduler('first')
+        scheduler.pending_ttl = 60
+        scheduler.enqueue_request(Request('http://irr.ru/advert1.html'))
+        request = self.take(scheduler)
+        self.assertEqual(request.url, 'http://irr.ru/advert1.html')
+        scheduler.crawler.engine.slot.inprogress.discard(request)
+        # completion and the check are done in the thread of the scheduler
+        self.assertTrue(scheduler.has_pending_requests())
+        self.settle(scheduler)
+        self.assertTrue(scheduler.has_pending_requests())
+        self.settle(scheduler)
+        self.assertFalse(scheduler.has_pending_requests())
+        closed = []
+        scheduler.close('finished').addBoth(closed.append)
+        self.assertTrue(wait_until(lambda: closed))
+        self.assertEqual(self.rows, [])
+
+
+@unittest.skipUnless(BENCH_DATABASE, 'BENCH_DATABASE is not set')
+class FrontierTestCase(unittest.TestCase):
+    JOB = 'test_frontier'
+
+    def setUp(self):
+        self.engine = db_connect(BENCH_DATABASE)
+        create_tables(self.engine)
+        self.first = Frontier(self.engine, self.JOB, 'first')
+        self.second = Frontier(self.engine, self.JOB, 'second')
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
+        self.engine.dispose()
+
+    def cleanup(self):
+        self.first.execute(u"DELETE FROM crawl_frontier WHERE job = :job")
+
+    def add(self, count):
+        return self.first.add([{
+            'fingerprint': '{0:040d}'.format(number),
+            'url': u'http://irr.ru/{0}'.format(number),
+            'request': b'', 'priority': 0,
+        } for number in xrange(count)])
+
+    def expire_leases(self):
+        self.first.execute(
+            u"UPDATE crawl_frontier SET leased_until = "
+            u"(now() AT TIME ZONE 'UTC') - interval '1 second' "
+            u"WHERE job = :job AND done IS NULL")
+
+    def test_claims_without_overlap(self):
+        self.assertEqual(self.add(40), 40)
+        self.assertEqual(self.add(40), 0)
+        claimed = {'first': [], 'second': []}
+
+        def claim(frontier):
+            while True:
+                rows = frontier.claim(3)
+                if not rows:
+                    break
+                claimed[frontier.worker].extend(row[0] for row in rows)
+        workers = [Thread(target=claim, args=(frontier,))
+                   for frontier in (self.first, self.second)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        first, second = claimed['first'], claimed['second']
+        self.assertEqual(len(first + second), 40)
+        self.assertEqual(len(set(first + second)), 40)
+        # leased requests aren't claimed again
+        self.assertEqual(self.first.claim(10), [])
+        self.assertTrue(self.first.has_pending())
+        self.first.complete(first)
+        self.second.complete(second)
+        self.assertEqual(self.first.finish(), 0)
+        self.assertEqual(self.add(1), 1)
+
+    def test_expired_lease(self):
+        self.add(1)
+        (request_id, fingerprint, request, attempts), = self.first.claim(1)
+        self.assertEqual(attempts, 1)
+        self.assertEqual(self.second.claim(1), [])
+        # the first worker stopped
+        self.expire_leases()
+        self.assertEqual(self.second.claim(1),
+                         [(request_id, fingerprint, request, 2)])
+        self.assertIsNone(self.second.finish())
+        self.expire_leases()
+        self.assertEqual(len(self.first.claim(1)), 1)
+        # claimed max_attempts times
+        self.expire_leases()
+        self.assertEqual(self.second.claim(1), [])
+        self.assertEqual(self.second.finish(), 1)